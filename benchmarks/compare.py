@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基准结果比较 - 将本次结果与保存的基准结果比较，变差超过阈值的指标视为性能回退
+
+用法:
+    python benchmarks/compare.py baseline.json results.json --threshold 10
+
+存在性能回退时退出码为1，可直接用于CI。
+"""
+
+import argparse
+import json
+import sys
+
+
+def load_result(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_metrics(baseline, current, threshold):
+    """
+    比较两次结果中的同名指标
+    :param threshold: 允许的变差比例，如 0.1 表示10%
+    :return: [(指标名称, 基准值, 本次值, 变化比例, 状态)]，状态为 regression/improvement/ok
+    """
+    rows = []
+    for name, metric in current["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None or not base["value"]:
+            continue
+        change = metric["value"] / base["value"] - 1
+        # 统一为"正数表示变差"
+        worse = change if metric["better"] == "lower" else -change
+        if worse > threshold:
+            status = "regression"
+        elif worse < -threshold:
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append((name, base["value"], metric["value"], change, status))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PhotoWaterMark 基准结果比较')
+    parser.add_argument('baseline', help='基准结果JSON文件')
+    parser.add_argument('current', help='本次结果JSON文件')
+    parser.add_argument('--threshold', type=float, default=10.0, help='判定为回退的变差百分比 (默认值: 10)')
+    args = parser.parse_args()
+
+    baseline = load_result(args.baseline)
+    current = load_result(args.current)
+
+    # 输入或环境不同时结果不可直接比较
+    for key in ("corpus", "pillow", "cpu_count"):
+        if baseline["meta"].get(key) != current["meta"].get(key):
+            print(f"警告: {key} 不同 (基准: {baseline['meta'].get(key)}, 本次: {current['meta'].get(key)})")
+
+    rows = compare_metrics(baseline, current, args.threshold / 100)
+    labels = {"regression": "回退", "improvement": "提升", "ok": ""}
+    for name, base_value, value, change, status in rows:
+        unit = current["metrics"][name]["unit"]
+        print(f"{name:<60} {base_value:>10.2f} -> {value:>10.2f} {unit:<9} {change:>+7.1%} {labels[status]}")
+
+    missing = sorted(set(baseline["metrics"]) - set(current["metrics"]))
+    if missing:
+        print(f"本次结果中缺少 {len(missing)} 项指标: {', '.join(missing)}")
+
+    regressions = [row for row in rows if row[4] == "regression"]
+    improvements = [row for row in rows if row[4] == "improvement"]
+    print(f"\n比较 {len(rows)} 项指标: 回退 {len(regressions)} 项, 提升 {len(improvements)} 项 (阈值 {args.threshold:g}%)")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基准测试图片集生成器 - 按固定规则生成图片，同一版本的Pillow每次生成的文件完全相同
+
+用法:
+    python benchmarks/corpus.py benchmarks/corpus --profile quick
+    python benchmarks/corpus.py benchmarks/corpus --profile full
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+# 各档位包含的图片尺寸（宽, 高）
+SIZES = {
+    "1mp": (1200, 800),
+    "12mp": (4000, 3000),
+    "24mp": (6000, 4000),
+    "50mp": (8660, 5774),
+    "100mp": (12248, 8165),
+}
+
+# (格式, 模式, 是否写入EXIF拍摄日期)
+VARIANTS = [
+    ("JPEG", "RGB", True),
+    ("JPEG", "RGB", False),
+    ("JPEG", "L", True),
+    ("JPEG", "CMYK", False),
+    ("PNG", "RGB", False),
+    ("PNG", "RGBA", False),
+    ("PNG", "P", False),
+    ("TIFF", "RGB", True),
+    ("TIFF", "RGBA", False),
+]
+
+# 超大尺寸只生成最常见的几种组合，控制生成时间和磁盘占用
+LARGE_VARIANTS = [
+    ("JPEG", "RGB", True),
+    ("PNG", "RGB", False),
+    ("TIFF", "RGB", True),
+]
+
+PROFILES = {
+    "quick": ["1mp", "12mp"],
+    "standard": ["1mp", "12mp", "24mp"],
+    "full": ["1mp", "12mp", "24mp", "50mp", "100mp"],
+}
+
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "TIFF": ".tif"}
+
+EXIF_DATE = "2024:05:20 10:30:00"
+
+SEED = 20240520
+
+
+def make_image(size, mode, seed):
+    """
+    生成一张带渐变和随机几何图形的图片
+    :param size: (width, height)
+    :param mode: 图像模式
+    :param seed: 随机种子
+    :return: PIL图像
+    """
+    rng = random.Random(seed)
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    radial = Image.radial_gradient('L').resize(size)
+    img = Image.merge('RGB', (gradient, radial, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+    # 随机图形使图片包含边缘和细节，编码耗时更接近真实照片
+    draw = ImageDraw.Draw(img)
+    shapes = max(50, width * height // 40000)
+    for _ in range(shapes):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(8, max(9, width // 10)), rng.randrange(8, max(9, height // 10))
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        if rng.random() < 0.5:
+            draw.rectangle((x, y, x + w, y + h), fill=color)
+        else:
+            draw.ellipse((x, y, x + w, y + h), outline=color, width=rng.randrange(1, 6))
+
+    if mode == 'RGBA':
+        img.putalpha(radial.point(lambda v: 255 - v // 2))
+    elif mode == 'P':
+        img = img.quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+
+def make_exif():
+    """生成只包含拍摄日期的EXIF"""
+    exif = Image.Exif()
+    exif[0x0132] = EXIF_DATE  # DateTime
+    exif.get_ifd(0x8769)[0x9003] = EXIF_DATE  # DateTimeOriginal
+    return exif
+
+
+def corpus_entries(profile):
+    """
+    列出某个档位的所有图片
+    :return: [(文件名, 尺寸名称, 格式, 模式, 是否有EXIF)]
+    """
+    entries = []
+    for size_name in PROFILES[profile]:
+        pixels = SIZES[size_name][0] * SIZES[size_name][1]
+        variants = LARGE_VARIANTS if pixels > 30 * 1000 * 1000 else VARIANTS
+        for image_format, mode, with_exif in variants:
+            exif_tag = "exif" if with_exif else "noexif"
+            filename = f"{size_name}_{image_format.lower()}_{mode.lower()}_{exif_tag}{EXTENSIONS[image_format]}"
+            entries.append((filename, size_name, image_format, mode, with_exif))
+    return entries
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def generate_corpus(output_dir, profile="quick", force=False):
+    """
+    生成图片集和 manifest.json，已存在的文件不会重新生成
+    :param output_dir: 输出目录
+    :param profile: 档位名称，见 PROFILES
+    :param force: 是否重新生成已存在的文件
+    :return: manifest 字典
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = []
+    for index, (filename, size_name, image_format, mode, with_exif) in enumerate(corpus_entries(profile)):
+        path = os.path.join(output_dir, filename)
+        if force or not os.path.exists(path):
+            img = make_image(SIZES[size_name], mode, SEED + index)
+            options = {"format": image_format}
+            if with_exif:
+                options["exif"] = make_exif()
+            if image_format == "JPEG":
+                options["quality"] = 90
+            img.save(path, **options)
+            print(f"生成: {filename}")
+
+        width, height = SIZES[size_name]
+        files.append({
+            "name": filename,
+            "size": size_name,
+            "width": width,
+            "height": height,
+            "format": image_format,
+            "mode": mode,
+            "exif": with_exif,
+            "bytes": os.path.getsize(path),
+            "sha256": hash_file(path)
+        })
+
+    manifest = {
+        "profile": profile,
+        "pillow": Image.__version__,
+        "files": files,
+        # 整个图片集的指纹，比较基准结果时用于确认输入一致
+        "fingerprint": hashlib.sha256("".join(f["sha256"] for f in files).encode()).hexdigest()
+    }
+    with open(os.path.join(output_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PhotoWaterMark 基准测试图片集生成器')
+    parser.add_argument('output_dir', help='输出目录')
+    parser.add_argument('--profile', choices=list(PROFILES), default='quick',
+                        help='图片集档位: quick (1/12MP), standard (到24MP), full (到100MP) (默认值: quick)')
+    parser.add_argument('--force', action='store_true', help='重新生成已存在的文件')
+    args = parser.parse_args()
+
+    manifest = generate_corpus(args.output_dir, args.profile, args.force)
+    total = sum(f["bytes"] for f in manifest["files"])
+    print(f"图片集: {len(manifest['files'])} 个文件, {total / 1024 / 1024:.1f} MB, 指纹 {manifest['fingerprint'][:12]}")
+
+
+if __name__ == "__main__":
+    main()
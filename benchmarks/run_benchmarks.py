@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+基准测试 - 测量单张图片延迟、批量吞吐量、预览刷新延迟、导入缩略图速度、
+各编码配置的编码耗时与输出大小、缩小输出时缩小解码与完整解码的对比，
+以及逐帧写出动画GIF的耗时和各帧颜色是否保持不变，结果写入JSON
+
+用法:
+    python benchmarks/run_benchmarks.py benchmarks/corpus --profile quick --output results.json
+    python benchmarks/compare.py baseline.json results.json
+
+图片集不存在时会先用 corpus.py 生成。每项结果取多次运行的中位数。
+"""
+
+import argparse
+from datetime import datetime
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+from PIL import Image, ImageChops, ImageSequence, ImageStat
+
+from corpus import generate_corpus, PROFILES
+from encoder_profiles import ENCODER_PROFILES, encoder_options, source_info
+from frame_sequence import write_sequence
+from output_variants import variant_size
+from watermark_handler import (WatermarkHandler, build_tiled_pattern, load_font, measure_text, render_text_sprite,
+                               render_tile, resize_image, tiled_position)
+from worker_pool import WatermarkWorkerPool, watermark_file
+
+TEXTS = {
+    "ascii": "2024-05-20",
+    "cjk": "© 2024 摄影 水印测试"
+}
+
+# 与桌面版预览区域默认大小、缩略图大小一致
+PREVIEW_SIZE = (600, 400)
+THUMBNAIL_SIZE = (40, 40)
+
+# 批量吞吐量只使用不超过该像素数的图片
+BATCH_MAX_PIXELS = 12 * 1000 * 1000
+
+# 缩小输出测试的长边像素数
+RESIZE_TARGETS = (2048, 1024, 400)
+
+# 动画GIF测试：每帧使用不同的颜色，后面的帧不能只量化到第一帧的调色板
+GIF_FRAME_COLORS = ((0, 255, 0), (80, 175, 0), (160, 95, 0), (30, 60, 220))
+GIF_FRAME_SIZE = (320, 240)
+
+
+def _median_time(fn, repeat):
+    """运行一次预热后取 repeat 次的中位数（秒）"""
+    fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def _clear_caches():
+    """清空字体和水印精灵图缓存，模拟首次使用"""
+    load_font.cache_clear()
+    measure_text.cache_clear()
+    render_text_sprite.cache_clear()
+    render_tile.cache_clear()
+    build_tiled_pattern.cache_clear()
+
+
+def _psnr(a, b):
+    """两张相同尺寸图像的峰值信噪比（dB），完全相同时返回100"""
+    stat = ImageStat.Stat(ImageChops.difference(a.convert('RGB'), b.convert('RGB')))
+    mse = sum(stat.sum2) / (a.width * a.height * 3)
+    return 100.0 if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def _output_path(tmp_dir, name):
+    return os.path.join(tmp_dir, "out_" + name)
+
+
+class BenchmarkRunner:
+    def __init__(self, corpus_dir, manifest, repeat=3, workers=None):
+        """
+        :param corpus_dir: 图片集目录
+        :param manifest: corpus.generate_corpus 返回的 manifest
+        :param repeat: 每项测量的重复次数
+        :param workers: 批量吞吐量测试的工作进程数
+        """
+        self.corpus_dir = corpus_dir
+        self.manifest = manifest
+        self.repeat = repeat
+        self.workers = workers
+        self.handler = WatermarkHandler()
+        self.metrics = {}
+
+    def record(self, name, value, unit, better="lower"):
+        self.metrics[name] = {"value": value, "unit": unit, "better": better}
+        print(f"  {name:<60} {value:>10.2f} {unit}")
+
+    def path(self, entry):
+        return os.path.join(self.corpus_dir, entry["name"])
+
+    def run_latency(self, tmp_dir):
+        """单张图片延迟：命令行路径（EXIF日期 + process_image）和中文、半透明、旋转水印"""
+        print("单张图片延迟")
+        for entry in self.manifest["files"]:
+            input_path = self.path(entry)
+            output_path = _output_path(tmp_dir, entry["name"])
+
+            seconds = _median_time(lambda: watermark_file(input_path, output_path), self.repeat)
+            self.record(f"latency.cli.{entry['name']}", seconds * 1000, "ms")
+
+            seconds = _median_time(lambda: self.handler.add_text_watermark(
+                input_path, output_path, TEXTS["cjk"], 48, '#ff8000', 60, 30, 'center'), self.repeat)
+            self.record(f"latency.cjk.{entry['name']}", seconds * 1000, "ms")
+
+    def run_batch(self, tmp_dir):
+        """批量吞吐量：顺序处理和工作进程池"""
+        print("批量吞吐量")
+        entries = [f for f in self.manifest["files"] if f["width"] * f["height"] <= BATCH_MAX_PIXELS]
+        items = [(self.path(f), _output_path(tmp_dir, f["name"])) for f in entries]
+
+        def sequential():
+            for input_path, output_path in items:
+                watermark_file(input_path, output_path)
+
+        seconds = _median_time(sequential, self.repeat)
+        self.record("batch.sequential", len(items) / seconds, "images/s", better="higher")
+
+        pool = WatermarkWorkerPool(self.workers)
+        try:
+            def pooled():
+                for item, result in pool.run_batch(watermark_file, items):
+                    if isinstance(result, Exception):
+                        raise result
+
+            seconds = _median_time(pooled, self.repeat)
+            self.record(f"batch.pool_{pool.workers}", len(items) / seconds, "images/s", better="higher")
+        finally:
+            pool.shutdown()
+
+    def show_preview(self, path, font_size, position):
+        """与桌面版 show_image 相同的步骤：打开、添加水印、缩放到预览区域"""
+        image = Image.open(path)
+        scale = min(PREVIEW_SIZE[0] / image.width, PREVIEW_SIZE[1] / image.height, 1.0)
+        watermarked = self.handler.apply_text_watermark(
+            image, TEXTS["cjk"], font_size, '#ffffff', 60, 0, position)
+        return watermarked.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+
+    def run_preview(self):
+        """预览刷新延迟：首次显示（缓存为空）和修改水印设置后的刷新"""
+        print("预览刷新延迟")
+        entries = [f for f in self.manifest["files"] if f["format"] == "JPEG" and f["mode"] == "RGB" and f["exif"]]
+        for entry in entries:
+            path = self.path(entry)
+
+            def first():
+                _clear_caches()
+                self.show_preview(path, 36, 'bottomRight')
+
+            seconds = _median_time(first, self.repeat)
+            self.record(f"preview.first.{entry['name']}", seconds * 1000, "ms")
+
+            positions = iter(['topLeft', 'center', 'bottomRight'] * (self.repeat + 1))
+            seconds = _median_time(lambda: self.show_preview(path, 36, next(positions)), self.repeat)
+            self.record(f"preview.update.{entry['name']}", seconds * 1000, "ms")
+
+            # 平铺水印：首次生成图案，以及平铺参数不变时的刷新（图案来自缓存）
+            def tiled_first():
+                _clear_caches()
+                self.show_preview(path, 36, tiled_position())
+
+            seconds = _median_time(tiled_first, self.repeat)
+            self.record(f"preview.tiled_first.{entry['name']}", seconds * 1000, "ms")
+            seconds = _median_time(lambda: self.show_preview(path, 36, tiled_position()), self.repeat)
+            self.record(f"preview.tiled_update.{entry['name']}", seconds * 1000, "ms")
+
+    def run_import(self):
+        """导入速度：与桌面版 add_images 相同，打开图片并生成缩略图"""
+        print("导入缩略图")
+        paths = [self.path(f) for f in self.manifest["files"]]
+
+        def import_all():
+            for path in paths:
+                image = Image.open(path)
+                image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+
+        seconds = _median_time(import_all, self.repeat)
+        self.record("import.thumbnail", seconds / len(paths) * 1000, "ms")
+
+    def run_encode(self):
+        """编码耗时与输出大小：每种编码配置分别输出 JPEG、PNG、WebP 有损和 WebP 无损"""
+        print("编码耗时与输出大小")
+        entries = [f for f in self.manifest["files"] if f["width"] * f["height"] <= BATCH_MAX_PIXELS]
+        images = []
+        for entry in entries:
+            with Image.open(self.path(entry)) as image:
+                info = source_info(image)
+                watermarked = self.handler.apply_text_watermark_roi(image.convert('RGB'), TEXTS["ascii"], 48)
+            images.append((watermarked.convert('RGB'), info))
+        input_size = sum(f["bytes"] for f in entries)
+
+        targets = (("jpeg", "JPEG", False), ("png", "PNG", False), ("webp", "WEBP", False), ("webp_lossless", "WEBP", True))
+        for profile in ENCODER_PROFILES:
+            for name, image_format, lossless in targets:
+                def encode():
+                    total = 0
+                    for image, info in images:
+                        output = io.BytesIO()
+                        image.save(output, format=image_format,
+                                   **encoder_options(image_format, profile, lossless=lossless, source=info))
+                        total += output.tell()
+                    return total
+
+                seconds = _median_time(encode, self.repeat)
+                total = encode()
+                self.record(f"encode.{profile}.{name}.time", seconds / len(images) * 1000, "ms")
+                self.record(f"encode.{profile}.{name}.size", total / len(images) / 1024, "KB")
+                # 输出与输入文件的大小之比
+                self.record(f"encode.{profile}.{name}.ratio", total / input_size, "x")
+
+    def run_resize(self):
+        """缩小输出：完整解码后LANCZOS缩放，与 draft()/reduce() 缩小解码后再LANCZOS缩放比较耗时、解码像素数和画质"""
+        print("缩小输出")
+        groups = {
+            "jpeg": [f for f in self.manifest["files"] if f["format"] == "JPEG"],
+            "other": [f for f in self.manifest["files"] if f["format"] != "JPEG"]
+        }
+        for max_size in RESIZE_TARGETS:
+            for group, entries in groups.items():
+                if not entries:
+                    continue
+
+                def full():
+                    results = []
+                    for entry in entries:
+                        with Image.open(self.path(entry)) as image:
+                            image.load()
+                            target = variant_size(image.size, max_size)
+                            decoded = image.width * image.height
+                            results.append((image.convert('RGB').resize(target, Image.LANCZOS), decoded))
+                    return results
+
+                def reduced():
+                    results = []
+                    for entry in entries:
+                        with Image.open(self.path(entry)) as image:
+                            target = variant_size(image.size, max_size)
+                            self.handler.decode(image, target)
+                            decoded = image.width * image.height
+                            results.append((resize_image(image, target), decoded))
+                    return results
+
+                full_seconds = _median_time(full, self.repeat)
+                reduced_seconds = _median_time(reduced, self.repeat)
+                reference, candidate = full(), reduced()
+                prefix = f"resize.{max_size}.{group}"
+                self.record(f"{prefix}.full", full_seconds / len(entries) * 1000, "ms")
+                self.record(f"{prefix}.reduced", reduced_seconds / len(entries) * 1000, "ms")
+                self.record(f"{prefix}.decoded_pixels",
+                            sum(pixels for _, pixels in candidate) / sum(pixels for _, pixels in reference) * 100, "%")
+                # 以完整解码后缩放的结果为参照
+                self.record(f"{prefix}.psnr",
+                            statistics.mean(_psnr(a, b) for (a, _), (b, _) in zip(reference, candidate)),
+                            "dB", better="higher")
+
+    def run_frames(self):
+        """逐帧写出动画GIF：各帧为不同颜色的渐变，原样写出后与原帧比较，并测量写出耗时"""
+        print("动画GIF逐帧写出")
+        frames = []
+        for color in GIF_FRAME_COLORS:
+            gradient = Image.linear_gradient('L').resize(GIF_FRAME_SIZE)
+            frames.append(Image.composite(Image.new('RGB', GIF_FRAME_SIZE, color),
+                                          Image.new('RGB', GIF_FRAME_SIZE, (255, 255, 255)), gradient))
+        source = io.BytesIO()
+        frames[0].save(source, format="GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+        def write():
+            output = io.BytesIO()
+            write_sequence(output, Image.open(io.BytesIO(source.getvalue())), lambda frame: frame.convert('RGB'))
+            return output
+
+        seconds = _median_time(write, self.repeat)
+        self.record("frames.gif.time", seconds / len(frames) * 1000, "ms")
+        # 以Pillow写出的同一动画为参照，任何一帧颜色被破坏都会使最小值明显下降
+        with Image.open(source) as expected, Image.open(write()) as actual:
+            psnr = [_psnr(a.convert('RGB'), b.convert('RGB'))
+                    for a, b in zip(ImageSequence.Iterator(expected), ImageSequence.Iterator(actual))]
+        self.record("frames.gif.psnr", min(psnr), "dB", better="higher")
+
+    def run(self, suites):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if "latency" in suites:
+                self.run_latency(tmp_dir)
+            if "batch" in suites:
+                self.run_batch(tmp_dir)
+        if "preview" in suites:
+            self.run_preview()
+        if "import" in suites:
+            self.run_import()
+        if "encode" in suites:
+            self.run_encode()
+        if "resize" in suites:
+            self.run_resize()
+        if "frames" in suites:
+            self.run_frames()
+        return self.metrics
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PhotoWaterMark 基准测试')
+    parser.add_argument('corpus_dir', help='图片集目录，不存在时自动生成')
+    parser.add_argument('--profile', choices=list(PROFILES), default='quick', help='图片集档位 (默认值: quick)')
+    parser.add_argument('--suites', default='latency,batch,preview,import,encode,resize,frames',
+                        help='要运行的测试，逗号分隔 (默认值: latency,batch,preview,import,encode,resize,frames)')
+    parser.add_argument('--repeat', type=int, default=3, help='每项测量的重复次数 (默认值: 3)')
+    parser.add_argument('--workers', type=int, default=None, help='批量测试的工作进程数 (默认值: CPU核心数)')
+    parser.add_argument('--output', default=None, help='结果JSON文件路径 (默认值: 只输出到终端)')
+    args = parser.parse_args()
+
+    manifest = generate_corpus(args.corpus_dir, args.profile)
+    runner = BenchmarkRunner(args.corpus_dir, manifest, args.repeat, args.workers)
+    metrics = runner.run(set(args.suites.split(',')))
+
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "pillow": Image.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "profile": args.profile,
+            "repeat": args.repeat,
+            "corpus": manifest["fingerprint"]
+        },
+        "metrics": metrics
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+压缩包读写 - 直接读取 ZIP/TAR 中的图片并写出 ZIP/TAR，无需解压到磁盘
+
+成员逐个读入内存交给工作进程池处理，输出压缩包由后台线程写入。
+JPEG/PNG/WebP 等本身已压缩的格式在ZIP中以存储方式保存，不再重复deflate。
+"""
+
+from collections import deque
+from datetime import datetime
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+
+from encoder_profiles import OUTPUT_EXTENSIONS, normalize_format
+from image_processor import SUPPORTED_EXTENSIONS, get_supported_images, remove_output
+from isolated_pool import QuarantineReport
+from worker_pool import WatermarkWorkerPool, watermark_data
+
+TAR_MODES = {
+    ".tar": "", ".tar.gz": "gz", ".tgz": "gz",
+    ".tar.bz2": "bz2", ".tbz2": "bz2", ".tar.xz": "xz", ".txz": "xz"
+}
+
+# 已压缩格式，写入ZIP时不再压缩
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+
+def _tar_mode(path):
+    lower = path.lower()
+    for ext, compression in TAR_MODES.items():
+        if lower.endswith(ext):
+            return compression
+    return None
+
+
+def is_archive(path):
+    """判断路径是否为支持的压缩包"""
+    return path.lower().endswith('.zip') or _tar_mode(path) is not None
+
+
+def archive_extension(path):
+    """获取压缩包扩展名（包括 .tar.gz 这样的双扩展名）"""
+    lower = path.lower()
+    for ext in sorted(list(TAR_MODES) + ['.zip'], key=len, reverse=True):
+        if lower.endswith(ext):
+            return path[-len(ext):]
+    return os.path.splitext(path)[1]
+
+
+def _is_image(name):
+    return os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def _date_string(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def iter_images(path):
+    """
+    逐个读取目录或压缩包中的图片
+    :param path: 目录或压缩包路径
+    :return: 生成器，产生 (成员名称, 图片内容, 修改日期)
+    """
+    if os.path.isdir(path):
+        for name in get_supported_images(path):
+            file_path = os.path.join(path, name)
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            yield name, data, _date_string(os.path.getmtime(file_path))
+
+    elif path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not _is_image(info.filename):
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                yield info.filename, zf.read(info), _date_string(mtime)
+
+    else:
+        with tarfile.open(path, mode='r:' + _tar_mode(path)) as tar:
+            for member in tar:
+                if not member.isfile() or not _is_image(member.name):
+                    continue
+                yield member.name, tar.extractfile(member).read(), _date_string(member.mtime)
+
+
+class ImageSink:
+    """
+    输出到目录或压缩包，压缩包由后台线程写入
+    """
+
+    def __init__(self, path, max_pending=16):
+        """
+        :param path: 输出目录或压缩包路径
+        :param max_pending: 等待写入的最大成员数
+        """
+        self.path = path
+        self.archive = None
+        self.error = None
+        self.count = 0
+
+        if is_archive(path):
+            parent = os.path.dirname(os.path.abspath(path))
+            os.makedirs(parent, exist_ok=True)
+            if path.lower().endswith('.zip'):
+                self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            else:
+                self.archive = tarfile.open(path, mode='w:' + _tar_mode(path))
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._write_loop, daemon=True)
+            self.thread.start()
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def _write_member(self, name, data):
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            stored = os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self._write_member(*item)
+                except Exception as e:
+                    self.error = e
+
+    def add(self, name, data):
+        """
+        写入一个成员
+        :param name: 成员名称（目录输出时为文件名）
+        :param data: 文件内容
+        """
+        if self.archive is None:
+            # 防止压缩包成员名称写到输出目录之外
+            normalized = os.path.normpath(name)
+            if os.path.isabs(normalized) or normalized.split(os.sep)[0] == '..':
+                raise ValueError(f"非法的成员路径: {name}")
+            output_path = os.path.join(self.path, normalized)
+            os.makedirs(os.path.dirname(output_path) or self.path, exist_ok=True)
+            remove_output(output_path)
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        else:
+            if self.error is not None:
+                raise self.error
+            self.queue.put((name, data))
+        self.count += 1
+
+    def close(self):
+        """等待后台写入完成并关闭压缩包"""
+        if self.archive is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.archive.close()
+            if self.error is not None:
+                raise self.error
+
+
+def default_output_path(input_path):
+    """默认输出路径：压缩包为 <名称>_watermark.<扩展名>，目录为 <名称>_watermark"""
+    if is_archive(input_path):
+        ext = archive_extension(input_path)
+        return input_path[:-len(ext)] + "_watermark" + ext
+    return os.path.normpath(input_path) + "_watermark"
+
+
+def watermark_to_sink(items, sink, settings, output_format=None, workers=None, memory_budget=None):
+    """
+    用工作进程池处理图片并按输入顺序写入输出
+    :param items: 可迭代对象，产生 (输出成员名称, 图片内容, 备用水印文本)
+    :param sink: ImageSink 实例
+    :param settings: 水印设置字典（见 worker_pool.watermark_data）
+    :param output_format: 输出格式，默认与输入格式相同
+    :param workers: 工作进程数，默认为CPU核心数
+    :param memory_budget: 单张图像的内存预算（字节），None 表示不限制
+    :return: 生成器，产生 (输出成员名称, 异常或None)
+    """
+    pool = WatermarkWorkerPool(workers, settings.get("font_size", 24), memory_budget)
+    window = pool.workers * 2
+    pending = deque()
+
+    def emit(name, future):
+        try:
+            data, image_format = future.result()
+            sink.add(name, data)
+        except Exception as e:
+            return name, e
+        return name, None
+
+    try:
+        for name, data, fallback_text in items:
+            item_settings = dict(settings, filename=os.path.basename(name))
+            if fallback_text:
+                item_settings["fallback_text"] = fallback_text
+            future = pool.submit_sized(pool.estimate(data), watermark_data, data, item_settings, output_format)
+            pending.append((name, future))
+            # 按输入顺序写出，在途成员数量有上限
+            while len(pending) >= window:
+                yield emit(*pending.popleft())
+        while pending:
+            yield emit(*pending.popleft())
+    finally:
+        pool.shutdown()
+
+
+def archive_main(args, output_path):
+    """
+    压缩包模式：输入或输出至少一方为压缩包
+    :param args: parse_arguments 解析得到的参数
+    :param output_path: 输出目录或压缩包路径
+    """
+    settings = {
+        "font_size": args.font_size,
+        "font_color": args.font_color,
+        "position": args.position
+    }
+    if args.layers:
+        settings["layers"] = args.layers
+    if args.text:
+        settings["watermark_text"] = args.text
+
+    sink = ImageSink(output_path)
+    quarantine = QuarantineReport()
+    processed = 0
+    total = 0
+
+    print(f"输入: {args.input_directory}")
+    print(f"输出: {output_path}")
+    try:
+        memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+        output_format = normalize_format(args.format)
+        items = iter_images(args.input_directory)
+        if output_format:
+            items = ((os.path.splitext(name)[0] + OUTPUT_EXTENSIONS[output_format], data, date)
+                     for name, data, date in items)
+        results = watermark_to_sink(items, sink, settings, output_format,
+                                    workers=args.workers, memory_budget=memory_budget)
+        for name, error in results:
+            total += 1
+            if error is None:
+                processed += 1
+                print(f"成功处理: {name}")
+            else:
+                quarantine.add(name, error)
+                print(f"处理失败: {name} ({error})")
+    finally:
+        sink.close()
+
+    print(f"\n处理完成! 成功处理 {processed}/{total} 个图像文件")
+    print(f"输出: {output_path}")
+    report_path = args.quarantine_report or os.path.normpath(output_path) + ".quarantine.json"
+    if quarantine.write(report_path):
+        print(f"{len(quarantine)} 个图像被隔离（超时、崩溃或内存超限），详见: {report_path}")
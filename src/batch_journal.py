@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+批处理日志 - 记录已完成的图片，使中断的批量任务可以断点续传
+
+日志为追加写入的 JSON Lines 文件：第一行是任务描述（水印设置、导出选项等），
+之后每行记录一张已完成的图片。进程崩溃时最多丢失最后一行，读取时会被忽略。
+所有图片都处理成功后删除日志，输出目录中只在任务中断或有失败的图片时留下日志。
+"""
+
+import json
+import os
+
+JOURNAL_NAME = ".photowatermark_journal.jsonl"
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _canonical(obj):
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False)
+
+
+class BatchJournal:
+    def __init__(self, journal_path, sync_every=64):
+        """
+        :param journal_path: 日志文件路径
+        :param sync_every: 每写入多少条记录执行一次fsync（写入本身每条都会flush）
+        """
+        self.journal_path = journal_path
+        self.sync_every = sync_every
+        self.job = None
+        # 输出路径 -> 完成记录（一张输入图片可以有多个输出规格）
+        self.completed = {}
+        self.file = None
+        self.unsynced = 0
+
+    def load(self):
+        """
+        读取已有日志
+        :return: 日志中保存的任务描述，不存在时返回None
+        """
+        self.job = None
+        self.completed = {}
+        if not os.path.exists(self.journal_path):
+            return None
+
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时未写完的最后一行
+                    continue
+                if "job" in record:
+                    self.job = record["job"]
+                elif "input" in record:
+                    self.completed[record["output"]] = record
+        return self.job
+
+    def start(self, job, resume=False):
+        """
+        开始记录一个批量任务
+        :param job: 任务描述字典，续传时必须与日志中的任务一致
+        :param resume: 是否在已有日志的基础上续传
+        :return: 可跳过的已完成图片数量
+        """
+        if resume:
+            stored_job = self.load()
+            if stored_job is None:
+                resume = False
+            elif _canonical(stored_job) != _canonical(job):
+                print("警告: 水印设置与上次任务不同，将重新处理所有图片")
+                resume = False
+
+        if not resume:
+            self.completed = {}
+
+        self.job = job
+        torn = resume and self._has_torn_tail()
+        self.file = open(self.journal_path, 'a' if resume else 'w', encoding='utf-8')
+        if torn:
+            # 上次崩溃时留下了未写完的行，先换行避免与新记录拼接
+            self.file.write("\n")
+        if not resume:
+            self.file.write(_canonical({"job": job}) + "\n")
+            self.file.flush()
+        return len(self.completed)
+
+    def _has_torn_tail(self):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def is_done(self, input_path, output_path):
+        """
+        检查图片是否已完成且输出文件仍然有效
+        :param input_path: 输入图像路径
+        :param output_path: 输出图像路径
+        :return: 是否可以跳过
+        """
+        record = self.completed.get(output_path)
+        if record is None or record["input"] != input_path:
+            return False
+        try:
+            if list(_file_signature(input_path)) != record["input_signature"]:
+                return False
+            return os.path.getsize(output_path) == record["output_size"]
+        except OSError:
+            return False
+
+    def record(self, input_path, output_path):
+        """
+        记录一张已完成的图片
+        :param input_path: 输入图像路径
+        :param output_path: 输出图像路径
+        """
+        record = {
+            "input": input_path,
+            "input_signature": list(_file_signature(input_path)),
+            "output": output_path,
+            "output_size": os.path.getsize(output_path)
+        }
+        self.completed[output_path] = record
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        """关闭日志文件"""
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def finish(self):
+        """任务全部完成：关闭并删除日志，不需要再续传"""
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
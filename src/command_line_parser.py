@@ -1,19 +1,24 @@
 import argparse
+import json
 import sys
 import os
 
-def parse_arguments():
+from archive_io import is_archive
+from encoder_profiles import DEFAULT_PROFILE, ENCODER_PROFILES, normalize_format, parse_quality
+from output_variants import check_output_names, parse_variant
+from watermark_handler import TILE_DEFAULTS, parse_layers, tiled_position
+
+def add_watermark_arguments(parser):
     """
-    解析命令行参数
-    :return: 解析后的参数对象
+    添加各模式通用的水印样式参数
+    :param parser: 参数解析器
     """
-    parser = argparse.ArgumentParser(
-        description='PhotoWaterMark - 根据图像EXIF元数据向图片添加文本水印'
-    )
-
     parser.add_argument(
-        'input_directory',
-        help='包含图像文件的目录路径'
+        '--text',
+        default=None,
+        metavar='TEMPLATE',
+        help='水印文本，可包含每张图片分别替换的模板字段 {date}（拍摄日期，没有EXIF时使用文件修改日期）、'
+             '{filename}（文件名）和 {camera}（相机型号），例如 "{date} {camera}" (默认值: {date})'
     )
 
     parser.add_argument(
@@ -31,20 +36,517 @@ def parse_arguments():
 
     parser.add_argument(
         '--position',
-        choices=['topLeft', 'center', 'bottomRight'],
+        choices=['topLeft', 'center', 'bottomRight', 'tiled'],
         default='bottomRight',
-        help='水印位置: topLeft, center, bottomRight (默认值: bottomRight)'
+        help='水印位置: topLeft, center, bottomRight，tiled 表示在整幅图像上重复平铺 (默认值: bottomRight)'
+    )
+
+    parser.add_argument(
+        '--tile-spacing',
+        type=int,
+        default=TILE_DEFAULTS["spacing"],
+        help=f'平铺时相邻文字之间的间距，单位像素 (默认值: {TILE_DEFAULTS["spacing"]})'
+    )
+
+    parser.add_argument(
+        '--tile-angle',
+        type=float,
+        default=TILE_DEFAULTS["angle"],
+        help=f'平铺时文字的旋转角度 (默认值: {TILE_DEFAULTS["angle"]})'
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--no-tile-stagger',
+        action='store_true',
+        help='平铺时各行对齐排列，默认下一行右移半格错位排列'
+    )
+
+    parser.add_argument(
+        '--layers',
+        type=_layers_type,
+        default=None,
+        metavar='FILE',
+        help='附加图层的JSON文件，内容为 text、logo、tiled 图层的列表，按顺序叠加在日期水印之上，'
+             '所有图层在一次合成中完成'
+    )
+
+def _layers_type(value):
+    try:
+        with open(value, encoding='utf-8') as f:
+            return parse_layers(json.load(f))
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(f"无法读取图层文件 {value}: {e}")
+
+def resolve_watermark_position(parser, args):
+    """
+    --position tiled 时把位置替换为平铺参数字典（见 watermark_handler.tiled_position）
+    :param parser: 参数解析器，用于报告错误
+    :param args: 解析后的参数对象
+    :return: args
+    """
+    if args.position == 'tiled':
+        try:
+            args.position = tiled_position(args.tile_spacing, args.tile_angle, not args.no_tile_stagger)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+def add_engine_arguments(parser):
+    """
+    添加各模式通用的处理引擎参数
+    :param parser: 参数解析器
+    """
+    parser.add_argument(
+        '--memory-budget',
+        type=int,
+        default=None,
+        help='单张图像的内存预算，单位MB；预计超出的图像会被跳过而不是耗尽内存 (默认值: 不限制)'
+    )
 
-    # 验证输入目录是否存在
-    if not os.path.exists(args.input_directory):
-        print(f"错误: 目录 '{args.input_directory}' 不存在")
+    parser.add_argument(
+        '--task-timeout',
+        type=float,
+        default=300,
+        help='工作进程处理单张图片的超时秒数，超时的图片被隔离，0 表示不限制 (默认值: 300)'
+    )
+
+    parser.add_argument(
+        '--max-tasks-per-worker',
+        type=int,
+        default=1000,
+        help='工作进程处理多少张图片后换成新进程，0 表示不重启 (默认值: 1000)'
+    )
+
+    parser.add_argument(
+        '--max-worker-rss',
+        type=int,
+        default=0,
+        help='工作进程RSS上限，单位MB；处理中超出时隔离该图片，处理后超出时重启进程，0 表示不限制 (默认值: 0)'
+    )
+
+    parser.add_argument(
+        '--quarantine-report',
+        default=None,
+        help='超时、崩溃或内存失控而被隔离的图片写入该JSON报告 '
+             '(默认值: 目录和 watch 模式为输出目录下的 quarantine.json，压缩包模式为 <输出>.quarantine.json，stream 和 serve 模式不写)'
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        default=None,
+        help='工作进程池中同时处理的图片估算内存合计上限，单位MB，0 表示不限制 '
+             '(默认值: 容器 cgroup 内存上限或物理内存的75%%)'
+    )
+
+    parser.add_argument(
+        '--memory-model',
+        default=None,
+        help='--profile-memory 生成的 memory_model.json，用于估算每张图片的内存 (默认值: 按图像尺寸和模式估算)'
+    )
+
+def _quality_type(value):
+    try:
+        return parse_quality(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"质量必须是1到100之间的整数或 keep: {value}")
+
+def _variant_type(value):
+    try:
+        return value, parse_variant(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def add_encoder_arguments(parser):
+    """
+    添加各模式通用的编码参数
+    :param parser: 参数解析器
+    """
+    parser.add_argument(
+        '--encoder-profile',
+        choices=list(ENCODER_PROFILES),
+        default=DEFAULT_PROFILE,
+        help='编码配置: compat 与以前的版本相同的Pillow默认参数 (JPEG质量75, PNG压缩级别6), fast 编码最快, '
+             'balanced JPEG沿用原图质量且PNG快速压缩, smallest 文件最小 '
+             f'(默认值: {DEFAULT_PROFILE})'
+    )
+
+    parser.add_argument(
+        '--quality',
+        type=_quality_type,
+        default=None,
+        help='JPEG/WebP质量 1-100，keep 表示沿用JPEG原图的量化表 (默认值: 由编码配置决定)'
+    )
+
+    parser.add_argument(
+        '--lossless',
+        action='store_true',
+        help='WebP输出使用无损压缩'
+    )
+
+def _scale_type(value):
+    try:
+        scale = float(value[:-1]) / 100 if value.endswith('%') else float(value)
+    except ValueError:
+        scale = 0
+    if not 0 < scale <= 1:
+        raise argparse.ArgumentTypeError(f"缩放比例必须在0到1之间，或写作百分比: {value}")
+    return scale
+
+def add_output_size_arguments(parser):
+    """
+    添加各模式通用的输出尺寸参数
+    :param parser: 参数解析器
+    """
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        default=None,
+        help='输出图像长边的最大像素数，只缩小不放大；JPEG按不小于目标的DCT比例解码，不解码完整分辨率 (默认值: 原尺寸)'
+    )
+
+    parser.add_argument(
+        '--scale',
+        type=_scale_type,
+        default=None,
+        help='输出缩放比例，例如 0.5 或 50%%；与 --max-size 同时指定时取较小的结果 (默认值: 1)'
+    )
+
+def add_metrics_arguments(parser):
+    """
+    添加各模式通用的运行指标参数
+    :param parser: 参数解析器
+    """
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=None,
+        help='在 127.0.0.1 的该端口以Prometheus文本格式提供 /metrics (默认值: 不启用)'
+    )
+
+    parser.add_argument(
+        '--metrics-file',
+        default=None,
+        help='定期将运行指标的JSON快照写入该文件 (默认值: 不启用)'
+    )
+
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=10.0,
+        help='写入JSON快照的间隔秒数 (默认值: 10)'
+    )
+
+def parse_arguments(argv=None):
+    """
+    解析命令行参数
+    :param argv: 参数列表，默认为 sys.argv[1:]
+    :return: 解析后的参数对象
+    """
+    parser = argparse.ArgumentParser(
+        description='PhotoWaterMark - 根据图像EXIF元数据向图片添加文本水印'
+    )
+
+    parser.add_argument(
+        'input_directory',
+        help='包含图像文件的目录路径，或 .zip/.tar/.tar.gz 压缩包'
+    )
+
+    add_watermark_arguments(parser)
+    add_engine_arguments(parser)
+    add_encoder_arguments(parser)
+    add_output_size_arguments(parser)
+    add_metrics_arguments(parser)
+
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='输出目录或 .zip/.tar/.tar.gz 压缩包 (默认值: <输入名称>_watermark)'
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=['JPEG', 'PNG', 'WEBP', 'jpeg', 'png', 'jpg', 'webp'],
+        default=None,
+        help='输出格式，输出文件的扩展名随之改变 (默认值: 与输入相同)'
+    )
+
+    parser.add_argument(
+        '--variant',
+        action='append',
+        type=_variant_type,
+        default=None,
+        metavar='SIZE:FORMAT:PROFILE:SUFFIX',
+        help='输出规格，可重复指定，每张图片只解码一次并生成所有规格，例如 '
+             '--variant full --variant 2048:webp::_web --variant 400:jpeg:fast:_thumb；'
+             '省略的格式和编码配置使用 --format 和 --encoder-profile (默认值: 只输出原尺寸)'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='工作进程数，指定 --profile 或 --profile-memory 时在主进程中处理 (默认值: CPU核心数)'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help='输出缓存目录，启用后相同输入和设置的图片将直接复用上次的结果；不支持压缩包输入或输出'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1024,
+        help='输出缓存大小上限，单位MB (默认值: 1024)'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='从上次中断的位置继续处理，跳过已完成并校验通过的图片；不支持压缩包输入或输出'
+    )
+
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='记录各处理阶段的耗时，结束时输出汇总表并写入 profile.json / profile.csv'
+    )
+
+    parser.add_argument(
+        '--profile-top',
+        type=int,
+        default=0,
+        help='配合 --profile 为最慢的N张图片保存 cProfile 数据 (默认值: 0)'
+    )
+
+    parser.add_argument(
+        '--profile-memory',
+        action='store_true',
+        help='在 --profile 的基础上记录各阶段和每张图片的峰值、残留内存，并写入内存模型 memory_model.json'
+    )
+
+    parser.add_argument(
+        '--profile-dir',
+        default=None,
+        help='性能分析报告的输出目录 (默认值: 输出目录)'
+    )
+
+    args = resolve_watermark_position(parser, parser.parse_args(argv))
+
+    if args.variant:
+        try:
+            check_output_names(args.variant, normalize_format(args.format))
+        except ValueError as e:
+            parser.error(str(e))
+
+    # 验证输入目录或压缩包是否存在
+    if is_archive(args.input_directory) and os.path.isfile(args.input_directory):
+        return args
+    validate_directory(args.input_directory)
+
+    return args
+
+def validate_directory(directory):
+    """验证目录存在，否则退出"""
+    if not os.path.exists(directory):
+        print(f"错误: 目录 '{directory}' 不存在")
         sys.exit(1)
 
-    if not os.path.isdir(args.input_directory):
-        print(f"错误: '{args.input_directory}' 不是一个有效的目录")
+    if not os.path.isdir(directory):
+        print(f"错误: '{directory}' 不是一个有效的目录")
         sys.exit(1)
 
-    return args
\ No newline at end of file
+def parse_watch_arguments(argv=None):
+    """
+    解析监视模式 (photowatermark watch <dir>) 的命令行参数
+    :param argv: watch 之后的参数列表
+    :return: 解析后的参数对象
+    """
+    parser = argparse.ArgumentParser(
+        prog='photowatermark watch',
+        description='PhotoWaterMark 监视模式 - 监视目录并为新写入的图片添加日期水印'
+    )
+
+    parser.add_argument(
+        'directory',
+        help='要监视的目录路径'
+    )
+
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='输出目录 (默认值: <目录名>_watermark)'
+    )
+
+    add_watermark_arguments(parser)
+    add_engine_arguments(parser)
+    add_encoder_arguments(parser)
+    add_output_size_arguments(parser)
+    add_metrics_arguments(parser)
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='工作进程数 (默认值: CPU核心数)'
+    )
+
+    parser.add_argument(
+        '--settle-time',
+        type=float,
+        default=2.0,
+        help='文件多少秒内不再变化视为写入完成 (默认值: 2.0)'
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=16,
+        help='每批最多提交的图片数量 (默认值: 16)'
+    )
+
+    parser.add_argument(
+        '--batch-delay',
+        type=float,
+        default=0.5,
+        help='凑批最多等待的秒数 (默认值: 0.5)'
+    )
+
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=1.0,
+        help='不支持inotify时的轮询间隔秒数 (默认值: 1.0)'
+    )
+
+    parser.add_argument(
+        '--rescan-interval',
+        type=float,
+        default=60.0,
+        help='使用inotify时完整扫描目录的间隔秒数，补上丢失的事件，0 表示只在事件队列溢出时扫描 (默认值: 60.0)'
+    )
+
+    args = resolve_watermark_position(parser, parser.parse_args(argv))
+    validate_directory(args.directory)
+    return args
+def parse_serve_arguments(argv=None):
+    """
+    解析服务模式 (photowatermark serve) 的命令行参数
+    :param argv: serve 之后的参数列表
+    :return: 解析后的参数对象
+    """
+    parser = argparse.ArgumentParser(
+        prog='photowatermark serve',
+        description='PhotoWaterMark 服务模式 - 在本机提供HTTP水印接口'
+    )
+
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='监听地址 (默认值: 127.0.0.1)'
+    )
+
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8765,
+        help='监听端口 (默认值: 8765)'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='工作进程数 (默认值: CPU核心数)'
+    )
+
+    parser.add_argument(
+        '--max-concurrency',
+        type=int,
+        default=None,
+        help='同时处理的请求数上限 (默认值: 工作进程数的2倍)'
+    )
+
+    parser.add_argument(
+        '--max-queue',
+        type=int,
+        default=64,
+        help='等待处理的请求数上限，超出时返回503 (默认值: 64)'
+    )
+
+    parser.add_argument(
+        '--max-body-size',
+        type=int,
+        default=256,
+        help='请求体大小上限，单位MB (默认值: 256)'
+    )
+
+    parser.add_argument(
+        '--font-size',
+        type=int,
+        default=24,
+        help='工作进程预加载的字体大小 (默认值: 24)'
+    )
+
+    add_engine_arguments(parser)
+    add_encoder_arguments(parser)
+    add_output_size_arguments(parser)
+    add_metrics_arguments(parser)
+
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='输出每个请求的访问日志'
+    )
+
+    # 服务模式的水印位置（包括 tiled）由每个请求的查询字符串指定
+    return parser.parse_args(argv)
+
+def parse_stream_arguments(argv=None):
+    """
+    解析流式模式 (photowatermark stream) 的命令行参数
+    :param argv: stream 之后的参数列表
+    :return: 解析后的参数对象
+    """
+    parser = argparse.ArgumentParser(
+        prog='photowatermark stream',
+        description='PhotoWaterMark 流式模式 - 从标准输入读取图片，添加水印后写到标准输出'
+    )
+
+    parser.add_argument(
+        '--framing',
+        choices=['tar', 'length'],
+        default='tar',
+        help='分帧方式: tar 为tar流, length 为4字节大端序长度前缀 (默认值: tar)'
+    )
+
+    add_watermark_arguments(parser)
+    add_engine_arguments(parser)
+    add_encoder_arguments(parser)
+    add_output_size_arguments(parser)
+    add_metrics_arguments(parser)
+
+    parser.add_argument(
+        '--format',
+        choices=['JPEG', 'PNG', 'WEBP', 'jpeg', 'png', 'jpg', 'webp'],
+        default=None,
+        help='输出格式 (默认值: 与输入相同)'
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='工作进程数 (默认值: CPU核心数)'
+    )
+
+    parser.add_argument(
+        '--window',
+        type=int,
+        default=None,
+        help='同时在途的图片数量上限 (默认值: 工作进程数的2倍)'
+    )
+
+    return resolve_watermark_position(parser, parser.parse_args(argv))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+合成后端 - 将水印精灵图合成到图像中，只处理精灵图覆盖的区域
+
+    pillow  使用 Image.alpha_composite，RGB图像需先把区域转换为RGBA
+    numpy   使用NumPy向量化计算，直接在RGB/RGBA区域上混合（需要安装numpy）
+
+两个后端的结果逐像素相同：numpy后端使用与Pillow相同的整数运算和舍入方式。
+Pillow图像不提供可写的内存视图，numpy后端需要把脏区域复制出再写回，在各种情况下都比pillow后端慢，
+只作为校验pillow后端结果的参照实现（见 compositing_bench.py），命令行和桌面版不提供选择。
+
+composite_layers 按顺序合成多个图层的精灵图，用于文字、Logo、平铺等图层叠加时一次完成混合。
+"""
+
+from PIL import Image
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+def clip_region(image_size, sprite_size, dest):
+    """
+    计算精灵图与图像重叠的区域
+    :param image_size: 图像尺寸 (width, height)
+    :param sprite_size: 精灵图尺寸 (width, height)
+    :param dest: 精灵图左上角在图像中的位置
+    :return: (图像中的区域, 精灵图中的区域)，没有重叠时返回None
+    """
+    x, y = dest
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + sprite_size[0], image_size[0]), min(y + sprite_size[1], image_size[1])
+    if right <= left or bottom <= top:
+        return None
+    return (left, top, right, bottom), (left - x, top - y, right - x, bottom - y)
+
+
+def union_box(boxes):
+    """
+    多个区域的外接矩形
+    :param boxes: [(left, top, right, bottom), ...]，不能为空
+    :return: (left, top, right, bottom)
+    """
+    lefts, tops, rights, bottoms = zip(*boxes)
+    return min(lefts), min(tops), max(rights), max(bottoms)
+
+
+def dirty_regions(boxes):
+    """
+    把互相重叠的区域合并为互不重叠的脏区域
+    :param boxes: [(left, top, right, bottom), ...]
+    :return: [(外接矩形, [区域序号, ...]), ...]，每组内的序号保持原来的先后顺序
+    """
+    groups = []
+    for i, box in enumerate(boxes):
+        members = [i]
+        # 合并后的区域变大，可能与之前不重叠的组重叠，直到没有可合并的组为止
+        merged = True
+        while merged:
+            merged = False
+            for group in groups:
+                other, other_members = group
+                if other[0] < box[2] and box[0] < other[2] and other[1] < box[3] and box[1] < other[3]:
+                    groups.remove(group)
+                    box = union_box([box, other])
+                    members = sorted(members + other_members)
+                    merged = True
+                    break
+        groups.append((box, members))
+    return groups
+
+
+class PillowCompositor:
+    name = "pillow"
+
+    def composite(self, img, sprite, dest):
+        """
+        将RGBA精灵图合成到RGB或RGBA图像中（原地修改），超出图像的部分被裁剪
+        :param img: RGB或RGBA图像
+        :param sprite: RGBA精灵图
+        :param dest: 精灵图左上角在图像中的位置
+        """
+        region = clip_region(img.size, sprite.size, dest)
+        if region is None:
+            return
+        box, source = region
+
+        if img.mode == 'RGBA':
+            img.alpha_composite(sprite, dest=box[:2], source=source)
+            return
+
+        roi = img.crop(box).convert('RGBA')
+        roi.alpha_composite(sprite, source=source)
+        img.paste(roi.convert('RGB'), box)
+
+    def composite_layers(self, img, placements):
+        """
+        按顺序将多个RGBA精灵图合成到RGB或RGBA图像中（原地修改）
+
+        RGB图像以精灵图自身为蒙版直接粘贴，结果与 alpha_composite 逐像素相同，
+        各图层都不需要RGBA转换和区域副本，整幅的平铺图案也不需要。
+
+        :param img: RGB或RGBA图像
+        :param placements: [(精灵图, 左上角位置), ...]，从下到上
+        """
+        for sprite, dest in placements:
+            region = clip_region(img.size, sprite.size, dest)
+            if region is None:
+                continue
+            box, source = region
+            if img.mode == 'RGBA':
+                img.alpha_composite(sprite, dest=box[:2], source=source)
+                continue
+            if source != (0, 0) + sprite.size:
+                sprite = sprite.crop(source)
+            img.paste(sprite, box, sprite)
+
+
+class NumpyCompositor:
+    name = "numpy"
+
+    # 与Pillow AlphaComposite.c 相同的定点精度
+    PRECISION_BITS = 7
+
+    def composite(self, img, sprite, dest):
+        """
+        将RGBA精灵图合成到RGB或RGBA图像中（原地修改），超出图像的部分被裁剪
+        :param img: RGB或RGBA图像
+        :param sprite: RGBA精灵图
+        :param dest: 精灵图左上角在图像中的位置
+        """
+        self.composite_layers(img, [(sprite, dest)])
+
+    def composite_layers(self, img, placements):
+        """
+        按顺序将多个RGBA精灵图合成到RGB或RGBA图像中（原地修改）
+
+        互相重叠的图层合并为一个脏区域，每个脏区域只复制出、写回各一次，其中的图层在同一个数组上依次混合。
+        覆盖整幅图像的平铺图案由Pillow直接混合，不复制整幅图像。
+
+        :param img: RGB或RGBA图像
+        :param placements: [(精灵图, 左上角位置), ...]，从下到上
+        """
+        run = []
+        for sprite, dest in placements:
+            if sprite.size == img.size and tuple(dest) == (0, 0):
+                # 先写回下面的图层，保持叠加顺序
+                self._composite_run(img, run)
+                run = []
+                PillowCompositor().composite_layers(img, [(sprite, dest)])
+            else:
+                run.append((sprite, dest))
+        self._composite_run(img, run)
+
+    def _composite_run(self, img, placements):
+        """在各脏区域上一次完成其中所有图层的混合"""
+        regions = [(sprite, clip_region(img.size, sprite.size, dest)) for sprite, dest in placements]
+        regions = [(sprite, region) for sprite, region in regions if region is not None]
+        for union, members in dirty_regions([box for _, (box, _) in regions]):
+            self._composite_region(img, union, [regions[i] for i in members])
+
+    def _composite_region(self, img, union, regions):
+        """
+        :param union: 脏区域 (left, top, right, bottom)
+        :param regions: [(精灵图, clip_region 的返回值), ...]，都在脏区域内
+        """
+        left, top, right, bottom = union
+        # Pillow图像不提供可写的内存视图，只复制脏区域
+        dst = np.array(img.crop((left, top, right, bottom)))
+        for sprite, (box, source) in regions:
+            src = np.asarray(sprite.crop(source))
+            view = dst[box[1] - top:box[3] - top, box[0] - left:box[2] - left]
+            if img.mode == 'RGB' or view[..., 3].min() == 255:
+                self.blend_opaque(view[..., :3], src)
+            else:
+                # 目标带透明度时，只计算精灵图不透明度大于0的像素
+                mask = src[..., 3] != 0
+                view[mask] = self.blend(view[mask].astype(np.uint32), src[mask].astype(np.uint32))
+        img.paste(Image.fromarray(dst, img.mode), (left, top))
+
+    def blend_opaque(self, dst_rgb, src):
+        """
+        目标不透明时的混合（原地修改）
+
+        此时 Pillow 的 coef1 = src_a << PRECISION_BITS，结果只取决于
+        v = src * src_a + dst * (255 - src_a)，v 不超过 65025，
+        Pillow 的舍入化简后为 w = v + 128, (w + (w >> 8)) >> 8，全程不超出uint16；src_a 为0时结果即为 dst。
+        逐通道在连续的uint16数组上原地计算，不做跨步运算和查表。
+
+        :param dst_rgb: (h, w, 3) uint8 数组视图
+        :param src: (h, w, 4) uint8 精灵图数组
+        """
+        shape = src.shape[:2]
+        src_a = np.empty(shape, np.uint16)
+        src_a[...] = src[..., 3]
+        dst_a = 255 - src_a
+        v = np.empty(shape, np.uint16)
+        tmp = np.empty(shape, np.uint16)
+        for channel in range(3):
+            v[...] = src[..., channel]
+            v *= src_a
+            tmp[...] = dst_rgb[..., channel]
+            tmp *= dst_a
+            v += tmp
+            v += 128
+            np.right_shift(v, 8, out=tmp)
+            v += tmp
+            v >>= 8
+            dst_rgb[..., channel] = v
+
+    def blend(self, dst, src):
+        """
+        向量化的 alpha_composite，与Pillow的整数运算结果相同
+        :param dst: (n, 4) uint32 像素数组
+        :param src: (n, 4) uint32 像素数组，不透明度均大于0
+        :return: (n, 4) uint8 数组
+        """
+        shift = self.PRECISION_BITS
+        src_a = src[:, 3:4]
+        out_a255 = src_a * 255 + dst[:, 3:4] * (255 - src_a)
+        coef1 = (src_a * (255 * 255 << shift)) // out_a255
+        coef2 = (255 << shift) - coef1
+
+        out = np.empty(dst.shape, dtype=np.uint8)
+        tmp = src[:, :3] * coef1 + dst[:, :3] * coef2
+        out[:, :3] = self._div255(tmp + (0x80 << shift)) >> shift
+        out[:, 3:4] = self._div255(out_a255 + 0x80)
+        return out
+
+    @staticmethod
+    def _div255(value):
+        return ((value >> 8) + value) >> 8
+
+
+BACKENDS = {"pillow": PillowCompositor}
+if NUMPY_AVAILABLE:
+    BACKENDS["numpy"] = NumpyCompositor
+
+_current = PillowCompositor()
+
+
+def available_backends():
+    """当前环境可用的合成后端名称"""
+    return list(BACKENDS)
+
+
+def set_backend(name):
+    """
+    选择合成后端
+    :param name: 后端名称，见 available_backends()
+    """
+    global _current
+    if name not in BACKENDS:
+        if name == "numpy":
+            raise ValueError("numpy合成后端需要安装numpy: pip install numpy")
+        raise ValueError(f"未知的合成后端: {name}")
+    _current = BACKENDS[name]()
+
+
+def get_backend():
+    """当前使用的合成后端"""
+    return _current
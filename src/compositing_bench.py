@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+合成后端基准测试 - 比较各合成后端在不同水印尺寸和图像模式下的耗时，并校验结果逐像素相同
+
+用法:
+    python src/compositing_bench.py --repeat 50
+"""
+
+import argparse
+import time
+
+from PIL import Image, ImageChops
+
+from compositing import BACKENDS
+from watermark_handler import render_text_sprite
+
+# (说明, 水印文本, 字体大小)
+SPRITE_CASES = [
+    ("小号日期", "2024-01-01", 24),
+    ("中号中英文", "© 2024 摄影 PhotoWaterMark", 64),
+    ("大号横幅", "PhotoWaterMark 版权所有", 240),
+]
+
+
+def make_target(mode, size=(4000, 3000)):
+    """生成基准测试用的渐变图像"""
+    gradient = Image.linear_gradient('L').resize(size)
+    bands = [gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), gradient]
+    if mode == 'RGBA':
+        bands.append(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+    return Image.merge(mode, bands)
+
+
+def time_backend(backend, target, sprite, repeat):
+    """
+    :return: (每次合成的平均耗时秒数, 合成结果)
+    """
+    dest = (target.width - sprite.width - 10, target.height - sprite.height - 10)
+    img = target.copy()
+    backend.composite(img, sprite, dest)
+    result = img.copy()
+
+    # 重复合成到同一张图像上，耗时只与水印区域大小有关
+    started = time.perf_counter()
+    for _ in range(repeat):
+        backend.composite(img, sprite, dest)
+    return (time.perf_counter() - started) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PhotoWaterMark 合成后端基准测试')
+    parser.add_argument('--repeat', type=int, default=50, help='每种情况重复次数 (默认值: 50)')
+    parser.add_argument('--transparency', type=int, default=60, help='水印不透明度 0-100 (默认值: 60)')
+    args = parser.parse_args()
+
+    alpha = int(255 * args.transparency / 100)
+    print(f"后端: {', '.join(BACKENDS)}")
+    print(f"{'水印':<10} {'精灵图':>10} {'模式':>5} " + " ".join(f"{name:>10}" for name in BACKENDS) + "  结果一致")
+
+    for mode in ('RGB', 'RGBA'):
+        target = make_target(mode)
+        for label, text, font_size in SPRITE_CASES:
+            sprite = render_text_sprite(text, font_size, (255, 255, 255), alpha, 0)
+            timings = []
+            results = []
+            for backend_class in BACKENDS.values():
+                seconds, result = time_backend(backend_class(), target, sprite, args.repeat)
+                timings.append(seconds)
+                results.append(result)
+            identical = all(ImageChops.difference(results[0], other).getbbox() is None for other in results[1:])
+            size = f"{sprite.width}x{sprite.height}"
+            print(f"{label:<10} {size:>10} {mode:>5} "
+                  + " ".join(f"{seconds * 1000:>8.3f}ms" for seconds in timings)
+                  + f"  {'是' if identical else '否'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -95,4 +95,13 @@ class ConfigManager:
 
     def get_last_template(self):
         """获取上次使用的模板"""
-        return self.config["last_template"]
\ No newline at end of file
+        return self.config["last_template"]
+
+    def get_setting(self, key, default=None):
+        """获取通用设置项"""
+        return self.config.get(key, default)
+
+    def set_setting(self, key, value):
+        """保存通用设置项"""
+        self.config[key] = value
+        self.save_config()
\ No newline at end of file
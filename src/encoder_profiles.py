@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+编码配置 - 按名称选择输出图片的编码参数
+
+    compat    默认：与Pillow默认编码参数相同（JPEG质量75，PNG压缩级别6，WebP质量80），输出与以前的版本一致
+    fast      编码最快：JPEG不做霍夫曼优化，PNG压缩级别1，WebP method 0
+    balanced  JPEG来源保持原图的量化表和色度抽样（quality='keep'），输出大小接近原图；
+              其他来源JPEG质量85并做霍夫曼优化，PNG压缩级别3，WebP method 4
+    smallest  文件最小：JPEG渐进式、质量80，PNG压缩级别9并优化，WebP method 6
+
+quality 可以覆盖配置中的JPEG/WebP质量，'keep' 表示沿用JPEG原图的量化表（其他来源使用配置中的质量）。
+lossless 为True时WebP使用无损压缩。
+"""
+
+from PIL import JpegImagePlugin
+
+ENCODER_PROFILES = {
+    "compat": {
+        "JPEG": {"quality": 75, "subsampling": "4:2:0", "optimize": False, "progressive": False},
+        "PNG": {"compress_level": 6},
+        "WEBP": {"quality": 80, "method": 4}
+    },
+    "fast": {
+        "JPEG": {"quality": 85, "subsampling": "4:2:0", "optimize": False, "progressive": False},
+        "PNG": {"compress_level": 1},
+        "WEBP": {"quality": 80, "method": 0}
+    },
+    "balanced": {
+        "JPEG": {"quality": "keep", "subsampling": "4:2:0", "optimize": True, "progressive": False},
+        "PNG": {"compress_level": 3},
+        "WEBP": {"quality": 85, "method": 4}
+    },
+    "smallest": {
+        "JPEG": {"quality": 80, "subsampling": "4:2:0", "optimize": True, "progressive": True},
+        "PNG": {"compress_level": 9, "optimize": True},
+        "WEBP": {"quality": 75, "method": 6}
+    }
+}
+
+DEFAULT_PROFILE = "compat"
+
+# quality='keep' 但来源不是JPEG时使用的质量
+FALLBACK_JPEG_QUALITY = 85
+
+OUTPUT_FORMATS = ("JPEG", "PNG", "WEBP")
+
+OUTPUT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+
+def normalize_format(name):
+    """
+    规范化输出格式名称，jpg/jpeg -> JPEG
+    :return: JPEG、PNG 或 WEBP；name 为空时返回None
+    """
+    if not name:
+        return None
+    name = name.upper()
+    return "JPEG" if name == "JPG" else name
+
+
+def parse_quality(value):
+    """
+    解析质量参数，可用作 argparse 的 type
+    :param value: 1-100 的整数或 'keep'
+    :return: 整数或 'keep'，空值返回None
+    """
+    if value in (None, ""):
+        return None
+    if str(value).lower() == "keep":
+        return "keep"
+    quality = int(value)
+    if not 1 <= quality <= 100:
+        raise ValueError(f"质量必须在1到100之间: {value}")
+    return quality
+
+
+def source_info(img):
+    """
+    在转换颜色模式之前记录来源的编码信息，用于 quality='keep'
+    :param img: 已打开的来源图像
+    :return: 字典，非JPEG来源返回None
+    """
+    # 相机拍摄的JPEG常被识别为MPO，同样带有量化表
+    if img.format not in ("JPEG", "MPO") or not getattr(img, "quantization", None):
+        return None
+    return {
+        "quantization": img.quantization,
+        "subsampling": JpegImagePlugin.get_sampling(img)
+    }
+
+
+def keep_source_info(src, dst):
+    """
+    缩放等操作生成的新图像没有来源的格式和JPEG量化表，从来源图像复制过去，使 source_info 仍然可用
+    :param src: 来源图像
+    :param dst: 由来源图像生成的新图像
+    """
+    dst.format = src.format
+    for name in ("quantization", "layers", "layer"):
+        if hasattr(src, name):
+            setattr(dst, name, getattr(src, name))
+
+
+def encoder_options(output_format, profile=None, quality=None, lossless=False, source=None):
+    """
+    生成 Image.save 的编码参数
+    :param output_format: JPEG、PNG 或 WEBP
+    :param profile: 配置名称，默认为 compat
+    :param quality: 覆盖配置中的质量，整数或 'keep'
+    :param lossless: WebP是否无损压缩
+    :param source: source_info 的返回值
+    :return: 参数字典
+    """
+    if profile not in ENCODER_PROFILES:
+        if profile is not None:
+            raise ValueError(f"未知的编码配置: {profile}")
+        profile = DEFAULT_PROFILE
+    options = dict(ENCODER_PROFILES[profile].get(output_format, {}))
+
+    if output_format == "JPEG":
+        if quality is not None:
+            options["quality"] = quality
+        if options["quality"] == "keep":
+            # 直接传入原图的量化表，颜色模式转换后的图像也能沿用原图质量
+            if source is not None:
+                tables = source["quantization"]
+                options["qtables"] = [tables[key] for key in sorted(tables)]
+                if source["subsampling"] >= 0:
+                    options["subsampling"] = source["subsampling"]
+                del options["quality"]
+            else:
+                options["quality"] = FALLBACK_JPEG_QUALITY
+    elif output_format == "WEBP":
+        if lossless:
+            options["lossless"] = True
+            # 无损模式下 quality 表示压缩力度；method 5、6 在千万像素图片上要几分钟，收益很小
+            options["quality"] = {"compat": 80, "balanced": 50, "smallest": 90}.get(profile, 0)
+            options["method"] = min(options["method"], 4)
+        elif isinstance(quality, int):
+            options["quality"] = quality
+    return options
+
+
+def encoder_fingerprint(output_format, profile=None, quality=None, lossless=False):
+    """用于输出缓存键的编码设置"""
+    return {
+        "format": output_format,
+        "profile": profile or DEFAULT_PROFILE,
+        "quality": quality,
+        "lossless": bool(lossless) if output_format == "WEBP" else False
+    }
@@ -1,15 +1,18 @@
 import exifread
 import os
+from contextlib import nullcontext
 from datetime import datetime
 
 def extract_date_from_exif(image_path):
     """
     从图像的EXIF数据中提取拍摄日期
-    :param image_path: 图像文件路径
+    :param image_path: 图像文件路径，或已打开的二进制文件对象
     :return: 拍摄日期字符串 (YYYY-MM-DD) 或 None（如果未找到）
     """
     try:
-        with open(image_path, 'rb') as f:
+        # 文件对象由调用方负责关闭
+        source = nullcontext(image_path) if hasattr(image_path, 'read') else open(image_path, 'rb')
+        with source as f:
             tags = exifread.process_file(f, details=False)
 
             # 查找日期相关的标签
@@ -51,4 +54,21 @@ def get_file_modification_date(image_path):
         return datetime.fromtimestamp(mtime).strftime('%Y-%m-%d')
     except Exception as e:
         print(f"警告: 获取 {image_path} 的修改日期时出错: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def extract_camera_from_exif(image_path):
+    """
+    从图像的EXIF数据中提取相机型号
+    :param image_path: 图像文件路径，或已打开的二进制文件对象
+    :return: 相机型号字符串 或 None（如果未找到）
+    """
+    try:
+        source = nullcontext(image_path) if hasattr(image_path, 'read') else open(image_path, 'rb')
+        with source as f:
+            tags = exifread.process_file(f, details=False, stop_tag='Model')
+            model = str(tags.get('Image Model', '')).strip()
+            return model or None
+
+    except Exception as e:
+        print(f"警告: 读取 {image_path} 的EXIF数据时出错: {e}")
+        return None
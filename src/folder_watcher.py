@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+文件夹监视 - 监视收件目录，文件写入完成后分批交给工作进程池添加水印
+
+Linux 下使用 inotify，其他平台使用轮询。文件大小和修改时间在 settle_time
+秒内不再变化才视为写入完成，避免处理上传到一半的文件。
+inotify 事件队列溢出时，以及每隔 rescan_interval 秒，重新扫描整个目录，补上丢失的事件。
+"""
+
+import ctypes
+import ctypes.util
+import os
+import queue
+import random
+import select
+import struct
+import sys
+import time
+
+from image_processor import SUPPORTED_EXTENSIONS, create_output_directory
+import metrics
+from isolated_pool import QUARANTINE_REPORT, QuarantineReport
+from worker_pool import WatermarkWorkerPool, watermark_file
+
+# inotify 事件掩码
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+IN_GONE = IN_MOVED_FROM | IN_DELETE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _is_supported(filename):
+    return os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class FolderWatcher:
+    def __init__(self, directory, settle_time=2.0, poll_interval=1.0, rescan_interval=60.0):
+        """
+        :param directory: 监视的目录
+        :param settle_time: 文件多少秒内不再变化视为写入完成
+        :param poll_interval: 轮询模式下的扫描间隔（秒）
+        :param rescan_interval: inotify 模式下完整扫描目录的间隔（秒），0 表示只在事件队列溢出时扫描
+        """
+        self.directory = directory
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        # 路径 -> [文件签名, 首次发现时间, 最后变化时间]
+        self.pending = {}
+        # 已交付处理且仍在目录中的文件及其签名，文件删除或移走后移除
+        self.delivered = {}
+        self.last_scan = 0.0
+        self.inotify_fd = None
+        self.backend = "inotify" if self._init_inotify() else "polling"
+
+        # 启动时目录中已有的文件也需要处理
+        self._scan()
+
+    def _init_inotify(self):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return False
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_WATCH_MASK) < 0:
+                os.close(fd)
+                return False
+        except (OSError, AttributeError):
+            return False
+        self.inotify_fd = fd
+        return True
+
+    def _touch(self, path, now):
+        """记录文件的最新状态"""
+        try:
+            signature = _file_signature(path)
+        except OSError:
+            self._forget(path)
+            return
+        if self.delivered.get(path) == signature:
+            return
+
+        state = self.pending.get(path)
+        if state is None:
+            self.pending[path] = [signature, now, now]
+        elif state[0] != signature:
+            state[0] = signature
+            state[2] = now
+
+    def _forget(self, path):
+        """文件已删除或移走"""
+        self.pending.pop(path, None)
+        self.delivered.pop(path, None)
+
+    def _scan(self):
+        """扫描整个目录（启动时、轮询模式、inotify 事件队列溢出及定期扫描），移除已不在目录中的文件"""
+        now = time.time()
+        self.last_scan = now
+        present = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and _is_supported(entry.name):
+                    present.add(entry.path)
+                    self._touch(entry.path, now)
+        for path in [path for path in self.delivered if path not in present]:
+            del self.delivered[path]
+
+    def _read_events(self, timeout):
+        """等待并读取inotify事件"""
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        now = time.time()
+        data = os.read(self.inotify_fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                # 内核丢弃了部分事件，只能重新扫描整个目录
+                print("警告: inotify 事件队列溢出，重新扫描目录")
+                self._scan()
+            elif name and _is_supported(name):
+                path = os.path.join(self.directory, name)
+                if mask & IN_GONE:
+                    self._forget(path)
+                else:
+                    self._touch(path, now)
+
+    def poll(self, timeout=1.0):
+        """
+        等待新文件，返回已经写入完成的文件
+        :param timeout: 最长等待时间（秒）
+        :return: [(文件路径, 首次发现时间)]
+        """
+        if self.pending:
+            # 有待稳定的文件时，最多等到最早一个文件可能稳定的时刻
+            earliest = min(state[2] for state in self.pending.values()) + self.settle_time
+            timeout = max(0.0, min(timeout, earliest - time.time()))
+
+        if self.backend == "inotify":
+            self._read_events(timeout)
+            if self.rescan_interval and time.time() - self.last_scan >= self.rescan_interval:
+                self._scan()
+        else:
+            time.sleep(min(timeout, self.poll_interval) if self.pending else self.poll_interval)
+            self._scan()
+
+        now = time.time()
+        stable = []
+        for path in list(self.pending):
+            # inotify 不会报告仅修改元数据的情况，这里重新检查一次
+            self._touch(path, now)
+            state = self.pending.get(path)
+            if state is not None and now - state[2] >= self.settle_time:
+                del self.pending[path]
+                self.delivered[path] = state[0]
+                stable.append((path, state[1]))
+        return stable
+
+    def close(self):
+        """释放inotify句柄"""
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+class LatencyStats:
+    def __init__(self, reservoir_size=10000):
+        """
+        长时间运行时统计延迟：计数和最大值精确，分位数按固定大小的均匀抽样估算
+        :param reservoir_size: 保留的样本数
+        """
+        self.reservoir_size = reservoir_size
+        self.samples = []
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.max = max(self.max, value)
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(value)
+        else:
+            # 蓄水池抽样：第 count 个值以 reservoir_size/count 的概率替换一个样本
+            index = random.randrange(self.count)
+            if index < self.reservoir_size:
+                self.samples[index] = value
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _needs_processing(input_path, output_path):
+    """输出文件已存在且比输入文件新时跳过"""
+    try:
+        return os.path.getmtime(output_path) < os.path.getmtime(input_path)
+    except OSError:
+        return True
+
+
+def watch_main(args):
+    """
+    监视模式主函数
+    :param args: parse_watch_arguments 解析得到的参数
+    """
+    output_directory = args.output or create_output_directory(args.directory, clean=False)
+    os.makedirs(output_directory, exist_ok=True)
+
+    watcher = FolderWatcher(args.directory, args.settle_time, args.poll_interval, args.rescan_interval)
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    pool = WatermarkWorkerPool(args.workers, args.font_size, memory_budget)
+    print(f"开始监视目录: {args.directory} (方式: {watcher.backend}, 工作进程: {pool.workers})")
+    print(f"输出目录: {output_directory}")
+
+    registry = metrics.get_registry()
+    image_results = metrics.LabeledCounter(registry, "watermark_images_total", "处理的图片数", "result")
+    latency_histogram = None
+    if registry:
+        registry.gauge("watermark_watch_pending", "等待写入完成的文件数").set_function(lambda: len(watcher.pending))
+        registry.gauge("watermark_watch_batch", "正在凑批的图片数").set_function(lambda: len(batch))
+        latency_histogram = registry.histogram("watermark_watch_latency_seconds", "从发现文件到写出水印图片的延迟（秒）")
+
+    quarantine = QuarantineReport()
+    report_path = args.quarantine_report or os.path.join(output_directory, QUARANTINE_REPORT)
+    latencies = LatencyStats()
+    batch = []
+    batch_started = None
+    batch_count = 0
+    # 已提交的批次：批次号 -> {"total", "done", "latencies"}；任务完成时记录时间，主循环取出后汇报
+    batches = {}
+    running = {}
+    finished = queue.Queue()
+    # 处理中又被改写的文件，等本次处理完成后再提交
+    deferred = {}
+
+    def report(future, done_at):
+        nonlocal batch_started
+        item, batch_id, seen = running.pop(future)
+        name = os.path.basename(item[0])
+        stats = batches[batch_id]
+        stats["done"] += 1
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        if isinstance(result, Exception) or not result[0]:
+            image_results.inc("failed")
+            if quarantine.add(name, result):
+                # 长时间运行，每次隔离后立即更新报告
+                quarantine.write(report_path)
+                print(f"处理失败: {name} ({result})，已记入 {report_path}")
+            else:
+                print(f"处理失败: {name}")
+        else:
+            latency = done_at - seen
+            stats["latencies"].append(latency)
+            latencies.add(latency)
+            image_results.inc("ok")
+            if latency_histogram:
+                latency_histogram.observe(latency)
+            print(f"成功处理: {name} (水印: {result[1]}, 延迟 {latency:.2f}s)")
+
+        if stats["done"] == stats["total"]:
+            del batches[batch_id]
+            batch_latencies = stats["latencies"]
+            if batch_latencies:
+                print(f"批次 {batch_id}: {len(batch_latencies)}/{stats['total']} 张, "
+                      f"平均延迟 {sum(batch_latencies) / len(batch_latencies):.2f}s, "
+                      f"最大延迟 {max(batch_latencies):.2f}s")
+        if item[0] in deferred:
+            # 输出可能是按改写前的内容生成的，比较修改时间不可靠，直接重新处理
+            if not batch:
+                batch_started = time.time()
+            batch.append((item[0], item[1], deferred.pop(item[0])))
+
+    def drain():
+        while True:
+            try:
+                report(*finished.get_nowait())
+            except queue.Empty:
+                return
+
+    try:
+        while True:
+            for input_path, first_seen in watcher.poll(args.batch_delay if batch else 1.0):
+                output_path = os.path.join(output_directory, os.path.basename(input_path))
+                if not _needs_processing(input_path, output_path):
+                    continue
+                if any(item[0] == input_path for item in running.values()):
+                    deferred.setdefault(input_path, first_seen)
+                    continue
+                if not batch:
+                    batch_started = time.time()
+                batch.append((input_path, output_path, first_seen))
+            drain()
+
+            # 凑够一批，或者等待时间已到，或者没有正在写入的文件时提交
+            if not batch:
+                continue
+            if (len(batch) < args.batch_size and watcher.pending
+                    and time.time() - batch_started < args.batch_delay):
+                continue
+
+            # 提交后不等待完成，继续凑下一批；工作进程在前一批处理时就能接着处理后面的文件
+            batch_count += 1
+            batches[batch_count] = {"total": len(batch), "done": 0, "latencies": []}
+            sized = [(pool.estimate(input_path), input_path, output_path, seen)
+                     for input_path, output_path, seen in batch]
+            batch = []
+            # 按估算内存从大到小提交：大任务最先开始，批次耗时不会被最后才开始的大图拖长
+            sized.sort(key=lambda entry: entry[0], reverse=True)
+            for nbytes, input_path, output_path, seen in sized:
+                item = (input_path, output_path, args.font_size, args.font_color, args.position, args.layers,
+                        args.text)
+                # 内存上限已满时在这里等待，正在处理的任务结束后释放
+                future = pool.submit_sized(nbytes, watermark_file, *item)
+                running[future] = (item, batch_count, seen)
+                future.add_done_callback(lambda done: finished.put((done, time.time())))
+
+    except KeyboardInterrupt:
+        print("\n停止监视")
+    finally:
+        watcher.close()
+        pool.shutdown()
+        drain()
+
+    if latencies.count:
+        print(f"共处理 {latencies.count} 张图片, 落盘到输出延迟: "
+              f"p50 {latencies.percentile(0.5):.2f}s, "
+              f"p95 {latencies.percentile(0.95):.2f}s, "
+              f"最大 {latencies.max:.2f}s")
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+多帧图像 - 逐帧为动画GIF、APNG和多页TIFF添加水印
+
+    if is_frame_sequence(img):                      Image.open 之后、解码之前判断
+        write_sequence(fp, img, render, options)    ImageSequence 逐帧解码，render(frame) 添加水印后立即编码写出
+
+同一时间只解码、处理一帧（另外保留上一帧用于比较），内存与帧数无关。
+Pillow 的 save_all 会先收集所有帧再编码，这里按格式自行写出:
+
+    GIF   沿用第一帧的全局调色板，空闲的条目补充水印带来的新颜色，每帧量化到同一调色板（不抖动）；
+          之后的帧含有全局调色板无法表示的颜色时，量化到该帧自己的调色板并写为局部颜色表（与 save_all 相同），
+          保留时长、循环次数、透明色和处置方式；
+          上一帧不清除画布时只写出与上一帧不同的区域；含透明像素的帧以处置方式2（恢复背景）写出完整画布
+    APNG  每帧与上一帧不同的区域先编码为独立的PNG，再把图像数据改写为 fcTL/fdAT 块；
+          blend_op=SOURCE、dispose_op=NONE，显示结果与Pillow合成后的帧逐像素相同，保留时长和循环次数；
+          输出为RGB/RGBA，不保留调色板
+    TIFF  用 AppendingTiffWriter 逐页追加，保留各页的压缩方式和分辨率
+"""
+
+import io
+import struct
+import zlib
+
+from PIL import GifImagePlugin, Image, ImageChops, ImageSequence, TiffImagePlugin
+
+from profiling import stage
+
+# 支持逐帧处理的格式；MPO（相机拍摄的JPEG）和动画WebP仍只处理第一帧
+SEQUENCE_FORMATS = ("GIF", "PNG", "TIFF")
+
+# GIF帧中与调色板最接近的颜色相差超过该值（灰度）的像素视为无法表示：
+# 第一帧用全局调色板的空闲条目补充，之后的帧改用局部颜色表
+PALETTE_ERROR = 24
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def is_frame_sequence(img):
+    """
+    是否为需要逐帧处理的多帧图像
+    :param img: Image.open 得到的图像
+    """
+    return img.format in SEQUENCE_FORMATS and getattr(img, "n_frames", 1) > 1
+
+
+def write_sequence(fp, img, render, options=None):
+    """
+    逐帧添加水印并写出，输出格式与输入相同
+    :param fp: 二进制输出文件对象，TIFF需要可读写、可定位（BytesIO 或 'w+b' 打开的文件）
+    :param img: 尚未解码的多帧图像（is_frame_sequence 为True）
+    :param render: render(frame) -> 添加水印后的RGB或RGBA图像；frame 为已定位到当前帧的 img，
+                   不能在 frame 上原地绘制，Pillow 解码下一帧时还会用到它
+    :param options: 编码参数（见 encoder_profiles.encoder_options），APNG的各帧按PNG参数编码
+    :return: 写出的帧数
+    """
+    writers = {"GIF": _write_gif, "PNG": _write_apng, "TIFF": _write_tiff}
+    return writers[img.format](fp, img, render, options or {})
+
+
+def _palette_indices(img):
+    """P模式图像的调色板索引，作为L模式图像（不经过调色板）"""
+    return Image.frombytes("L", img.size, img.tobytes())
+
+
+def _quantize_palette(colors, transparency):
+    """
+    用于量化的调色板：透明色的条目换成另一个条目的颜色，不透明像素不会只能匹配到透明色
+    :param colors: 全局调色板 [r, g, b, ...]
+    :return: (P模式的调色板图像, 代替透明色的索引)
+    """
+    colors = list(colors) + [0] * (768 - len(colors))
+    substitute = None
+    if transparency is not None:
+        substitute = 0 if transparency else 1
+        colors[transparency * 3:transparency * 3 + 3] = colors[substitute * 3:substitute * 3 + 3]
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(colors)
+    return palette, substitute
+
+
+def _unrepresented(rgb, colors, transparency):
+    """
+    调色板无法表示的像素所在的区域
+    :param rgb: RGB图像
+    :param colors: 调色板 [r, g, b, ...]
+    :return: (left, top, right, bottom)，都能表示时返回None
+    """
+    palette, _ = _quantize_palette(colors, transparency)
+    approx = rgb.quantize(palette=palette, dither=Image.Dither.NONE).convert('RGB')
+    error = ImageChops.difference(rgb, approx).convert('L').point(lambda e: 255 if e > PALETTE_ERROR else 0)
+    return error.getbbox()
+
+
+def _extend_palette(colors, transparency, watermarked):
+    """
+    用调色板的空闲条目补充第一帧中无法用原调色板表示的颜色（通常是水印文字和Logo）
+    :param colors: 全局调色板 [r, g, b, ...]
+    :param watermarked: 添加水印后的第一帧
+    :return: 补充后的调色板
+    """
+    free = 256 - len(colors) // 3
+    if free <= 0:
+        return colors
+    rgb = watermarked.convert('RGB')
+    box = _unrepresented(rgb, colors, transparency)
+    if box is None:
+        return colors
+    extra = rgb.crop(box).quantize(free)
+    return list(colors) + extra.getpalette()[:len(extra.getcolors()) * 3]
+
+
+def _local_palette(rgb, transparency):
+    """
+    为一帧生成自己的调色板（局部颜色表），透明色保持在全局调色板中的索引
+    :param rgb: 添加水印后的帧（RGB）
+    :return: 调色板 [r, g, b, ...]，256个条目
+    """
+    quantized = rgb.quantize(256 if transparency is None else 255)
+    colors = quantized.getpalette()[:len(quantized.getcolors()) * 3]
+    if transparency is not None:
+        colors = colors[:transparency * 3] + [0, 0, 0] + colors[transparency * 3:]
+    return (colors + [0] * 768)[:768]
+
+
+def _write_gif(fp, img, render, options):
+    colors = None
+    transparency = None
+    previous = None
+    previous_disposal = None
+    count = 0
+
+    for frame in ImageSequence.Iterator(img):
+        duration = frame.info.get("duration", 0)
+        disposal = getattr(frame, "disposal_method", 0)
+        if colors is None and frame.mode == 'P':
+            # 第一帧保留原始调色板，以它作为所有帧的全局调色板
+            colors = frame.getpalette()
+            transparency = frame.info.get("transparency")
+        watermarked = render(frame)
+
+        with stage("encode", pixels=watermarked.width * watermarked.height):
+            rgb = watermarked.convert('RGB')
+            if colors is None:
+                # 没有调色板的来源（如灰度GIF）由第一帧生成，留出最后一个索引作为透明色
+                colors = rgb.quantize(255).getpalette()
+                transparency = 255 if watermarked.mode == 'RGBA' else None
+            local_colors = None
+            if count == 0:
+                colors = _extend_palette(colors, transparency, watermarked)
+                palette, substitute = _quantize_palette(colors, transparency)
+            elif _unrepresented(rgb, colors, transparency) is not None:
+                # 这一帧有全局调色板表示不了的新颜色，量化到自己的调色板，写为局部颜色表
+                local_colors = _local_palette(rgb, transparency)
+            if local_colors is None:
+                frame_palette, frame_substitute = palette, substitute
+            else:
+                frame_palette, frame_substitute = _quantize_palette(local_colors, transparency)
+            indexed = rgb.quantize(palette=frame_palette, dither=Image.Dither.NONE)
+
+            transparent = None
+            if transparency is not None:
+                # 量化到透明色条目的不透明像素颜色与代替索引相同，换成代替索引
+                collide = _palette_indices(indexed).point(lambda i: 255 if i == transparency else 0)
+                if collide.getbbox():
+                    indexed.paste(frame_substitute, mask=collide)
+                if watermarked.mode == 'RGBA' and watermarked.getchannel('A').getextrema()[0] < 128:
+                    transparent = watermarked.getchannel('A').point(lambda a: 0 if a >= 128 else 255)
+                    indexed.paste(transparency, mask=transparent)
+
+            params = {"duration": duration}
+            if transparency is not None:
+                params["transparency"] = transparency
+            # 含透明像素的帧以完整画布写出，显示后恢复背景，下一帧的透明区域才不会透出本帧
+            params["disposal"] = 2 if transparent is not None else disposal
+            if local_colors is not None:
+                # 局部颜色表保留透明色条目的原始颜色，与全局调色板一致
+                indexed.putpalette(local_colors)
+                params["include_color_table"] = True
+
+            # 各帧的调色板可能不同，按显示的颜色比较
+            shown = indexed.convert('RGB')
+            box = (0, 0) + indexed.size
+            if previous is not None and previous_disposal in (0, 1) and transparent is None:
+                # 上一帧留在画布上，只写出变化的区域；完全相同时写出一个像素，保留这一帧的时长
+                box = ImageChops.difference(previous, shown).getbbox() or (0, 0, 1, 1)
+
+            if count == 0:
+                # 全局调色板使用原始颜色，透明色的条目不变
+                indexed.putpalette(colors)
+                indexed.info["version"] = b"89a"
+                info = {"loop": img.info.get("loop"), "background": img.info.get("background", 0)}
+                if transparency is not None:
+                    info["transparency"] = transparency
+                header, _ = GifImagePlugin.getheader(indexed, None, info)
+                for block in header:
+                    fp.write(block)
+            part = indexed if box == (0, 0) + indexed.size else indexed.crop(box)
+            for block in GifImagePlugin.getdata(part, box[:2], **params):
+                fp.write(block)
+
+        previous = shown
+        previous_disposal = params["disposal"]
+        count += 1
+
+    fp.write(b";")
+    return count
+
+
+def _png_chunks(data):
+    """遍历PNG文件内容中的 (类型, 数据)"""
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        length, = struct.unpack(">I", data[offset:offset + 4])
+        yield data[offset + 4:offset + 8], data[offset + 8:offset + 8 + length]
+        offset += length + 12
+
+
+def _put_chunk(fp, chunk_type, data):
+    fp.write(struct.pack(">I", len(data)) + chunk_type + data)
+    fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def _write_apng(fp, img, render, options):
+    sequence = 0
+    mode = None
+    previous = None
+    count = 0
+    fp.write(PNG_SIGNATURE)
+
+    for frame in ImageSequence.Iterator(img):
+        duration = frame.info.get("duration", 0)
+        watermarked = render(frame)
+        if mode is None:
+            mode = watermarked.mode
+        elif watermarked.mode != mode:
+            # 所有帧共用第一帧的 IHDR
+            watermarked = watermarked.convert(mode)
+
+        with stage("encode", pixels=watermarked.width * watermarked.height):
+            box = (0, 0) + watermarked.size
+            if previous is not None:
+                # 上一帧留在画布上，只写出变化的区域；完全相同时写出一个像素，保留这一帧的时长
+                box = ImageChops.difference(previous, watermarked).getbbox() or (0, 0, 1, 1)
+            part = watermarked if box == (0, 0) + watermarked.size else watermarked.crop(box)
+            encoded = io.BytesIO()
+            part.save(encoded, format="PNG", **options)
+            fctl = struct.pack(">IIIIIHHBB", sequence, part.width, part.height, box[0], box[1],
+                               int(round(duration)), 1000, 0, 0)
+            sequence += 1
+            fctl_written = False
+            for chunk_type, data in _png_chunks(encoded.getvalue()):
+                if chunk_type == b"IHDR":
+                    if count == 0:
+                        _put_chunk(fp, b"IHDR", data)
+                        _put_chunk(fp, b"acTL", struct.pack(">II", img.n_frames, img.info.get("loop", 0)))
+                elif chunk_type == b"IDAT":
+                    if not fctl_written:
+                        _put_chunk(fp, b"fcTL", fctl)
+                        fctl_written = True
+                    if count == 0:
+                        _put_chunk(fp, b"IDAT", data)
+                    else:
+                        _put_chunk(fp, b"fdAT", struct.pack(">I", sequence) + data)
+                        sequence += 1
+                elif chunk_type != b"IEND" and count == 0:
+                    # PLTE、tRNS 等辅助块只在第一帧之前写出一次
+                    _put_chunk(fp, chunk_type, data)
+        previous = watermarked
+        count += 1
+
+    _put_chunk(fp, b"IEND", b"")
+    return count
+
+
+def _write_tiff(fp, img, render, options):
+    count = 0
+    with TiffImagePlugin.AppendingTiffWriter(fp) as tiff:
+        for frame in ImageSequence.Iterator(img):
+            params = dict(options)
+            for key in ("compression", "dpi"):
+                if frame.info.get(key) and frame.info[key] != "raw":
+                    params.setdefault(key, frame.info[key])
+            watermarked = render(frame)
+            with stage("encode", pixels=watermarked.width * watermarked.height):
+                watermarked.save(tiff, format="TIFF", **params)
+                tiff.newFrame()
+            count += 1
+    return count
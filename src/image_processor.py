@@ -1,27 +1,53 @@
 import os
-from PIL import Image, ImageDraw, ImageFont
+from PIL import ImageColor
 import shutil
 
+import profiling
+from watermark_handler import WatermarkHandler
+
+SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp', '.gif'}
+
+# 共享同一个水印处理器，字体和文字精灵图缓存在批量处理中复用
+_handler = WatermarkHandler()
+
+def remove_output(path):
+    """
+    写出输出文件前删除已有的文件，新内容写入新的inode，不会改写与它共用数据的其他文件
+    :param path: 输出文件路径
+    """
+    if os.path.lexists(path):
+        os.remove(path)
+
+def normalize_color(font_color):
+    """
+    用 ImageColor 解析颜色，支持Pillow识别的所有颜色名称、HEX和 rgb(...) 等写法
+    :param font_color: 颜色字符串
+    :return: HEX颜色 "#rrggbb"
+    :raise ValueError: 无法识别的颜色
+    """
+    r, g, b = ImageColor.getrgb(font_color)[:3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
 def get_supported_images(directory):
     """
     获取目录中支持的图像文件
     :param directory: 目录路径
     :return: 支持的图像文件列表
     """
-    supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
     images = []
 
     for filename in os.listdir(directory):
         _, ext = os.path.splitext(filename)
-        if ext.lower() in supported_extensions:
+        if ext.lower() in SUPPORTED_EXTENSIONS:
             images.append(filename)
 
     return images
 
-def create_output_directory(input_directory):
+def create_output_directory(input_directory, clean=True):
     """
     创建输出目录
     :param input_directory: 输入目录路径
+    :param clean: 是否清空已存在的输出目录（断点续传时为False）
     :return: 输出目录路径
     """
     dir_name = os.path.basename(os.path.normpath(input_directory))
@@ -29,11 +55,11 @@ def create_output_directory(input_directory):
     output_path = os.path.join(os.path.dirname(input_directory), output_dir)
 
     # 如果输出目录已存在，先删除它
-    if os.path.exists(output_path):
+    if clean and os.path.exists(output_path):
         shutil.rmtree(output_path)
 
     # 创建新的输出目录
-    os.makedirs(output_path)
+    os.makedirs(output_path, exist_ok=True)
     return output_path
 
 def get_watermark_position(image_size, text_size, position):
@@ -59,7 +85,8 @@ def get_watermark_position(image_size, text_size, position):
         # 默认为右下角
         return (img_width - text_width - margin, img_height - text_height - margin)
 
-def process_image(input_path, output_path, watermark_text, font_size=24, font_color='black', position='bottomRight'):
+def process_image(input_path, output_path, watermark_text, font_size=24, font_color='black', position='bottomRight',
+                  layers=None, fields=None):
     """
     处理单个图像，添加水印
     :param input_path: 输入图像路径
@@ -68,88 +95,43 @@ def process_image(input_path, output_path, watermark_text, font_size=24, font_co
     :param font_size: 字体大小
     :param font_color: 字体颜色
     :param position: 水印位置
+    :param layers: watermark_handler.parse_layers 返回的附加图层
+    :param fields: 当前图片的模板字段值，用于替换水印文本中的 {date}、{filename}、{camera}
+    :return: 是否成功处理
+    """
+    try:
+        # 与直接使用颜色名称绘制保持一致，支持Pillow识别的所有颜色名称
+        return _handler.add_text_watermark(
+            input_path, output_path, watermark_text, font_size,
+            normalize_color(font_color), 100, 0, position, layers=layers, fields=fields)
+
+    except Exception as e:
+        print(f"错误: 处理图像 {input_path} 时出错: {e}")
+        return False
+
+def process_image_variants(input_path, output_paths, variants, watermark_text, font_size=24,
+                           font_color='black', position='bottomRight', output_format=None, layers=None,
+                           fields=None):
+    """
+    处理单个图像，一次解码生成多个输出规格
+    :param output_paths: 与 variants 对应的输出图像路径
+    :param variants: output_variants.parse_variant 返回的规格列表
+    :param output_format: 规格未指定格式时的输出格式，None 表示与输入相同
+    :param layers: watermark_handler.parse_layers 返回的附加图层
+    :param fields: 当前图片的模板字段值（见 process_image）
     :return: 是否成功处理
     """
     try:
-        # 打开图像
-        with Image.open(input_path) as img:
-            # 转换为RGBA模式以支持透明度
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-
-            # 创建一个透明图层用于绘制水印
-            txt_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(txt_layer)
-
-            # 尝试使用支持中文的字体
-            font_names = [
-                "simhei.ttf",      # 黑体
-                "simsun.ttc",      # 宋体
-                "msyh.ttc",        # 微软雅黑
-                "simkai.ttf",      # 楷体
-                "fangsong.ttf",    # 仿宋
-                "arial.ttf",
-                "DejaVuSans.ttf"
-            ]
-
-            font = None
-            for font_name in font_names:
-                try:
-                    font = ImageFont.truetype(font_name, font_size)
-                    break
-                except:
-                    continue
-
-            # 如果所有字体都失败，使用默认字体
-            if font is None:
-                font = ImageFont.load_default()
-                # 如果默认字体也不支持中文，尝试使用系统字体
-                try:
-                    # Windows系统字体
-                    font = ImageFont.truetype("C:/Windows/Fonts/simhei.ttf", font_size)
-                except:
-                    try:
-                        # macOS系统字体
-                        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-                    except:
-                        try:
-                            # Linux系统字体
-                            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-                        except:
-                            pass
-
-            # 获取文本尺寸
-            bbox = draw.textbbox((0, 0), watermark_text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-
-            # 计算水印位置
-            img_width, img_height = img.size
-            margin = 10
-
-            if position == 'topLeft':
-                x, y = margin, margin
-            elif position == 'center':
-                x, y = (img_width - text_width) // 2, (img_height - text_height) // 2
-            elif position == 'bottomRight':
-                x, y = img_width - text_width - margin, img_height - text_height - margin
-            else:
-                x, y = img_width - text_width - margin, img_height - text_height - margin
-
-            # 绘制水印
-            draw.text((x, y), watermark_text, font=font, fill=font_color)
-
-            # 合并图像和水印图层
-            watermarked = Image.alpha_composite(img, txt_layer)
-
-            # 转换回RGB模式以保存为JPEG等格式
-            watermarked = watermarked.convert('RGB')
-
-            # 保存图像
-            watermarked.save(output_path)
-
-            return True
+        outputs = _handler.watermark_variants(
+            input_path, variants, watermark_text, font_size,
+            normalize_color(font_color), 100, 0, position, output_format, layers=layers, fields=fields)
+        for output_path, data in zip(output_paths, outputs):
+            with profiling.stage("write", nbytes_written=len(data)):
+                remove_output(output_path)
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+        return True
 
     except Exception as e:
         print(f"错误: 处理图像 {input_path} 时出错: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+隔离的工作进程池 - 每个工作进程同时只执行一个任务，单个任务卡死、内存失控或导致进程崩溃时
+只影响该任务，不会拖住或中断整个批次
+
+    超时        任务执行超过 task_timeout 秒时终止该工作进程，任务结果为 TaskTimeout；
+                从工作进程初始化完成后开始计时，新进程的启动时间不计入
+    内存        执行中的工作进程RSS超过 max_worker_rss 时终止，任务结果为 WorkerCrashed
+    崩溃        工作进程意外退出（例如解码器段错误）时任务结果为 WorkerCrashed
+    定期重启    工作进程完成 max_tasks_per_worker 个任务，或任务结束后RSS超过 max_worker_rss 时换成新进程
+
+超时、内存失控和崩溃的任务结果都是 TaskQuarantined 的子类，调用方用 QuarantineReport 按名称记录并写入JSON报告。
+接口与 concurrent.futures.ProcessPoolExecutor 相同: submit() 返回 Future，shutdown() 等待所有任务完成。
+调度线程本身出错（例如无法启动工作进程）时，排队和执行中的任务都以该异常结束，之后的 submit() 抛出 BrokenProcessPool。
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+import itertools
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+from multiprocessing.reduction import ForkingPickler
+import pickle
+import threading
+import time
+
+from memory_profiler import read_rss
+
+# 执行任务时检查工作进程RSS的间隔（秒）
+RSS_CHECK_INTERVAL = 0.2
+
+# 默认的隔离报告文件名
+QUARANTINE_REPORT = "quarantine.json"
+
+# 连续多少个工作进程在初始化完成前退出时，放弃所有排队的任务
+MAX_STARTUP_FAILURES = 3
+
+
+class TaskQuarantined(Exception):
+    def __init__(self, message, reason, elapsed=None):
+        """
+        任务因超时、内存失控或进程崩溃被隔离
+        :param reason: timeout、memory、crashed 或 startup
+        :param elapsed: 任务已执行的秒数
+        """
+        super().__init__(message)
+        self.reason = reason
+        self.elapsed = elapsed
+
+
+class TaskTimeout(TaskQuarantined):
+    """任务执行超时，工作进程已被终止"""
+
+
+class WorkerCrashed(TaskQuarantined):
+    """执行任务的工作进程意外退出或内存超出上限"""
+
+
+def _get_context():
+    # forkserver 从一个干净的进程派生工作进程，主进程中其他线程持有的锁不会被带入子进程
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _worker_main(conn, initializer, initargs):
+    """
+    工作进程主循环：接收任务、执行、返回 (任务编号, 是否成功, 结果或异常, RSS)
+    初始化完成后先发送任务编号为None的消息
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send((None, True, None, read_rss()))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        task_id, fn, args, kwargs = message
+        try:
+            reply = (task_id, True, fn(*args, **kwargs))
+        except BaseException as e:
+            reply = (task_id, False, e)
+        try:
+            conn.send(reply + (read_rss(),))
+        except Exception as e:
+            # 结果或异常无法序列化
+            conn.send((task_id, False, RuntimeError(f"无法返回任务结果: {e}"), read_rss()))
+
+
+class _Worker:
+    def __init__(self, context, initializer, initargs):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, initializer, initargs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks_done = 0
+        self.ready = False
+        # (任务编号, Future, 开始时间, 任务)；开始时间从工作进程初始化完成算起，启动期间为None
+        self.task = None
+
+    def stop(self, timeout=5.0):
+        """请求工作进程退出，超时后强制终止"""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class IsolatedProcessPool:
+    def __init__(self, max_workers, initializer=None, initargs=(), task_timeout=None,
+                 max_tasks_per_worker=None, max_worker_rss=None, on_event=None):
+        """
+        :param max_workers: 工作进程数
+        :param initializer: 工作进程启动时调用的函数
+        :param initargs: initializer 的参数
+        :param task_timeout: 单个任务的超时时间（秒），None 表示不限制
+        :param max_tasks_per_worker: 工作进程完成多少个任务后重启，None 表示不重启
+        :param max_worker_rss: 工作进程RSS上限（字节），None 表示不限制
+        :param on_event: 回调 on_event(事件, 原因)，事件为 quarantine 或 restart，用于记录指标
+        """
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.task_timeout = task_timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_worker_rss = max_worker_rss
+        self.on_event = on_event
+        self.context = _get_context()
+
+        self.quarantined = 0
+        self.restarts = 0
+        # 经管道传递的任务和结果（pickle 之后）的字节数
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._startup_failures = 0
+        self._queue = deque()
+        self._workers = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        # 调度线程异常退出的原因
+        self._broken = None
+        # 唤醒调度线程
+        self._wakeup_reader, self._wakeup_writer = self.context.Pipe(duplex=False)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ---- 提交 ----
+
+    def submit(self, fn, *args, **kwargs):
+        """提交任务，返回 Future"""
+        future = Future()
+        with self._lock:
+            if self._broken is not None:
+                raise BrokenProcessPool(f"进程池调度线程已异常退出: {self._broken!r}")
+            if self._shutdown:
+                raise RuntimeError("进程池已关闭")
+            self._queue.append((next(self._ids), future, fn, args, kwargs))
+        self._wake()
+        return future
+
+    def _wake(self):
+        try:
+            self._wakeup_writer.send_bytes(b"")
+        except OSError:
+            pass
+
+    def shutdown(self, wait=True):
+        """不再接受新任务；wait 为True时等待所有已提交的任务完成"""
+        with self._lock:
+            self._shutdown = True
+        self._wake()
+        if wait:
+            self._thread.join()
+
+    # ---- 调度线程 ----
+
+    def _run(self):
+        try:
+            self._loop()
+        except BaseException as e:
+            self._fail_all(e)
+            return
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def _fail_all(self, error):
+        """调度线程出错：终止所有工作进程，排队和执行中的任务都以 error 结束，进程池不再接受任务"""
+        print(f"错误: 进程池调度线程异常退出: {error!r}")
+        with self._lock:
+            self._broken = error
+            futures = [task[1] for task in self._queue]
+            self._queue.clear()
+        for worker in self._workers:
+            if worker.task is not None:
+                futures.append(worker.task[1])
+            try:
+                worker.kill()
+            except Exception:
+                pass
+        self._workers = []
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                idle = not self._queue and all(worker.task is None for worker in self._workers)
+                if self._shutdown and idle:
+                    break
+            self._dispatch()
+
+            ready = wait([self._wakeup_reader]
+                         + [worker.conn for worker in self._workers]
+                         + [worker.process.sentinel for worker in self._workers],
+                         timeout=self._next_timeout())
+            if self._wakeup_reader in ready:
+                while self._wakeup_reader.poll():
+                    self._wakeup_reader.recv_bytes()
+
+            for worker in list(self._workers):
+                if worker.conn in ready:
+                    self._receive(worker)
+                elif worker.process.sentinel in ready:
+                    self._crashed(worker)
+            self._check_running()
+
+    def _dispatch(self):
+        """把排队的任务分配给空闲的工作进程，需要时启动新进程"""
+        while True:
+            worker = next((w for w in self._workers if w.task is None), None)
+            if worker is None and len(self._workers) < self.max_workers:
+                with self._lock:
+                    if not self._queue:
+                        return
+                worker = _Worker(self.context, self.initializer, self.initargs)
+                self._workers.append(worker)
+            if worker is None:
+                return
+
+            with self._lock:
+                if not self._queue:
+                    return
+                task = self._queue.popleft()
+            task_id, future, fn, args, kwargs = task
+            # 因工作进程启动失败而重新排队的任务已经处于运行状态
+            if not future.running() and not future.set_running_or_notify_cancel():
+                continue
+            try:
+                message = ForkingPickler.dumps((task_id, fn, args, kwargs))
+                worker.conn.send_bytes(message)
+                self.bytes_sent += len(message)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            # 新进程启动和初始化的时间不算作任务的执行时间，初始化完成后才开始计时
+            worker.task = (task_id, future, time.monotonic() if worker.ready else None, task)
+
+    def _next_timeout(self):
+        """距离最近的超时或下一次RSS检查的秒数"""
+        running = [worker.task[2] for worker in self._workers if worker.task and worker.task[2] is not None]
+        if not running:
+            return None
+        timeouts = []
+        if self.task_timeout:
+            timeouts.append(min(running) + self.task_timeout - time.monotonic())
+        if self.max_worker_rss:
+            timeouts.append(RSS_CHECK_INTERVAL)
+        return max(0.0, min(timeouts)) if timeouts else None
+
+    def _receive(self, worker):
+        while True:
+            try:
+                message = worker.conn.recv_bytes()
+            except (EOFError, OSError):
+                self._crashed(worker)
+                return
+            self.bytes_received += len(message)
+            task_id, ok, value, rss = pickle.loads(message)
+            if task_id is not None:
+                break
+            # 初始化完成，已分配的任务从现在开始计时
+            worker.ready = True
+            self._startup_failures = 0
+            if worker.task is not None:
+                worker.task = worker.task[:2] + (time.monotonic(),) + worker.task[3:]
+            if not worker.conn.poll():
+                return
+
+        future = worker.task[1]
+        worker.task = None
+        worker.tasks_done += 1
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+        if self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker:
+            self._restart(worker, "tasks")
+        elif self.max_worker_rss and rss and rss > self.max_worker_rss:
+            self._restart(worker, "rss")
+
+    def _check_running(self):
+        """终止超时或RSS超出上限的任务"""
+        now = time.monotonic()
+        for worker in list(self._workers):
+            if worker.task is None or worker.task[2] is None:
+                continue
+            elapsed = now - worker.task[2]
+            if self.task_timeout and elapsed > self.task_timeout:
+                self._fail(worker, TaskTimeout(f"任务执行超过 {self.task_timeout:g} 秒", "timeout", elapsed))
+                continue
+            if self.max_worker_rss:
+                rss = read_rss(worker.process.pid)
+                if rss and rss > self.max_worker_rss:
+                    self._fail(worker, WorkerCrashed(
+                        f"工作进程内存 {rss / 1024 / 1024:.0f}MB 超出上限 "
+                        f"{self.max_worker_rss / 1024 / 1024:.0f}MB", "memory", elapsed))
+
+    def _crashed(self, worker):
+        # 进程已经退出，等待回收以取得退出码
+        worker.process.join(1.0)
+        if worker.ready:
+            elapsed = time.monotonic() - worker.task[2] if worker.task and worker.task[2] is not None else None
+            self._fail(worker, WorkerCrashed(f"工作进程意外退出 (退出码 {worker.process.exitcode})", "crashed", elapsed))
+            return
+
+        # 初始化时退出与任务无关，任务重新排队；连续失败时放弃所有任务
+        worker.kill()
+        self._workers.remove(worker)
+        self._startup_failures += 1
+        with self._lock:
+            if worker.task is not None:
+                self._queue.appendleft(worker.task[3])
+            if self._startup_failures < MAX_STARTUP_FAILURES:
+                return
+            tasks = list(self._queue)
+            self._queue.clear()
+        print(f"错误: 工作进程连续 {self._startup_failures} 次启动失败 (退出码 {worker.process.exitcode})")
+        for task in tasks:
+            future = task[1]
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(WorkerCrashed("工作进程无法启动", "startup"))
+
+    def _fail(self, worker, error):
+        """终止工作进程，任务结果为 error"""
+        worker.kill()
+        self._workers.remove(worker)
+        if worker.task is not None:
+            worker.task[1].set_exception(error)
+            self.quarantined += 1
+            if self.on_event:
+                self.on_event("quarantine", error.reason)
+        self.restarts += 1
+        if self.on_event:
+            self.on_event("restart", error.reason)
+
+    def _restart(self, worker, reason):
+        """任务间隙重启工作进程，新进程在下次分配任务时启动"""
+        worker.stop()
+        self._workers.remove(worker)
+        self.restarts += 1
+        if self.on_event:
+            self.on_event("restart", reason)
+
+    def worker_pids(self):
+        """当前工作进程的进程号"""
+        return [worker.process.pid for worker in list(self._workers)]
+
+
+class QuarantineReport:
+    def __init__(self):
+        """按任务名称记录被隔离的任务"""
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name, error):
+        """
+        error 是 TaskQuarantined 时记录该任务
+        :return: 是否记录
+        """
+        if not isinstance(error, TaskQuarantined):
+            return False
+        self.entries.append({
+            "task": name,
+            "reason": error.reason,
+            "error": str(error),
+            "elapsed": round(error.elapsed, 3) if error.elapsed is not None else None,
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S')
+        })
+        return True
+
+    def write(self, path):
+        """
+        写入JSON报告，没有被隔离的任务时不写
+        :return: 被隔离的任务数
+        """
+        if self.entries:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({"quarantined": self.entries}, f, ensure_ascii=False, indent=2)
+        return len(self.entries)
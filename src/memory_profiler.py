@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+内存分析 - 记录每张图片、每个处理阶段的峰值内存和残留内存，并拟合每百万像素的内存模型
+
+同时使用两种方式测量:
+    tracemalloc  Python对象（读入的文件内容、编码结果、字体和精灵图缓存等）
+    RSS采样      后台线程定期读取进程RSS，包含Pillow在C层分配的像素缓冲区
+
+Pillow的像素缓冲区不经过Python内存分配器，tracemalloc看不到，因此以RSS为准估算内存需求。
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from profiling import StageProfiler, _stage_rank
+
+# 单独拟合某个图像模式所需的最少图片数
+MIN_MODE_SAMPLES = 2
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def read_rss(pid=None):
+    """
+    进程的RSS（字节）
+    Linux读取 /proc/<pid>/statm；其他Unix平台只能得到当前进程的历史峰值 ru_maxrss，Windows上没有 resource 模块
+    :param pid: 进程号，None 表示当前进程
+    :return: 字节数，无法读取其他进程时返回None，当前进程也无法读取时返回0
+    """
+    try:
+        with open(f'/proc/{pid or "self"}/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        if pid is not None:
+            return None
+        try:
+            import resource
+        except ImportError:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 单位为字节，Linux 为KB
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RssSampler:
+    def __init__(self, interval=0.002):
+        """
+        :param interval: 采样间隔（秒）
+        """
+        self.interval = interval
+        self.peak = read_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = read_rss()
+            if rss > self.peak:
+                self.peak = rss
+
+    def reset(self):
+        """重新开始记录峰值，返回当前RSS"""
+        rss = read_rss()
+        self.peak = rss
+        return rss
+
+    def read_peak(self):
+        """自上次 reset 以来的峰值（包括此刻）"""
+        rss = read_rss()
+        if rss > self.peak:
+            self.peak = rss
+        return self.peak
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class MemoryStats:
+    __slots__ = ("rss_peak", "rss_retained", "py_peak", "py_retained")
+
+    def __init__(self):
+        self.rss_peak = 0
+        self.rss_retained = 0
+        self.py_peak = 0
+        self.py_retained = 0
+
+    def update(self, rss_peak, rss_retained, py_peak, py_retained):
+        # 同一阶段多次出现时，峰值取最大值，残留累加
+        self.rss_peak = max(self.rss_peak, rss_peak)
+        self.rss_retained += rss_retained
+        self.py_peak = max(self.py_peak, py_peak)
+        self.py_retained += py_retained
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class MemoryProfiler(StageProfiler):
+    """
+    在 StageProfiler 的基础上记录内存；各阶段的峰值为相对阶段开始时的增量
+    """
+
+    def __init__(self, top_n=0, budget=None, sample_interval=0.002):
+        """
+        :param top_n: 为最慢的N张图片保存 cProfile 数据
+        :param budget: 单张图片的内存预算（字节），峰值超出的图片会被标记
+        :param sample_interval: RSS采样间隔（秒）
+        """
+        super().__init__(top_n)
+        self.budget = budget
+        tracemalloc.start()
+        self.sampler = RssSampler(sample_interval)
+        # 每层阶段一项: [开始时RSS, 开始时Python内存, RSS峰值下限, Python峰值下限]
+        self._stack = []
+        self._image_start = None
+        self._image_peak = 0
+        self._image_py_peak = 0
+
+    # ---- 阶段 ----
+
+    def _save_peaks(self):
+        """
+        进入新阶段前保存外层阶段和当前图片到目前为止的峰值
+        采样器和 tracemalloc 只有一个峰值，进入新阶段时会被重置
+        """
+        rss_peak = self.sampler.read_peak()
+        py_peak = tracemalloc.get_traced_memory()[1]
+        if self._stack:
+            parent = self._stack[-1]
+            parent[2] = max(parent[2], rss_peak)
+            parent[3] = max(parent[3], py_peak)
+        if self._image_start is not None:
+            self._image_peak = max(self._image_peak, rss_peak)
+            self._image_py_peak = max(self._image_py_peak, py_peak)
+
+    def on_stage_enter(self, timer):
+        self._save_peaks()
+        tracemalloc.reset_peak()
+        rss = self.sampler.reset()
+        py_current = tracemalloc.get_traced_memory()[0]
+        self._stack.append([rss, py_current, rss, py_current])
+
+    def on_stage_exit(self, timer):
+        super().on_stage_exit(timer)
+        rss_start, py_start, rss_floor, py_floor = self._stack.pop()
+        rss_peak = max(self.sampler.read_peak(), rss_floor)
+        py_current, py_peak = tracemalloc.get_traced_memory()
+        py_peak = max(py_peak, py_floor)
+
+        record = self.current or self.outside
+        memory = record.extra.setdefault("memory_stages", {})
+        stats = memory.get(timer.name)
+        if stats is None:
+            stats = memory[timer.name] = MemoryStats()
+        stats.update(rss_peak - rss_start, read_rss() - rss_start, py_peak - py_start, py_current - py_start)
+
+    # ---- 图片 ----
+
+    def begin_image(self, name):
+        super().begin_image(name)
+        py_current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        rss = self.sampler.reset()
+        self._image_start = (rss, py_current)
+        self._image_peak = rss
+        self._image_py_peak = py_current
+
+    def end_image(self):
+        record = self.current
+        if record is not None and self._image_start is not None:
+            self._save_peaks()
+            rss_start, py_start = self._image_start
+            rss_peak = self._image_peak - rss_start
+            stages = record.extra.pop("memory_stages", {})
+            record.extra["memory"] = {
+                "rss_start": rss_start,
+                "rss_peak": rss_peak,
+                "rss_retained": read_rss() - rss_start,
+                "py_peak": self._image_py_peak - py_start,
+                "py_retained": tracemalloc.get_traced_memory()[0] - py_start,
+                "stages": {name: stats.to_dict() for name, stats in stages.items()}
+            }
+            # 由解码阶段记录的像素数得到图片尺寸，用于拟合内存模型
+            decode = record.stages.get("decode")
+            record.extra["pixels"] = decode.pixels if decode else 0
+            record.extra["over_budget"] = bool(self.budget and rss_peak > self.budget)
+        self._image_start = None
+        super().end_image()
+
+    def stop(self):
+        """停止采样和 tracemalloc"""
+        self.sampler.stop()
+        tracemalloc.stop()
+
+    # ---- 汇总与输出 ----
+
+    def over_budget(self):
+        """峰值超出预算的图片"""
+        return [record for record in self.images if record.extra.get("over_budget")]
+
+    def stage_peaks(self):
+        """各阶段在所有图片中的最大峰值和平均残留"""
+        peaks = {}
+        for record in self.images:
+            for name, stats in record.extra.get("memory", {}).get("stages", {}).items():
+                entry = peaks.setdefault(name, {"rss_peak": 0, "py_peak": 0, "rss_retained": 0, "count": 0})
+                entry["rss_peak"] = max(entry["rss_peak"], stats["rss_peak"])
+                entry["py_peak"] = max(entry["py_peak"], stats["py_peak"])
+                entry["rss_retained"] += stats["rss_retained"]
+                entry["count"] += 1
+        return dict(sorted(peaks.items(), key=lambda item: _stage_rank(item[0])))
+
+    def format_summary(self):
+        lines = [super().format_summary(), "", "内存:"]
+        lines.append(f"{'阶段':<10} {'RSS峰值':>10} {'Python峰值':>11} {'平均残留':>10}")
+        for name, entry in self.stage_peaks().items():
+            retained = entry["rss_retained"] / entry["count"] if entry["count"] else 0
+            lines.append(f"{name:<10} {_mb(entry['rss_peak']):>10} {_mb(entry['py_peak']):>11} {_mb(retained):>10}")
+
+        model = self.fit_model()
+        if model:
+            lines.append(f"内存模型: 每像素 {model['bytes_per_pixel']:.1f} 字节 "
+                         f"(每百万像素 {_mb(model['bytes_per_pixel'] * 1e6)}), "
+                         f"固定开销 {_mb(model['intercept'])}, 基于 {model['samples']} 张图片")
+            for mode, mode_model in model["modes"].items():
+                lines.append(f"  {mode:<6} 每像素 {mode_model['bytes_per_pixel']:.1f} 字节, "
+                             f"最大低估 {_mb(mode_model['max_error'])}, 基于 {mode_model['samples']} 张图片")
+        flagged = self.over_budget()
+        if flagged:
+            lines.append(f"超出内存预算 {_mb(self.budget)} 的图片:")
+            for record in flagged:
+                lines.append(f"  {record.name}: 峰值 {_mb(record.extra['memory']['rss_peak'])}")
+        return "\n".join(lines)
+
+    def fit_model(self):
+        """
+        按图片拟合 峰值 = 固定开销 + 每像素字节数 * 像素数
+        除整体模型外，样本足够的图像模式（RGB、RGBA等）各自拟合一个模型
+        """
+        samples = []
+        by_mode = {}
+        for record in self.images:
+            if record.extra.get("pixels"):
+                sample = (record.extra["pixels"], record.extra["memory"]["rss_peak"])
+                samples.append(sample)
+                by_mode.setdefault(record.extra.get("mode"), []).append(sample)
+        model = fit_memory_model(samples)
+        if model:
+            model["modes"] = {mode: fit_memory_model(items) for mode, items in by_mode.items()
+                              if mode and len(items) >= MIN_MODE_SAMPLES}
+        return model
+
+    def to_dict(self):
+        result = super().to_dict()
+        result["memory_model"] = self.fit_model()
+        result["budget"] = self.budget
+        result["over_budget"] = [record.name for record in self.over_budget()]
+        return result
+
+    def write_reports(self, directory, prefix="profile"):
+        paths = super().write_reports(directory, prefix)
+        model = self.fit_model()
+        if model:
+            model_path = os.path.join(directory, "memory_model.json")
+            save_memory_model(model, model_path)
+            paths.append(model_path)
+        return paths
+
+
+def fit_memory_model(samples):
+    """
+    最小二乘拟合内存模型
+    :param samples: [(像素数, 峰值字节数)]
+    :return: {"bytes_per_pixel", "intercept", "samples", "max_error"}，样本不足时返回None
+    """
+    if not samples:
+        return None
+    n = len(samples)
+    mean_x = sum(x for x, _ in samples) / n
+    mean_y = sum(y for _, y in samples) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in samples)
+    if var_x == 0:
+        # 所有图片尺寸相同，只能得到比例
+        slope = mean_y / mean_x if mean_x else 0.0
+        intercept = 0.0
+    else:
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in samples) / var_x
+        intercept = max(0.0, mean_y - slope * mean_x)
+    # 模型低估的最大值，调度时可作为安全余量
+    max_error = max(0.0, max(y - (intercept + slope * x) for x, y in samples))
+    return {
+        "bytes_per_pixel": slope,
+        "intercept": intercept,
+        "max_error": max_error,
+        "samples": n,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def save_memory_model(model, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(model, f, ensure_ascii=False, indent=2)
+
+
+def load_memory_model(path):
+    """
+    读取内存模型
+    :return: 模型字典，文件不存在或格式错误时返回None
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            model = json.load(f)
+        float(model["bytes_per_pixel"])
+        float(model["intercept"])
+        return model
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def estimate_from_model(model, pixels, mode=None):
+    """
+    按内存模型估算一张图片的峰值内存
+    :param model: load_memory_model 返回的模型
+    :param pixels: 像素数
+    :param mode: 图像模式，模型中有该模式时使用该模式的拟合结果
+    :return: 字节数（包含安全余量）
+    """
+    model = model.get("modes", {}).get(mode) or model
+    return int(model["intercept"] + model["bytes_per_pixel"] * pixels + model.get("max_error", 0))
+
+
+def _mb(value):
+    return f"{value / 1024 / 1024:.1f}MB"
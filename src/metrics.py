@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+运行指标 - 进程内的计数器、仪表和直方图，可通过本机HTTP接口以Prometheus文本格式导出，
+也可定期写入JSON快照文件
+
+未启用时 get_registry() 返回None，调用方跳过所有记录。启用后每次记录只是加锁后修改几个数字。
+
+    registry = metrics.enable()
+    images = registry.counter("watermark_images_total", "处理的图片数", {"result": "ok"})
+    images.inc()
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+
+# 耗时直方图的默认分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 当前启用的注册表，None 表示未启用
+_registry = None
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """导出时调用 function() 取值，用于队列长度、RSS等随时可读的量"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: 各分桶的上限，按升序排列
+        """
+        self.buckets = tuple(buckets)
+        # 最后一项为 +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        result = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            result.append((name + "_bucket", labels + (("le", _format_value(bound)),), cumulative))
+        result.append((name + "_sum", labels, total))
+        result.append((name + "_count", labels, count))
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "buckets": dict(zip([_format_value(b) for b in self.buckets] + ["+Inf"], self.counts))
+            }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        # 名称 -> {"kind", "help", "children": {标签元组: 指标}}
+        self.families = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = {"kind": cls.kind, "help": help_text, "children": {}}
+            elif family["kind"] != cls.kind:
+                raise ValueError(f"指标 {name} 已注册为 {family['kind']}")
+            metric = family["children"].get(key)
+            if metric is None:
+                metric = family["children"][key] = cls(**kwargs)
+        return metric
+
+    def counter(self, name, help_text="", labels=None):
+        """获取或创建计数器；同名不同标签的计数器属于同一个指标"""
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", labels=None):
+        """获取或创建仪表"""
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", labels=None, buckets=LATENCY_BUCKETS):
+        """获取或创建直方图，同名直方图的分桶以第一次创建时为准"""
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render_prometheus(self):
+        """按Prometheus文本格式导出所有指标"""
+        lines = []
+        with self._lock:
+            families = [(name, dict(family, children=dict(family["children"])))
+                        for name, family in sorted(self.families.items())]
+        for name, family in families:
+            if family["help"]:
+                lines.append(f"# HELP {name} {_escape_help(family['help'])}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for labels, metric in family["children"].items():
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    lines.append(f"{sample_name}{_format_labels(sample_labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """所有指标的当前值，可直接序列化为JSON"""
+        with self._lock:
+            families = [(name, family["kind"], dict(family["children"]))
+                        for name, family in sorted(self.families.items())]
+        result = {}
+        for name, kind, children in families:
+            result[name] = {
+                "type": kind,
+                "values": [{"labels": dict(labels), "value": metric.snapshot()}
+                           for labels, metric in children.items()]
+            }
+        return {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "uptime": time.time() - self.started,
+            "metrics": result
+        }
+
+    def write_snapshot(self, path):
+        """写入JSON快照，先写临时文件再替换，读取方不会读到写了一半的文件"""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+
+
+class LabeledCounter:
+    def __init__(self, registry, name, help_text, label):
+        """
+        按一个标签的不同取值分别计数，注册表为None时不做任何事
+        :param registry: 指标注册表，可以为None
+        :param label: 标签名称
+        """
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.counters = {}
+
+    def inc(self, value, amount=1):
+        if self.registry is None:
+            return
+        counter = self.counters.get(value)
+        if counter is None:
+            counter = self.counters[value] = self.registry.counter(self.name, self.help_text, {self.label: value})
+        counter.inc(amount)
+
+
+class StageLatency:
+    def __init__(self, registry):
+        """
+        将各处理阶段的耗时记入 watermark_stage_seconds 直方图，可作为 StageProfiler 的 listener
+        :param registry: 指标注册表
+        """
+        self.registry = registry
+        self.histograms = {}
+
+    def __call__(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = self.registry.histogram(
+                "watermark_stage_seconds", "各处理阶段的耗时（秒）", {"stage": name})
+        histogram.observe(seconds)
+
+
+def _escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter:
+    def __init__(self, registry, port=None, snapshot_path=None, interval=10.0, host='127.0.0.1'):
+        """
+        在后台线程中导出指标
+        :param registry: 指标注册表
+        :param port: HTTP端口，GET /metrics 返回Prometheus文本；None 表示不启动
+        :param snapshot_path: JSON快照文件路径；None 表示不写快照
+        :param interval: 写快照的间隔（秒）
+        :param host: 监听地址，默认只监听本机
+        """
+        self.registry = registry
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            self.server.daemon_threads = True
+            self.server.registry = registry
+            self._start(self.server.serve_forever)
+        if snapshot_path:
+            self._start(self._snapshot_loop)
+
+    @property
+    def address(self):
+        """HTTP接口的实际地址 (host, port)，未启动时为None"""
+        return self.server.server_address if self.server else None
+
+    def _start(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _snapshot_loop(self):
+        while not self._stop.wait(self.interval):
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        try:
+            self.registry.write_snapshot(self.snapshot_path)
+        except OSError as e:
+            print(f"警告: 写入指标快照失败: {e}")
+
+    def close(self):
+        """停止导出，写入最后一次快照"""
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.snapshot_path:
+            self._write_snapshot()
+
+
+def enable(registry=None):
+    """启用指标记录，返回注册表"""
+    global _registry
+    _registry = registry or MetricsRegistry()
+    return _registry
+
+
+def disable():
+    """停用指标记录"""
+    global _registry
+    _registry = None
+
+
+def get_registry():
+    """当前启用的注册表，未启用时返回None"""
+    return _registry
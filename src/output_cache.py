@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+输出缓存 - 按内容寻址缓存已导出的水印图片
+
+缓存键由 输入文件内容哈希 + 水印设置(模板)哈希 + 编码设置 组成。
+命中时直接通过 reflink / 复制 生成输出文件，跳过解码、绘制和编码。
+缓存文件与输出文件从不共用同一个inode：输出文件之后可能被覆盖，硬链接会让缓存内容随之改变。
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from image_processor import remove_output
+
+# 渲染逻辑发生变化时递增，使旧缓存自动失效
+CACHE_VERSION = 2
+
+# Linux 下 FICLONE ioctl 编号，用于写时复制(reflink)
+FICLONE = 0x40049409
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    计算文件内容的SHA-256哈希
+    :param path: 文件路径
+    :param chunk_size: 每次读取的字节数
+    :return: 十六进制哈希字符串
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_fingerprint(settings):
+    """
+    计算水印设置的规范化哈希
+    :param settings: 水印设置字典（与模板的 settings 格式相同）
+    :return: 十六进制哈希字符串
+    """
+    canonical = json.dumps(settings, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    以最便宜的方式让 dst 拥有与 src 相同、但互相独立的内容：reflink（写时复制） > 复制
+    :param src: 源文件路径
+    :param dst: 目标文件路径
+    :return: 使用的方式 ("reflink" 或 "copy")
+    """
+    remove_output(dst)
+
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class OutputCache:
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024):
+        """
+        :param cache_dir: 缓存目录
+        :param max_size: 缓存总大小上限（字节），超出后按LRU淘汰
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file = os.path.join(cache_dir, "index.json")
+        # key -> {"file": 相对路径, "size": 字节数, "last_used": 时间戳}
+        self.entries = {}
+        # "路径|大小|修改时间" -> 内容哈希，避免重复读取未修改的输入文件
+        self.input_hashes = {}
+        self.total_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        """加载缓存索引"""
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("version") == CACHE_VERSION:
+                    self.entries = data.get("entries", {})
+                    self.input_hashes = data.get("input_hashes", {})
+        except Exception as e:
+            print(f"加载缓存索引时出错: {e}")
+            self.entries = {}
+            self.input_hashes = {}
+
+        # 丢弃索引中已不存在的缓存文件
+        for key in list(self.entries):
+            if not os.path.exists(os.path.join(self.cache_dir, self.entries[key]["file"])):
+                del self.entries[key]
+        self.total_size = sum(entry["size"] for entry in self.entries.values())
+
+    def save_index(self):
+        """原子地保存缓存索引"""
+        data = {
+            "version": CACHE_VERSION,
+            "entries": self.entries,
+            "input_hashes": self.input_hashes
+        }
+        tmp_file = self.index_file + ".tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            print(f"保存缓存索引时出错: {e}")
+
+    def input_hash(self, input_path):
+        """
+        获取输入文件的内容哈希，文件未修改时复用上次的结果
+        :param input_path: 输入文件路径
+        :return: 十六进制哈希字符串
+        """
+        st = os.stat(input_path)
+        memo_key = f"{os.path.abspath(input_path)}|{st.st_size}|{st.st_mtime_ns}"
+        digest = self.input_hashes.get(memo_key)
+        if digest is None:
+            digest = hash_file(input_path)
+            self.input_hashes[memo_key] = digest
+        return digest
+
+    def make_key(self, input_path, settings, encoder_settings):
+        """
+        生成缓存键
+        :param input_path: 输入图像路径
+        :param settings: 水印设置字典
+        :param encoder_settings: 编码设置字典（格式、质量等）
+        :return: 缓存键
+        """
+        parts = {
+            "version": CACHE_VERSION,
+            "input": self.input_hash(input_path),
+            "settings": settings_fingerprint(settings),
+            "encoder": encoder_settings
+        }
+        return settings_fingerprint(parts)
+
+    def _entry_path(self, key, ext=""):
+        return os.path.join(key[:2], key + ext)
+
+    def fetch(self, key, output_path):
+        """
+        尝试用缓存内容生成输出文件
+        :param key: 缓存键
+        :param output_path: 输出文件路径
+        :return: 是否命中
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            cached_path = os.path.join(self.cache_dir, entry["file"])
+            try:
+                link_or_copy(cached_path, output_path)
+                entry["last_used"] = time.time()
+                self.hits += 1
+                self.bytes_saved += entry["size"]
+                return True
+            except OSError as e:
+                print(f"读取缓存 {cached_path} 时出错: {e}")
+                self._remove(key)
+
+        self.misses += 1
+        return False
+
+    def store(self, key, output_path):
+        """
+        将新生成的输出文件加入缓存
+        :param key: 缓存键
+        :param output_path: 已生成的输出文件路径
+        """
+        ext = os.path.splitext(output_path)[1].lower()
+        rel_path = self._entry_path(key, ext)
+        cached_path = os.path.join(self.cache_dir, rel_path)
+        try:
+            os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+            link_or_copy(output_path, cached_path)
+        except OSError as e:
+            print(f"写入缓存 {cached_path} 时出错: {e}")
+            return
+
+        if key in self.entries:
+            self.total_size -= self.entries[key]["size"]
+        size = os.path.getsize(cached_path)
+        self.entries[key] = {"file": rel_path, "size": size, "last_used": time.time()}
+        self.total_size += size
+        self.stores += 1
+        self.evict()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_size -= entry["size"]
+        try:
+            os.remove(os.path.join(self.cache_dir, entry["file"]))
+        except OSError:
+            pass
+
+    def evict(self):
+        """按最近最少使用顺序淘汰缓存，直到总大小不超过上限"""
+        if self.total_size <= self.max_size:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"]):
+            if self.total_size <= self.max_size:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def get_stats(self):
+        """获取缓存命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "bytes_saved": self.bytes_saved,
+            "entries": len(self.entries),
+            "total_size": self.total_size
+        }
+
+    def format_stats(self):
+        """格式化缓存统计信息"""
+        stats = self.get_stats()
+        return (f"缓存命中 {stats['hits']}/{stats['hits'] + stats['misses']} "
+                f"({stats['hit_rate']:.1%}), 淘汰 {stats['evictions']} 项, "
+                f"缓存大小 {stats['total_size'] / 1024 / 1024:.1f} MB")
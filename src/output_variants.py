@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+输出规格 - 一次解码生成多个尺寸、格式的输出
+
+每个规格写作 "最大边长:格式:编码配置:文件名后缀"，省略的字段使用默认值:
+
+    full                     原尺寸，格式和编码配置与其他参数相同
+    2048:webp::_web          长边缩小到2048像素的WebP，文件名加 _web
+    400:jpeg:fast:_thumb     长边400像素的JPEG缩略图，使用 fast 编码配置
+
+最大边长为 full 或 0 表示不缩放；不会放大小于最大边长的图片。
+"""
+
+import os
+
+from encoder_profiles import ENCODER_PROFILES, OUTPUT_EXTENSIONS, OUTPUT_FORMATS, normalize_format
+
+
+def parse_variant(spec):
+    """
+    解析一个输出规格
+    :param spec: "最大边长:格式:编码配置:文件名后缀"
+    :return: 字典 {"max_size", "format", "profile", "suffix"}，未指定的字段为None或空字符串
+    """
+    fields = spec.split(":")
+    if len(fields) > 4:
+        raise ValueError(f"输出规格最多包含4个字段: {spec}")
+    fields += [""] * (4 - len(fields))
+    size, output_format, profile, suffix = fields
+
+    if size.lower() in ("", "full", "0"):
+        max_size = None
+    else:
+        try:
+            max_size = int(size)
+        except ValueError:
+            raise ValueError(f"最大边长必须是正整数或 full: {spec}")
+        if max_size < 1:
+            raise ValueError(f"最大边长必须是正整数或 full: {spec}")
+
+    output_format = normalize_format(output_format)
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式 {fields[1]}: {spec}")
+    if profile and profile not in ENCODER_PROFILES:
+        raise ValueError(f"未知的编码配置 {profile}: {spec}")
+    if os.sep in suffix or "/" in suffix:
+        raise ValueError(f"文件名后缀不能包含路径分隔符: {spec}")
+
+    return {"max_size": max_size, "format": output_format, "profile": profile or None, "suffix": suffix}
+
+
+def variant_size(size, max_size, scale=None):
+    """
+    按最大边长或缩放比例等比缩小后的尺寸，不放大；两者都指定时取较小的结果
+    :param size: 原图尺寸 (width, height)
+    :param max_size: 最大边长，None 表示不限制
+    :param scale: 缩放比例 (0, 1]，None 表示不缩放
+    :return: (width, height)
+    """
+    width, height = size
+    factor = 1.0
+    if max_size is not None and max(width, height) > max_size:
+        factor = max_size / max(width, height)
+    if scale is not None:
+        factor = min(factor, scale)
+    if factor >= 1:
+        return size
+    return max(1, round(width * factor)), max(1, round(height * factor))
+
+
+def parse_output_size(text):
+    """
+    解析输出尺寸文本
+    :param text: 空或"原尺寸"表示不缩放，"2048" 表示长边最大像素数，"50%" 或 "0.5" 表示缩放比例
+    :return: {"max_size", "scale"}
+    """
+    text = text.strip()
+    if text in ("", "原尺寸", "full"):
+        return {"max_size": None, "scale": None}
+    if text.endswith("%"):
+        scale = float(text[:-1]) / 100
+    elif text.isdigit():
+        max_size = int(text)
+        if max_size < 1:
+            raise ValueError(f"最大边长必须是正整数: {text}")
+        return {"max_size": max_size, "scale": None}
+    else:
+        scale = float(text)
+    if not 0 < scale <= 1:
+        raise ValueError(f"缩放比例必须在0到1之间: {text}")
+    return {"max_size": None, "scale": scale}
+
+
+def variant_output_name(name, variant, output_format=None):
+    """
+    输出文件名：原文件名加后缀，指定格式时扩展名随之改变
+    :param name: 输入文件名
+    :param variant: parse_variant 的返回值
+    :param output_format: 规格未指定格式时使用的格式，None 表示与输入相同
+    """
+    base, ext = os.path.splitext(name)
+    output_format = variant["format"] or output_format
+    if output_format:
+        ext = OUTPUT_EXTENSIONS[output_format]
+    return base + variant["suffix"] + ext
+
+
+def check_output_names(variants, output_format=None):
+    """
+    检查各规格的输出文件名不会互相覆盖
+    :param variants: [(规格字符串, parse_variant 的返回值), ...]
+    :param output_format: 规格未指定格式时使用的格式
+    :raise ValueError: 两个规格对某些输入会生成相同的文件名
+    """
+    for i, (spec, variant) in enumerate(variants):
+        for other_spec, other in variants[:i]:
+            if variant["suffix"] != other["suffix"]:
+                continue
+            formats = (variant["format"] or output_format, other["format"] or output_format)
+            # 未指定格式时扩展名与输入相同，可能与另一个规格的格式一致
+            if None in formats or formats[0] == formats[1]:
+                raise ValueError(f"输出规格 {other_spec} 和 {spec} 的文件名可能相同，请使用不同的后缀")
@@ -5,20 +5,132 @@
 PhotoWaterMark - 根据图像EXIF元数据向图片添加文本水印
 """
 
+import atexit
+from collections import deque
 import os
 import sys
 
+from PIL import Image
+
 # 导入项目模块
-from command_line_parser import parse_arguments
-from exif_extractor import extract_date_from_exif, get_file_modification_date
-from image_processor import get_supported_images, create_output_directory, process_image
+from command_line_parser import (parse_arguments, parse_watch_arguments, parse_serve_arguments,
+                                 parse_stream_arguments)
+from exif_extractor import extract_camera_from_exif, extract_date_from_exif, get_file_modification_date
+from image_processor import get_supported_images, create_output_directory, process_image, process_image_variants
+from output_cache import OutputCache
+from batch_journal import BatchJournal, JOURNAL_NAME
+from archive_io import is_archive, default_output_path, archive_main
+from watermark_handler import WatermarkHandler, expand_template, layers_fingerprint, needed_fields
+from encoder_profiles import OUTPUT_EXTENSIONS, normalize_format
+from output_variants import variant_output_name
+from isolated_pool import QUARANTINE_REPORT, QuarantineReport
+import profiling
+from memory_profiler import MemoryProfiler, load_memory_model, read_rss
+import metrics
+from worker_pool import WatermarkWorkerPool
+
+def configure_engine(args):
+    """
+    按命令行参数设置当前进程的处理引擎，工作进程池会沿用这些设置
+    :param args: 解析后的参数对象
+    """
+    if args.memory_budget:
+        WatermarkHandler.set_memory_budget(args.memory_budget * 1024 * 1024)
+
+    WatermarkHandler.set_encoder(args.encoder_profile, args.quality, args.lossless)
+    try:
+        WatermarkHandler.set_output_size(args.max_size, args.scale)
+    except ValueError as e:
+        print(f"错误: {e}")
+        sys.exit(1)
+
+    memory_model = None
+    if args.memory_model:
+        memory_model = load_memory_model(args.memory_model)
+        if memory_model is None:
+            print(f"错误: 无法读取内存模型 {args.memory_model}")
+            sys.exit(1)
+    memory_limit = args.max_memory * 1024 * 1024 if args.max_memory is not None else None
+    WatermarkWorkerPool.configure_memory(memory_limit, memory_model)
+    WatermarkWorkerPool.configure_isolation(
+        task_timeout=args.task_timeout or None,
+        max_tasks_per_worker=args.max_tasks_per_worker or None,
+        max_worker_rss=args.max_worker_rss * 1024 * 1024 or None
+    )
+
+def configure_metrics(args):
+    """
+    按命令行参数启用运行指标，进程退出时写入最后一次快照
+    :param args: 解析后的参数对象
+    :return: 指标注册表，未启用时为None
+    """
+    if args.metrics_port is None and not args.metrics_file:
+        return None
+    registry = metrics.enable()
+    registry.gauge("process_resident_memory_bytes", "主进程RSS（字节）").set_function(read_rss)
+    try:
+        exporter = metrics.MetricsExporter(registry, args.metrics_port, args.metrics_file, args.metrics_interval)
+    except OSError as e:
+        print(f"错误: 无法启动指标接口: {e}")
+        sys.exit(1)
+    atexit.register(exporter.close)
+    if exporter.address:
+        # 流式模式的标准输出是图片数据，提示信息输出到标准错误
+        print(f"运行指标: http://{exporter.address[0]}:{exporter.address[1]}/metrics", file=sys.stderr)
+    return registry
 
 def main():
     """
     主函数
     """
+    # 监视模式: photowatermark watch <dir>
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        from folder_watcher import watch_main
+        args = parse_watch_arguments(sys.argv[2:])
+        configure_engine(args)
+        configure_metrics(args)
+        watch_main(args)
+        return
+
+    # 服务模式: photowatermark serve
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from watermark_server import serve_main
+        args = parse_serve_arguments(sys.argv[2:])
+        configure_engine(args)
+        configure_metrics(args)
+        serve_main(args)
+        return
+
+    # 流式模式: photowatermark stream < input > output
+    if len(sys.argv) > 1 and sys.argv[1] == 'stream':
+        from stream_processor import stream_main
+        args = parse_stream_arguments(sys.argv[2:])
+        configure_engine(args)
+        configure_metrics(args)
+        stream_main(args)
+        return
+
     # 解析命令行参数
     args = parse_arguments()
+    configure_engine(args)
+    registry = configure_metrics(args)
+
+    # 输入或输出为压缩包时直接流式读写，不解压到磁盘
+    if is_archive(args.input_directory) or (args.output and is_archive(args.output)):
+        if args.variant:
+            print("错误: --variant 只支持输出到目录")
+            sys.exit(1)
+        # 压缩包模式不记录处理进度，也不使用输出缓存
+        if args.resume:
+            print("错误: --resume 只支持从目录输入并输出到目录，压缩包模式每次完整处理")
+            sys.exit(1)
+        if args.cache_dir:
+            print("错误: --cache-dir 只支持从目录输入并输出到目录")
+            sys.exit(1)
+        if args.profile or args.profile_memory:
+            print("警告: 压缩包模式在工作进程中处理图片，不支持 --profile")
+        archive_main(args, args.output or default_output_path(args.input_directory))
+        return
 
     # 获取输入目录中的图像文件
     images = get_supported_images(args.input_directory)
@@ -30,49 +142,232 @@ def main():
     print(f"找到 {len(images)} 个图像文件")
 
     # 创建输出目录
-    output_directory = create_output_directory(args.input_directory)
+    if args.output:
+        output_directory = args.output
+        os.makedirs(output_directory, exist_ok=True)
+    else:
+        output_directory = create_output_directory(args.input_directory, clean=not args.resume)
     print(f"创建输出目录: {output_directory}")
 
-    # 处理每个图像文件
-    processed_count = 0
-    for image_name in images:
-        input_path = os.path.join(args.input_directory, image_name)
+    # 记录已完成的图片，用于断点续传
+    journal = BatchJournal(os.path.join(output_directory, JOURNAL_NAME))
+    output_format = normalize_format(args.format)
+    job = {
+        "font_size": args.font_size,
+        "font_color": args.font_color,
+        "position": args.position,
+        "format": output_format,
+        "encoder": WatermarkHandler().get_encoder()
+    }
+    if args.text:
+        job["text"] = args.text
+    if args.layers:
+        job["layers"] = layers_fingerprint(args.layers)
+    variants = [variant for _, variant in args.variant or []]
+    output_size = WatermarkHandler().get_output_size()
+    if variants:
+        job["variants"] = [spec for spec, _ in args.variant]
+        if any(output_size.values()):
+            print("警告: 指定 --variant 时按各规格的最大边长输出，忽略 --max-size 和 --scale")
+            output_size = {"max_size": None, "scale": None}
+    if any(output_size.values()):
+        job["output_size"] = output_size
+    resumable = journal.start(job, resume=args.resume)
+    if resumable:
+        print(f"断点续传: 上次已完成 {resumable} 个输出文件")
 
-        # 提取EXIF日期
-        date_str = extract_date_from_exif(input_path)
+    # 启用输出缓存
+    cache = None
+    if args.cache_dir:
+        cache = OutputCache(args.cache_dir, args.cache_size * 1024 * 1024)
 
-        # 如果没有EXIF日期，使用文件修改日期
-        if not date_str:
-            date_str = get_file_modification_date(input_path)
-            if date_str:
-                print(f"警告: {image_name} 缺少EXIF日期信息，使用文件修改日期: {date_str}")
-            else:
-                print(f"错误: 无法获取 {image_name} 的日期信息")
-                continue
-        else:
-            print(f"提取 {image_name} 的EXIF日期: {date_str}")
+    # 性能分析
+    profiler = None
+    if args.profile_memory:
+        budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+        profiler = profiling.enable(MemoryProfiler(top_n=args.profile_top, budget=budget))
+    elif args.profile:
+        profiler = profiling.enable(profiling.StageProfiler(top_n=args.profile_top))
+
+    # 运行指标：各阶段耗时来自分析器，未启用性能分析时只记录阶段耗时，不改变读写方式
+    image_results = metrics.LabeledCounter(registry, "watermark_images_total", "处理的图片数", "result")
+    cache_lookups = metrics.LabeledCounter(registry, "watermark_cache_lookups_total", "输出缓存查询次数", "result")
+    if registry:
+        registry.gauge("watermark_batch_images", "本批次的图片总数").set(len(images))
+        recorder = profiler or profiling.enable(profiling.StageProfiler(split_io=False))
+        recorder.listeners.append(metrics.StageLatency(registry))
 
-        # 生成输出路径
-        output_path = os.path.join(output_directory, image_name)
+    # 水印文本模板及所有图层用到的字段，每张图片只提取需要的字段
+    template = args.text or "{date}"
+    needed = needed_fields(template, args.layers)
 
-        # 添加水印
-        success = process_image(
-            input_path,
-            output_path,
-            date_str,
-            args.font_size,
-            args.font_color,
-            args.position
-        )
+    # 在工作进程中处理图片，超时、崩溃或内存失控的图片被隔离，不影响整个批次；
+    # 性能分析需要记录主进程中的各阶段，此时在主进程中逐张处理
+    pool = None
+    if profiler:
+        print("提示: 性能分析时在主进程中处理图片，不使用 --task-timeout 等隔离设置")
+    else:
+        memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+        pool = WatermarkWorkerPool(args.workers, args.font_size, memory_budget)
+    quarantine = QuarantineReport()
+    pending = deque()
+    processed_count = 0
+
+    def finish(image_name, input_path, output_paths, cache_keys, success):
+        """记录一张图片的处理结果，success 为是否成功或工作进程中的异常"""
+        nonlocal processed_count
+        if isinstance(success, BaseException):
+            quarantine.add(image_name, success)
+            print(f"错误: 处理图像 {input_path} 时出错: {success}")
+            success = False
+
+        if success and cache_keys:
+            with profiling.stage("cache"):
+                for cache_key, output_path in zip(cache_keys, output_paths):
+                    cache.store(cache_key, output_path)
 
         if success:
+            for output_path in output_paths:
+                journal.record(input_path, output_path)
             processed_count += 1
             print(f"成功处理: {image_name}")
+            image_results.inc("ok")
         else:
             print(f"处理失败: {image_name}")
+            image_results.inc("failed")
+
+    def finish_next():
+        image_name, input_path, output_paths, cache_keys, future = pending.popleft()
+        try:
+            success = future.result()
+        except Exception as e:
+            success = e
+        finish(image_name, input_path, output_paths, cache_keys, success)
+
+    # 处理每个图像文件
+    try:
+        for image_name in images:
+            input_path = os.path.join(args.input_directory, image_name)
+            if variants:
+                output_names = [variant_output_name(image_name, variant, output_format) for variant in variants]
+            else:
+                output_name = image_name
+                if output_format:
+                    output_name = os.path.splitext(image_name)[0] + OUTPUT_EXTENSIONS[output_format]
+                output_names = [output_name]
+            output_paths = [os.path.join(output_directory, name) for name in output_names]
+            if profiler:
+                profiler.begin_image(image_name)
+
+            # 跳过上次已完成的图片
+            if all(journal.is_done(input_path, output_path) for output_path in output_paths):
+                processed_count += 1
+                image_results.inc("skipped")
+                continue
+
+            fields = {"date": None, "filename": image_name, "camera": None}
+            if "date" in needed:
+                # 提取EXIF日期
+                with profiling.stage("exif"):
+                    date_str = extract_date_from_exif(input_path)
+
+                # 如果没有EXIF日期，使用文件修改日期
+                if not date_str:
+                    date_str = get_file_modification_date(input_path)
+                    if date_str:
+                        print(f"警告: {image_name} 缺少EXIF日期信息，使用文件修改日期: {date_str}")
+                    else:
+                        print(f"错误: 无法获取 {image_name} 的日期信息")
+                        image_results.inc("failed")
+                        continue
+                else:
+                    print(f"提取 {image_name} 的EXIF日期: {date_str}")
+                fields["date"] = date_str
+            if "camera" in needed:
+                with profiling.stage("exif"):
+                    fields["camera"] = extract_camera_from_exif(input_path)
+
+            # 查询输出缓存，所有输出规格都命中时才跳过解码
+            cache_keys = []
+            if cache:
+                handler = WatermarkHandler()
+                hit = True
+                for i, output_path in enumerate(output_paths):
+                    settings = {
+                        "watermark_text": expand_template(template, fields),
+                        "font_size": args.font_size,
+                        "font_color": args.font_color,
+                        "position": args.position
+                    }
+                    if any(output_size.values()):
+                        settings["output_size"] = output_size
+                    if args.layers:
+                        settings["layers"] = job["layers"]
+                        settings["fields"] = fields
+                    encoder = handler.get_encoder()
+                    if variants:
+                        settings["max_size"] = variants[i]["max_size"]
+                        encoder["profile"] = variants[i]["profile"] or encoder["profile"]
+                    image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+                    with profiling.stage("cache"):
+                        cache_keys.append(cache.make_key(
+                            input_path, settings, handler.encoder_fingerprint(image_format, encoder)))
+                        hit = hit and cache.fetch(cache_keys[-1], output_path)
+                cache_lookups.inc("hit" if hit else "miss")
+                if hit:
+                    for output_path in output_paths:
+                        journal.record(input_path, output_path)
+                    processed_count += 1
+                    print(f"缓存命中: {image_name}")
+                    image_results.inc("cached")
+                    continue
+
+            # 添加水印
+            if variants:
+                task = (process_image_variants, input_path, output_paths, variants, template, args.font_size,
+                        args.font_color, args.position, output_format, args.layers, fields)
+            else:
+                task = (process_image, input_path, output_paths[0], template, args.font_size,
+                        args.font_color, args.position, args.layers, fields)
+            if pool is None:
+                finish(image_name, input_path, output_paths, cache_keys, task[0](*task[1:]))
+                continue
+
+            # 按输入顺序记录结果，最多保留两倍于工作进程数的在途图片
+            pending.append((image_name, input_path, output_paths, cache_keys,
+                            pool.submit_sized(pool.estimate(input_path), *task)))
+            while len(pending) >= pool.workers * 2:
+                finish_next()
+        while pending:
+            finish_next()
+    finally:
+        if pool:
+            pool.shutdown()
+
+    if processed_count == len(images):
+        journal.finish()
+    else:
+        # 保留日志，下次使用 --resume 时只处理失败或未完成的图片
+        journal.close()
+
+    if profiler:
+        profiler.end_image()
+        profiling.disable()
+        if args.profile_memory:
+            profiler.stop()
+        print("\n" + profiler.format_summary())
+        for path in profiler.write_reports(args.profile_dir or output_directory):
+            print(f"性能分析报告: {path}")
+
+    if cache:
+        cache.save_index()
+        print(cache.format_stats())
 
     print(f"\n处理完成! 成功处理 {processed_count}/{len(images)} 个图像文件")
     print(f"输出目录: {output_directory}")
+    report_path = args.quarantine_report or os.path.join(output_directory, QUARANTINE_REPORT)
+    if quarantine.write(report_path):
+        print(f"{len(quarantine)} 个图像被隔离（超时、崩溃或内存超限），详见: {report_path}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -7,7 +7,7 @@ PhotoWaterMark - 桌面版图片水印工具
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, colorchooser
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from PIL import Image, ImageTk
 import os
 import sys
 
@@ -20,8 +20,14 @@ except ImportError:
     print("tkinterdnd2未安装，拖拽功能不可用")
 
 # 导入水印处理器和配置管理器
-from watermark_handler import WatermarkHandler
+from watermark_handler import LOGO_DEFAULTS, TILE_DEFAULTS, WatermarkHandler, load_logo, tiled_position
 from config_manager import ConfigManager
+from output_cache import OutputCache
+from batch_journal import BatchJournal, JOURNAL_NAME
+from archive_io import ImageSink, watermark_to_sink
+from encoder_profiles import DEFAULT_PROFILE, ENCODER_PROFILES, OUTPUT_EXTENSIONS, parse_quality
+from output_variants import parse_output_size
+import profiling
 
 class PhotoWaterMarkApp:
     def __init__(self, root):
@@ -46,6 +52,17 @@ class PhotoWaterMarkApp:
         self.transparency = tk.IntVar(value=100)
         self.rotation = tk.IntVar(value=0)
         self.selected_position = tk.StringVar(value="bottomRight")  # 默认位置为右下角
+        # Logo水印
+        self.logo_enabled = tk.BooleanVar(value=False)
+        self.logo_path = tk.StringVar(value="")
+        self.logo_width = tk.IntVar(value=int(LOGO_DEFAULTS["width"] * 100))  # 占图片宽度的百分比
+        self.logo_opacity = tk.IntVar(value=LOGO_DEFAULTS["opacity"])
+        self.logo_rotation = tk.IntVar(value=LOGO_DEFAULTS["rotation"])
+        self.logo_position = tk.StringVar(value=LOGO_DEFAULTS["position"])
+        # 平铺水印：启用后忽略九宫格和手动位置，文字角度使用旋转角度
+        self.tile_enabled = tk.BooleanVar(value=False)
+        self.tile_spacing = tk.IntVar(value=TILE_DEFAULTS["spacing"])
+        self.tile_stagger = tk.BooleanVar(value=TILE_DEFAULTS["stagger"])
 
         # 位置模式管理（简单明确的方式）
         self.position_mode = "grid"  # "grid" 或 "manual"
@@ -56,10 +73,17 @@ class PhotoWaterMarkApp:
         # 导出设置
         self.output_directory = tk.StringVar()
         self.output_format = tk.StringVar(value="JPEG")
+        self.encoder_profile = tk.StringVar(value=DEFAULT_PROFILE)
+        self.encoder_quality = tk.StringVar(value="")  # ""=由编码配置决定, "keep"=沿用JPEG原图质量, 或1-100
+        self.webp_lossless = tk.BooleanVar(value=False)
+        self.output_size = tk.StringVar(value="原尺寸")  # "原尺寸"、长边像素数或缩放百分比
         self.naming_rule = tk.StringVar(value="")  # 命名规则选择：""=保留原名, "prefix"=添加前缀, "suffix"=添加后缀
         self.naming_prefix = tk.StringVar(value="wm_")  # 前缀文本，默认值为"wm_"
         self.naming_suffix = tk.StringVar(value="_watermarked")  # 后缀文本
         self.allow_overwrite = tk.BooleanVar(value=False)
+        self.use_output_cache = tk.BooleanVar(value=False)
+        self.export_to_archive = tk.BooleanVar(value=False)
+        self.profile_export = tk.BooleanVar(value=False)
 
         # 当前模板
         self.current_template = tk.StringVar(value="默认模板")
@@ -69,6 +93,7 @@ class PhotoWaterMarkApp:
 
         # 配置管理器
         self.config_manager = ConfigManager()
+        self.use_output_cache.set(self.config_manager.get_setting("use_output_cache", False))
 
         # 加载上次使用的模板
         self.load_last_template()
@@ -94,6 +119,8 @@ class PhotoWaterMarkApp:
         file_menu.add_command(label="导入图片", command=self.import_images, accelerator="Ctrl+O")
         file_menu.add_command(label="导入文件夹", command=self.import_folder, accelerator="Ctrl+Shift+O")
         file_menu.add_separator()
+        file_menu.add_command(label="恢复上次导出", command=self.resume_last_export)
+        file_menu.add_separator()
         file_menu.add_command(label="退出", command=self.root.quit, accelerator="Ctrl+Q")
 
         # 模板菜单
@@ -226,6 +253,11 @@ class PhotoWaterMarkApp:
         self.right_panel.add(self.position_frame, text="位置设置")
         self.create_position_settings()
 
+        # Logo设置标签页
+        self.logo_frame = ttk.Frame(self.right_panel)
+        self.right_panel.add(self.logo_frame, text="Logo设置")
+        self.create_logo_settings()
+
         # 导出设置标签页
         self.export_frame = ttk.Frame(self.right_panel)
         self.right_panel.add(self.export_frame, text="导出设置")
@@ -310,6 +342,89 @@ class PhotoWaterMarkApp:
         # 更新选中按钮的样式
         self.update_position_button_styles()
 
+        # 平铺水印
+        tile_frame = ttk.LabelFrame(self.position_frame, text="平铺")
+        tile_frame.grid(row=3, column=0, columnspan=3, sticky=tk.EW, padx=2, pady=(10, 2))
+        ttk.Checkbutton(tile_frame, text="在整幅图像上平铺水印", variable=self.tile_enabled,
+                        command=lambda: self.on_watermark_setting_change(None)).grid(
+            row=0, column=0, columnspan=3, sticky=tk.W, padx=5, pady=2)
+        ttk.Label(tile_frame, text="间距:").grid(row=1, column=0, sticky=tk.W, padx=5, pady=2)
+        spacing_scale = ttk.Scale(tile_frame, from_=0, to=500, variable=self.tile_spacing, orient=tk.HORIZONTAL,
+                                  command=lambda value: self.tile_spacing.set(int(float(value))))
+        spacing_scale.grid(row=1, column=1, sticky=tk.EW, padx=5, pady=2)
+        spacing_scale.bind('<ButtonRelease-1>', self.on_watermark_setting_change)
+        ttk.Label(tile_frame, textvariable=self.tile_spacing).grid(row=1, column=2, padx=5, pady=2)
+        ttk.Checkbutton(tile_frame, text="错位排列", variable=self.tile_stagger,
+                        command=lambda: self.on_watermark_setting_change(None)).grid(
+            row=2, column=0, columnspan=3, sticky=tk.W, padx=5, pady=2)
+        ttk.Label(tile_frame, text="文字角度使用水印设置中的旋转角度").grid(
+            row=3, column=0, columnspan=3, sticky=tk.W, padx=5, pady=2)
+
+    def create_logo_settings(self):
+        """创建Logo设置界面"""
+        ttk.Checkbutton(self.logo_frame, text="添加Logo水印", variable=self.logo_enabled,
+                        command=lambda: self.on_watermark_setting_change(None)).grid(
+            row=0, column=0, columnspan=3, sticky=tk.W, padx=5, pady=5)
+
+        # Logo文件
+        ttk.Label(self.logo_frame, text="Logo文件:").grid(row=1, column=0, sticky=tk.W, padx=5, pady=5)
+        ttk.Entry(self.logo_frame, textvariable=self.logo_path, width=20).grid(row=1, column=1, padx=5, pady=5)
+        ttk.Button(self.logo_frame, text="浏览", command=self.browse_logo).grid(row=1, column=2, padx=5, pady=5)
+
+        # 宽度、不透明度、旋转角度
+        sliders = [
+            ("宽度(%):", self.logo_width, 2, 100),
+            ("不透明度:", self.logo_opacity, 0, 100),
+            ("旋转角度:", self.logo_rotation, -180, 180)
+        ]
+        for row, (label, variable, low, high) in enumerate(sliders, start=2):
+            ttk.Label(self.logo_frame, text=label).grid(row=row, column=0, sticky=tk.W, padx=5, pady=5)
+            scale = ttk.Scale(self.logo_frame, from_=low, to=high, variable=variable, orient=tk.HORIZONTAL,
+                              command=lambda value, variable=variable: variable.set(int(float(value))))
+            scale.grid(row=row, column=1, sticky=tk.EW, padx=5, pady=5)
+            scale.bind('<ButtonRelease-1>', self.on_watermark_setting_change)
+            ttk.Label(self.logo_frame, textvariable=variable).grid(row=row, column=2, padx=5, pady=5)
+
+        # 位置
+        ttk.Label(self.logo_frame, text="位置:").grid(row=5, column=0, sticky=tk.W, padx=5, pady=5)
+        position_box = ttk.Combobox(self.logo_frame, textvariable=self.logo_position, state="readonly", width=12,
+                                    values=["topLeft", "top", "topRight", "left", "center", "right",
+                                            "bottomLeft", "bottom", "bottomRight"])
+        position_box.grid(row=5, column=1, sticky=tk.W, padx=5, pady=5)
+        position_box.bind('<<ComboboxSelected>>', self.on_watermark_setting_change)
+
+    def browse_logo(self):
+        """选择Logo图片"""
+        path = filedialog.askopenfilename(
+            title="选择Logo图片",
+            filetypes=[("PNG图片", "*.png"), ("所有图片", "*.png *.webp *.gif *.jpg *.jpeg")]
+        )
+        if path:
+            self.logo_path.set(path)
+            self.logo_enabled.set(True)
+            self.on_watermark_setting_change(None)
+
+    def logo_settings(self):
+        """
+        当前的Logo设置，未启用或未选择文件时返回None
+        :return: {"path", "hash", "width", "opacity", "rotation", "position"}，hash 使输出缓存随Logo内容变化
+        """
+        path = self.logo_path.get()
+        if not self.logo_enabled.get() or not path:
+            return None
+        return {
+            "path": path,
+            "hash": load_logo(path),
+            "width": self.logo_width.get() / 100,
+            "opacity": self.logo_opacity.get(),
+            "rotation": self.logo_rotation.get(),
+            "position": self.logo_position.get()
+        }
+
+    def tile_position(self):
+        """当前平铺设置对应的位置参数，文字角度使用旋转角度"""
+        return tiled_position(self.tile_spacing.get(), self.rotation.get(), self.tile_stagger.get())
+
     def set_watermark_position(self, position):
         """设置水印位置"""
         print(f"=== 按钮点击事件触发! ===")
@@ -360,17 +475,46 @@ class PhotoWaterMarkApp:
         format_frame.grid(row=1, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
         ttk.Radiobutton(format_frame, text="JPEG", variable=self.output_format, value="JPEG").pack(side=tk.LEFT)
         ttk.Radiobutton(format_frame, text="PNG", variable=self.output_format, value="PNG").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Radiobutton(format_frame, text="WebP", variable=self.output_format, value="WEBP").pack(side=tk.LEFT, padx=(10, 0))
+
+        # 编码配置
+        ttk.Label(self.export_frame, text="编码配置:").grid(row=2, column=0, sticky=tk.W, padx=5, pady=5)
+        encoder_frame = ttk.Frame(self.export_frame)
+        encoder_frame.grid(row=2, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        ttk.Combobox(encoder_frame, textvariable=self.encoder_profile, values=list(ENCODER_PROFILES),
+                     state="readonly", width=9).pack(side=tk.LEFT)
+        ttk.Label(encoder_frame, text="质量:").pack(side=tk.LEFT, padx=(10, 2))
+        ttk.Combobox(encoder_frame, textvariable=self.encoder_quality,
+                     values=["", "keep", "95", "90", "85", "80", "75"], width=5).pack(side=tk.LEFT)
+        ttk.Checkbutton(encoder_frame, text="WebP无损", variable=self.webp_lossless).pack(side=tk.LEFT, padx=(10, 0))
+
+        # 输出尺寸
+        ttk.Label(self.export_frame, text="输出尺寸:").grid(row=3, column=0, sticky=tk.W, padx=5, pady=5)
+        size_frame = ttk.Frame(self.export_frame)
+        size_frame.grid(row=3, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        ttk.Combobox(size_frame, textvariable=self.output_size,
+                     values=["原尺寸", "4096", "2048", "1024", "50%", "25%"], width=8).pack(side=tk.LEFT)
+        ttk.Label(size_frame, text="长边像素数或缩放比例").pack(side=tk.LEFT, padx=(5, 0))
 
         # 命名规则
-        ttk.Label(self.export_frame, text="命名规则:").grid(row=2, column=0, sticky=tk.W, padx=5, pady=5)
-        ttk.Radiobutton(self.export_frame, text="保留原文件名", variable=self.naming_rule, value="").grid(row=2, column=1, sticky=tk.W, padx=5, pady=2)
-        ttk.Radiobutton(self.export_frame, text="添加前缀", variable=self.naming_rule, value="prefix").grid(row=3, column=1, sticky=tk.W, padx=5, pady=2)
-        ttk.Entry(self.export_frame, textvariable=self.naming_prefix, width=15).grid(row=3, column=2, padx=5, pady=2)
-        ttk.Radiobutton(self.export_frame, text="添加后缀", variable=self.naming_rule, value="suffix").grid(row=4, column=1, sticky=tk.W, padx=5, pady=2)
-        ttk.Entry(self.export_frame, textvariable=self.naming_suffix, width=15).grid(row=4, column=2, padx=5, pady=2)
+        ttk.Label(self.export_frame, text="命名规则:").grid(row=4, column=0, sticky=tk.W, padx=5, pady=5)
+        ttk.Radiobutton(self.export_frame, text="保留原文件名", variable=self.naming_rule, value="").grid(row=4, column=1, sticky=tk.W, padx=5, pady=2)
+        ttk.Radiobutton(self.export_frame, text="添加前缀", variable=self.naming_rule, value="prefix").grid(row=5, column=1, sticky=tk.W, padx=5, pady=2)
+        ttk.Entry(self.export_frame, textvariable=self.naming_prefix, width=15).grid(row=5, column=2, padx=5, pady=2)
+        ttk.Radiobutton(self.export_frame, text="添加后缀", variable=self.naming_rule, value="suffix").grid(row=6, column=1, sticky=tk.W, padx=5, pady=2)
+        ttk.Entry(self.export_frame, textvariable=self.naming_suffix, width=15).grid(row=6, column=2, padx=5, pady=2)
 
         # 覆盖原文件夹警告
-        ttk.Checkbutton(self.export_frame, text="允许导出到原文件夹", variable=self.allow_overwrite).grid(row=5, column=0, columnspan=3, sticky=tk.W, padx=5, pady=5)
+        ttk.Checkbutton(self.export_frame, text="允许导出到原文件夹", variable=self.allow_overwrite).grid(row=7, column=0, columnspan=3, sticky=tk.W, padx=5, pady=5)
+
+        # 输出缓存
+        ttk.Checkbutton(self.export_frame, text="启用输出缓存（重复导出相同图片时直接复用）", variable=self.use_output_cache).grid(row=8, column=0, columnspan=3, sticky=tk.W, padx=5, pady=5)
+
+        # 导出为压缩包
+        ttk.Checkbutton(self.export_frame, text="导出为ZIP/TAR压缩包", variable=self.export_to_archive).grid(row=9, column=0, columnspan=3, sticky=tk.W, padx=5, pady=5)
+
+        # 性能分析
+        ttk.Checkbutton(self.export_frame, text="记录各阶段耗时（报告写入输出文件夹）", variable=self.profile_export).grid(row=10, column=0, columnspan=3, sticky=tk.W, padx=5, pady=5)
 
     def create_template_settings(self):
         """创建模板设置界面"""
@@ -436,11 +580,12 @@ class PhotoWaterMarkApp:
         file_paths = filedialog.askopenfilenames(
             title="选择图片文件",
             filetypes=[
-                ("图片文件", "*.jpg *.jpeg *.png *.bmp *.tiff *.tif"),
+                ("图片文件", "*.jpg *.jpeg *.png *.bmp *.tiff *.tif *.webp *.gif"),
                 ("JPEG文件", "*.jpg *.jpeg"),
                 ("PNG文件", "*.png"),
                 ("BMP文件", "*.bmp"),
                 ("TIFF文件", "*.tiff *.tif"),
+                ("GIF文件", "*.gif"),
                 ("所有文件", "*.*")
             ]
         )
@@ -453,11 +598,12 @@ class PhotoWaterMarkApp:
         file_path = filedialog.askopenfilename(
             title="选择图片文件",
             filetypes=[
-                ("图片文件", "*.jpg *.jpeg *.png *.bmp *.tiff *.tif"),
+                ("图片文件", "*.jpg *.jpeg *.png *.bmp *.tiff *.tif *.webp *.gif"),
                 ("JPEG文件", "*.jpg *.jpeg"),
                 ("PNG文件", "*.png"),
                 ("BMP文件", "*.bmp"),
                 ("TIFF文件", "*.tiff *.tif"),
+                ("GIF文件", "*.gif"),
                 ("所有文件", "*.*")
             ]
         )
@@ -471,7 +617,7 @@ class PhotoWaterMarkApp:
 
         if folder_path:
             # 获取文件夹中所有支持的图片文件
-            supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
+            supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp', '.gif'}
             image_files = []
 
             for filename in os.listdir(folder_path):
@@ -578,141 +724,38 @@ class PhotoWaterMarkApp:
     def add_watermark_to_preview(self, image):
         """为预览图添加水印"""
         try:
-            # 转换为RGBA模式以支持透明度
-            if image.mode != 'RGBA':
-                image = image.convert('RGBA')
-
-            # 创建一个透明图层用于绘制水印
-            txt_layer = Image.new('RGBA', image.size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(txt_layer)
-
             # 获取水印文本
             watermark_text = self.watermark_text.get()
-
-            # 尝试使用支持中文的字体
-            font_names = [
-                "simhei.ttf",      # 黑体
-                "simsun.ttc",      # 宋体
-                "msyh.ttc",        # 微软雅黑
-                "simkai.ttf",      # 楷体
-                "fangsong.ttf",    # 仿宋
-                "arial.ttf",
-                "DejaVuSans.ttf"
-            ]
-
-            font = None
-            for font_name in font_names:
-                try:
-                    font = ImageFont.truetype(font_name, self.font_size.get())
-                    print(f"成功加载字体: {font_name}")
-                    break
-                except Exception as e:
-                    print(f"无法加载字体 {font_name}: {e}")
-                    continue
-
-            # 如果所有字体都失败，使用默认字体
-            if font is None:
-                print("使用默认字体")
-                font = ImageFont.load_default()
-                # 如果默认字体也不支持中文，尝试使用系统字体
-                try:
-                    # Windows系统字体
-                    font = ImageFont.truetype("C:/Windows/Fonts/simhei.ttf", self.font_size.get())
-                    print("成功加载Windows系统黑体字体")
-                except:
-                    try:
-                        # macOS系统字体
-                        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", self.font_size.get())
-                        print("成功加载macOS系统字体")
-                    except:
-                        try:
-                            # Linux系统字体
-                            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", self.font_size.get())
-                            print("成功加载Linux系统字体")
-                        except:
-                            print("无法加载任何系统字体，使用PIL默认字体")
-
-            # 获取文本尺寸
-            bbox = draw.textbbox((0, 0), watermark_text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-
-            # 计算水印位置
-            img_width, img_height = image.size
-            margin = 10
+            font_size = self.font_size.get()
 
             # 根据模式选择位置
-            if self.position_mode == "manual":
-                # 使用手动位置
-                x = self.manual_x
-                y = self.manual_y
-                # 确保位置在图像范围内
-                x = max(0, min(x, img_width - text_width))
-                y = max(0, min(y, img_height - text_height))
+            if self.tile_enabled.get():
+                # 平铺图案按预览图尺寸缓存，只修改其他设置时不会重新生成
+                position = self.tile_position()
+            elif self.position_mode == "manual":
+                # 使用手动位置，确保位置在图像范围内
+                text_width, text_height = self.watermark_handler.get_text_size(watermark_text, font_size)
+                x = max(0, min(self.manual_x, image.width - text_width))
+                y = max(0, min(self.manual_y, image.height - text_height))
+                position = (x, y)
                 print(f"使用手动位置: ({x}, {y}), 原始: ({self.manual_x}, {self.manual_y})")
             else:
                 # 使用九宫格位置
                 position = self.grid_position
-                if position == 'topLeft':
-                    x, y = margin, margin
-                elif position == 'top':
-                    x, y = (img_width - text_width) // 2, margin
-                elif position == 'topRight':
-                    x, y = img_width - text_width - margin, margin
-                elif position == 'left':
-                    x, y = margin, (img_height - text_height) // 2
-                elif position == 'center':
-                    x, y = (img_width - text_width) // 2, (img_height - text_height) // 2
-                elif position == 'right':
-                    x, y = img_width - text_width - margin, (img_height - text_height) // 2
-                elif position == 'bottomLeft':
-                    x, y = margin, img_height - text_height - margin
-                elif position == 'bottom':
-                    x, y = (img_width - text_width) // 2, img_height - text_height - margin
-                elif position == 'bottomRight':
-                    x, y = img_width - text_width - margin, img_height - text_height - margin
-                else:
-                    x, y = img_width - text_width - margin, img_height - text_height - margin
-                print(f"使用九宫格位置: {position} -> ({x}, {y})")
-
-            # 调整透明度
-            alpha = int(255 * self.transparency.get() / 100)
-
-            # 解析颜色
-            font_color = self.font_color.get()
-            if font_color.startswith('#'):
-                # HEX颜色
-                color = tuple(int(font_color[i:i+2], 16) for i in (1, 3, 5))
-            elif font_color.lower() == 'black':
-                color = (0, 0, 0)
-            elif font_color.lower() == 'white':
-                color = (255, 255, 255)
-            elif font_color.lower() == 'red':
-                color = (255, 0, 0)
-            elif font_color.lower() == 'green':
-                color = (0, 255, 0)
-            elif font_color.lower() == 'blue':
-                color = (0, 0, 255)
-            else:
-                color = (0, 0, 0)  # 默认黑色
-
-            # 绘制水印
-            draw.text((x, y), watermark_text, font=font, fill=(*color, alpha))
-
-            # 如果有旋转，应用旋转（仅在预览中简单实现）
-            rotation = self.rotation.get()
-            if rotation != 0:
-                # 对于预览，我们简化旋转实现
-                # 创建一个新的图层用于旋转
-                rotated_layer = Image.new('RGBA', image.size, (255, 255, 255, 0))
-                rotated_watermark = txt_layer.rotate(rotation, expand=1)
-                rotated_layer.paste(rotated_watermark, (0, 0), rotated_watermark)
-                txt_layer = rotated_layer
-
-            # 合并图像和水印图层
-            watermarked = Image.alpha_composite(image, txt_layer)
-
-            return watermarked
+                print(f"使用九宫格位置: {position}")
+
+            # 字体和水印精灵图由水印处理器缓存，拖动滑块时不会重复加载
+            watermarked = self.watermark_handler.apply_text_watermark(
+                image,
+                watermark_text,
+                font_size,
+                self.font_color.get(),
+                self.transparency.get(),
+                self.rotation.get(),
+                position
+            )
+            # 缩放和不透明度处理后的Logo同样被缓存
+            return self.watermark_handler.apply_logo(watermarked, self.logo_settings())
 
         except Exception as e:
             print(f"添加水印时出错: {e}")
@@ -760,7 +803,7 @@ class PhotoWaterMarkApp:
             if files:
                 # 过滤出图片文件
                 image_files = []
-                supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
+                supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp', '.gif'}
 
                 for file_path in files:
                     # 移除可能的花括号
@@ -843,7 +886,21 @@ class PhotoWaterMarkApp:
             "position_mode": self.position_mode,
             "manual_x": self.manual_x,
             "manual_y": self.manual_y,
-            "grid_position": self.grid_position
+            "grid_position": self.grid_position,
+            "logo_enabled": self.logo_enabled.get(),
+            "logo_path": self.logo_path.get(),
+            "logo_width": self.logo_width.get(),
+            "logo_opacity": self.logo_opacity.get(),
+            "logo_rotation": self.logo_rotation.get(),
+            "logo_position": self.logo_position.get(),
+            "tile_enabled": self.tile_enabled.get(),
+            "tile_spacing": self.tile_spacing.get(),
+            "tile_stagger": self.tile_stagger.get(),
+            "output_format": self.output_format.get(),
+            "encoder_profile": self.encoder_profile.get(),
+            "encoder_quality": self.encoder_quality.get(),
+            "webp_lossless": self.webp_lossless.get(),
+            "output_size": self.output_size.get()
         }
 
         # 保存模板
@@ -957,6 +1014,30 @@ class PhotoWaterMarkApp:
             self.transparency.set(settings["transparency"])
         if "rotation" in settings:
             self.rotation.set(settings["rotation"])
+        # 导出格式和编码配置
+        if "output_format" in settings:
+            self.output_format.set(settings["output_format"])
+        if "encoder_profile" in settings:
+            self.encoder_profile.set(settings["encoder_profile"])
+        if "encoder_quality" in settings:
+            self.encoder_quality.set(settings["encoder_quality"])
+        if "webp_lossless" in settings:
+            self.webp_lossless.set(settings["webp_lossless"])
+        if "output_size" in settings:
+            self.output_size.set(settings["output_size"])
+        # Logo水印
+        for key, variable in (("logo_enabled", self.logo_enabled), ("logo_path", self.logo_path),
+                              ("logo_width", self.logo_width), ("logo_opacity", self.logo_opacity),
+                              ("logo_rotation", self.logo_rotation), ("logo_position", self.logo_position)):
+            if key in settings:
+                variable.set(settings[key])
+        # 平铺水印
+        if "tile_enabled" in settings:
+            self.tile_enabled.set(settings["tile_enabled"])
+        if "tile_spacing" in settings:
+            self.tile_spacing.set(settings["tile_spacing"])
+        if "tile_stagger" in settings:
+            self.tile_stagger.set(settings["tile_stagger"])
         # 处理位置相关信息
         if "position" in settings:
             self.selected_position.set(settings["position"])
@@ -1007,6 +1088,16 @@ class PhotoWaterMarkApp:
             messagebox.showwarning("警告", "请先导入图片")
             return
 
+        if self.export_to_archive.get():
+            archive_path = filedialog.asksaveasfilename(
+                title="保存压缩包",
+                defaultextension=".zip",
+                filetypes=[("ZIP压缩包", "*.zip"), ("TAR压缩包", "*.tar *.tar.gz *.tgz")]
+            )
+            if archive_path:
+                self.run_archive_export(archive_path, self.build_export_job())
+            return
+
         if not self.output_directory.get():
             output_dir = filedialog.askdirectory(title="选择输出文件夹")
             if not output_dir:
@@ -1021,59 +1112,226 @@ class PhotoWaterMarkApp:
                 messagebox.showwarning("警告", "为防止覆盖原图，默认禁止导出到原文件夹。\n请更改输出文件夹或启用'允许导出到原文件夹'选项。")
                 return
 
+        self.run_export(self.output_directory.get(), self.build_export_job())
+
+    def build_export_job(self):
+        """
+        根据当前设置生成导出任务描述，同时写入批处理日志用于断点续传
+        :return: 导出任务字典
+        """
+        try:
+            quality = parse_quality(self.encoder_quality.get().strip())
+        except ValueError:
+            messagebox.showwarning("警告", "质量必须是1到100之间的整数或 keep，将使用编码配置的默认质量")
+            quality = None
+        try:
+            output_size = parse_output_size(self.output_size.get())
+        except ValueError:
+            messagebox.showwarning("警告", "输出尺寸必须是长边像素数（如2048）或缩放比例（如50%），将按原尺寸导出")
+            output_size = {"max_size": None, "scale": None}
+        return {
+            "image_paths": list(self.image_paths),
+            "settings": {
+                "watermark_text": self.watermark_text.get(),
+                "font_size": self.font_size.get(),
+                "font_color": self.font_color.get(),
+                "transparency": self.transparency.get(),
+                "rotation": self.rotation.get(),
+                "position": self.tile_position() if self.tile_enabled.get() else self.selected_position.get()
+            },
+            "output_format": self.output_format.get(),
+            "encoder": {
+                "profile": self.encoder_profile.get(),
+                "quality": quality,
+                "lossless": self.webp_lossless.get()
+            },
+            "output_size": output_size,
+            "logo": self.logo_settings(),
+            "naming_rule": self.naming_rule.get(),
+            "naming_prefix": self.naming_prefix.get(),
+            "naming_suffix": self.naming_suffix.get()
+        }
+
+    def resume_last_export(self):
+        """恢复上次中断的导出"""
+        journal_path = self.config_manager.get_setting("last_export_journal")
+        if not journal_path or not os.path.exists(journal_path):
+            messagebox.showinfo("提示", "没有可以恢复的导出任务")
+            return
+
+        job = BatchJournal(journal_path).load()
+        if not job:
+            messagebox.showinfo("提示", "没有可以恢复的导出任务")
+            return
+
+        self.run_export(os.path.dirname(journal_path), job, resume=True)
+
+    def get_output_filename(self, job, input_path):
+        """
+        根据命名规则和输出格式生成输出文件名
+        :param job: 导出任务描述
+        :param input_path: 输入图片路径
+        :return: 输出文件名
+        """
+        name, ext = os.path.splitext(os.path.basename(input_path))
+
+        # 根据命名规则生成新文件名
+        naming_rule = job["naming_rule"]
+        if naming_rule == "prefix":
+            prefix = job["naming_prefix"]
+            new_name = f"{prefix}_{name}" if prefix else name
+        elif naming_rule == "suffix":
+            suffix = job["naming_suffix"]
+            new_name = f"{name}{suffix}" if suffix else name
+        else:
+            new_name = name  # 保留原文件名
+
+        # 根据输出格式设置扩展名
+        return new_name + OUTPUT_EXTENSIONS.get(job["output_format"], ".png")
+
+    def run_archive_export(self, archive_path, job):
+        """
+        将导出结果直接写入压缩包，图片由工作进程并行处理
+        :param archive_path: 输出压缩包路径
+        :param job: 导出任务描述
+        """
+        self.status_label.config(text="开始导出图片...")
+        self.progress_var.set(0)
+
+        def read_images():
+            for input_path in job["image_paths"]:
+                with open(input_path, 'rb') as f:
+                    yield self.get_output_filename(job, input_path), f.read(), None
+
+        total_images = len(job["image_paths"])
+        processed = 0
+        sink = ImageSink(archive_path)
+        try:
+            settings = dict(job["settings"], encoder=job.get("encoder"), output_size=job.get("output_size"),
+                            logo=job.get("logo"))
+            results = watermark_to_sink(read_images(), sink, settings, job["output_format"])
+            for i, (output_filename, error) in enumerate(results):
+                if error is None:
+                    processed += 1
+                    self.status_label.config(text=f"已处理: {output_filename}")
+                else:
+                    self.status_label.config(text=f"处理失败: {output_filename}")
+                self.progress_var.set((i + 1) / total_images * 100)
+                self.root.update_idletasks()
+        except Exception as e:
+            messagebox.showerror("错误", f"导出压缩包时出错: {str(e)}")
+        finally:
+            sink.close()
+
+        self.status_label.config(text=f"导出完成! 成功处理 {processed} 张图片")
+        self.progress_var.set(100)
+        messagebox.showinfo("完成", f"导出完成! 成功处理 {processed}/{total_images} 张图片\n{archive_path}")
+
+    def run_export(self, output_dir, job, resume=False):
+        """
+        执行导出任务
+        :param output_dir: 输出目录
+        :param job: 导出任务描述
+        :param resume: 是否跳过上次已完成的图片
+        """
         # 开始导出过程
         self.status_label.config(text="开始导出图片...")
         self.progress_var.set(0)
 
         # 创建输出目录（如果不存在）
-        output_dir = self.output_directory.get()
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+        # 批处理日志
+        journal_path = os.path.join(output_dir, JOURNAL_NAME)
+        journal = BatchJournal(journal_path)
+        journal.start(job, resume=resume)
+        self.config_manager.set_setting("last_export_journal", journal_path)
+
+        # 启用输出缓存
+        cache = None
+        self.config_manager.set_setting("use_output_cache", self.use_output_cache.get())
+        if self.use_output_cache.get():
+            cache_dir = self.config_manager.get_setting(
+                "output_cache_dir", os.path.join(os.path.expanduser("~"), ".photowatermark_cache"))
+            cache_size = self.config_manager.get_setting("output_cache_size_mb", 1024)
+            cache = OutputCache(cache_dir, cache_size * 1024 * 1024)
+
+        settings = job["settings"]
+        image_paths = job["image_paths"]
+        skipped = 0
+        failed = 0
+        # 续传旧版本的任务时没有编码配置，使用默认配置
+        WatermarkHandler.set_encoder(**job.get("encoder", {}))
+        WatermarkHandler.set_output_size(**job.get("output_size", {}))
+
+        # 缩小输出时尺寸是缓存键的一部分，原尺寸导出沿用以前的缓存键
+        cache_settings = settings
+        if any(job.get("output_size", {}).values()):
+            cache_settings = dict(settings, output_size=job["output_size"])
+        # Logo按内容哈希而不是路径区分
+        logo = job.get("logo")
+        if logo:
+            cache_settings = dict(cache_settings, logo={key: value for key, value in logo.items() if key != "path"})
+
+        # 性能分析
+        profiler = None
+        if self.profile_export.get():
+            profiler = profiling.enable(profiling.StageProfiler())
+
         # 处理每张图片
-        total_images = len(self.image_paths)
-        for i, input_path in enumerate(self.image_paths):
+        total_images = len(image_paths)
+        for i, input_path in enumerate(image_paths):
             try:
                 # 生成输出文件名
                 filename = os.path.basename(input_path)
-                name, ext = os.path.splitext(filename)
-
-                # 根据命名规则生成新文件名
-                naming_rule = self.naming_rule.get()
-                if naming_rule == "prefix":
-                    prefix = self.naming_prefix.get()
-                    new_name = f"{prefix}_{name}" if prefix else name
-                elif naming_rule == "suffix":
-                    suffix = self.naming_suffix.get()
-                    new_name = f"{name}{suffix}" if suffix else name
-                else:
-                    new_name = name  # 保留原文件名
+                output_format = job["output_format"]
+                output_filename = self.get_output_filename(job, input_path)
+                output_path = os.path.join(output_dir, output_filename)
+                if profiler:
+                    profiler.begin_image(filename)
 
-                # 根据输出格式设置扩展名
-                output_format = self.output_format.get()
-                if output_format == "JPEG":
-                    output_ext = ".jpg"
-                else:
-                    output_ext = ".png"
+                # 跳过上次已完成的图片
+                if journal.is_done(input_path, output_path):
+                    skipped += 1
+                    continue
 
-                output_filename = new_name + output_ext
-                output_path = os.path.join(output_dir, output_filename)
+                # 查询输出缓存
+                cache_key = None
+                if cache:
+                    with profiling.stage("cache"):
+                        cache_key = cache.make_key(input_path, cache_settings,
+                                                   self.watermark_handler.encoder_fingerprint(output_format))
+                        hit = cache.fetch(cache_key, output_path)
+                    if hit:
+                        journal.record(input_path, output_path)
+                        self.status_label.config(text=f"缓存命中: {filename}")
+                        self.progress_var.set((i + 1) / total_images * 100)
+                        self.root.update_idletasks()
+                        continue
 
                 # 添加水印并保存
                 success = self.watermark_handler.add_text_watermark(
                     input_path,
                     output_path,
-                    self.watermark_text.get(),
-                    self.font_size.get(),
-                    self.font_color.get(),
-                    self.transparency.get(),
-                    self.rotation.get(),
-                    self.selected_position.get()
+                    settings["watermark_text"],
+                    settings["font_size"],
+                    settings["font_color"],
+                    settings["transparency"],
+                    settings["rotation"],
+                    settings["position"],
+                    logo
                 )
 
+                if success and cache_key:
+                    with profiling.stage("cache"):
+                        cache.store(cache_key, output_path)
+
                 if success:
+                    journal.record(input_path, output_path)
                     self.status_label.config(text=f"已处理: {filename}")
                 else:
+                    failed += 1
                     self.status_label.config(text=f"处理失败: {filename}")
 
                 # 更新进度条
@@ -1082,11 +1340,32 @@ class PhotoWaterMarkApp:
                 self.root.update_idletasks()
 
             except Exception as e:
+                failed += 1
                 messagebox.showerror("错误", f"处理图片 {filename} 时出错: {str(e)}")
 
+        if failed:
+            # 保留日志，可通过"恢复上次导出"重新处理失败的图片
+            journal.close()
+        else:
+            journal.finish()
+            self.config_manager.set_setting("last_export_journal", None)
+
+        message = f"导出完成! 成功处理 {total_images} 张图片"
+        if skipped:
+            message += f"\n跳过上次已完成的 {skipped} 张图片"
+        if profiler:
+            profiler.end_image()
+            profiling.disable()
+            print(profiler.format_summary())
+            profiler.write_reports(output_dir)
+            message += "\n性能分析报告已写入输出文件夹 (profile.json / profile.csv)"
+        if cache:
+            cache.save_index()
+            message += "\n" + cache.format_stats()
+
         self.status_label.config(text=f"导出完成! 成功处理 {total_images} 张图片")
         self.progress_var.set(100)
-        messagebox.showinfo("完成", f"导出完成! 成功处理 {total_images} 张图片")
+        messagebox.showinfo("完成", message)
 
     def show_help(self):
         """显示帮助"""
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分阶段性能分析 - 记录每张图片各处理阶段的耗时、CPU时间、读写字节数和像素数
+
+处理代码中用 stage() 标记阶段:
+
+    with stage("decode", pixels=img.width * img.height):
+        img.load()
+
+未启用分析时 stage() 返回同一个空的上下文管理器，几乎没有额外开销。
+启用后可输出汇总表、JSON、CSV，并为最慢的N张图片保存 cProfile 数据。
+"""
+
+from contextlib import nullcontext
+import cProfile
+import csv
+import heapq
+import json
+import os
+import time
+
+# 汇总表中阶段的显示顺序，未列出的阶段排在最后
+STAGE_ORDER = ["read", "exif", "cache", "open", "decode", "resize", "font", "draw", "convert",
+               "composite", "encode", "write"]
+
+_NULL_STAGE = nullcontext()
+
+# 当前启用的分析器，None 表示未启用
+_active = None
+
+
+def stage(name, nbytes_read=0, nbytes_written=0, pixels=0):
+    """
+    标记一个处理阶段
+    :param name: 阶段名称
+    :param nbytes_read: 本阶段读取的字节数
+    :param nbytes_written: 本阶段写入的字节数
+    :param pixels: 本阶段处理的像素数
+    :return: 上下文管理器
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, nbytes_read, nbytes_written, pixels)
+
+
+def add_bytes(name, nbytes_read=0, nbytes_written=0):
+    """补记某阶段的读写字节数（在阶段结束后才知道大小时使用）"""
+    if _active is not None:
+        _active.add_bytes(name, nbytes_read, nbytes_written)
+
+
+def annotate(**values):
+    """为当前图片补充附加信息（例如图像模式），写入报告中该图片的记录"""
+    if _active is not None:
+        _active.annotate(values)
+
+
+def get_profiler():
+    """当前启用的分析器，未启用时返回None"""
+    return _active
+
+
+class StageStats:
+    __slots__ = ("count", "wall", "cpu", "bytes_read", "bytes_written", "pixels")
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.pixels = 0
+
+    def add(self, other):
+        self.count += other.count
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.pixels += other.pixels
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class _StageTimer:
+    __slots__ = ("profiler", "name", "nbytes_read", "nbytes_written", "pixels", "wall", "cpu")
+
+    def __init__(self, profiler, name, nbytes_read, nbytes_written, pixels):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes_read = nbytes_read
+        self.nbytes_written = nbytes_written
+        self.pixels = pixels
+
+    def __enter__(self):
+        self.profiler.on_stage_enter(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        # 阶段结束后 wall / cpu 改为记录本次耗时，供 on_stage_exit 使用
+        self.wall = wall
+        self.cpu = cpu
+        stats = self.profiler.current_stats(self.name)
+        stats.count += 1
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.bytes_read += self.nbytes_read
+        stats.bytes_written += self.nbytes_written
+        stats.pixels += self.pixels
+        self.profiler.on_stage_exit(self)
+        return False
+
+
+class ImageRecord:
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.extra = {}
+
+    def to_dict(self):
+        result = {
+            "name": self.name,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "stages": {name: stats.to_dict() for name, stats in self.stages.items()}
+        }
+        result.update(self.extra)
+        return result
+
+
+class StageProfiler:
+    def __init__(self, top_n=0, split_io=True):
+        """
+        :param top_n: 为最慢的N张图片保存 cProfile 数据，0 表示不保存
+        :param split_io: 是否将读写盘与解码、编码分开计时（输入整体读入内存、输出先编码到内存）
+        """
+        self.top_n = top_n
+        self.split_io = split_io
+        # 每个阶段结束时调用 listener(阶段名称, 耗时秒数)
+        self.listeners = []
+        self.images = []
+        # 不属于任何图片的阶段（例如批处理开始前加载字体）
+        self.outside = ImageRecord(None)
+        self.current = None
+        self._image_wall = 0.0
+        self._image_cpu = 0.0
+        self._cprofile = None
+        # 最小堆，保存 (耗时, 序号, 图片名称, cProfile.Profile)
+        self._slowest = []
+
+    # ---- 供 stage() 使用 ----
+
+    def stage(self, name, nbytes_read=0, nbytes_written=0, pixels=0):
+        return _StageTimer(self, name, nbytes_read, nbytes_written, pixels)
+
+    def current_stats(self, name):
+        record = self.current or self.outside
+        stats = record.stages.get(name)
+        if stats is None:
+            stats = record.stages[name] = StageStats()
+        return stats
+
+    def add_bytes(self, name, nbytes_read=0, nbytes_written=0):
+        stats = self.current_stats(name)
+        stats.bytes_read += nbytes_read
+        stats.bytes_written += nbytes_written
+
+    def annotate(self, values):
+        (self.current or self.outside).extra.update(values)
+
+    def on_stage_enter(self, timer):
+        """阶段开始时的扩展点"""
+
+    def on_stage_exit(self, timer):
+        """阶段结束时的扩展点，通知所有 listener"""
+        for listener in self.listeners:
+            listener(timer.name, timer.wall)
+
+    # ---- 按图片记录 ----
+
+    def begin_image(self, name):
+        """开始处理一张图片，上一张图片尚未结束时先结束它"""
+        if self.current is not None:
+            self.end_image()
+        self.current = ImageRecord(name)
+        if self.top_n:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._image_cpu = time.process_time()
+        self._image_wall = time.perf_counter()
+
+    def end_image(self):
+        """结束当前图片"""
+        record = self.current
+        if record is None:
+            return
+        record.wall = time.perf_counter() - self._image_wall
+        record.cpu = time.process_time() - self._image_cpu
+        self.images.append(record)
+        self.current = None
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            entry = (record.wall, len(self.images), record.name, self._cprofile)
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+            self._cprofile = None
+
+    # ---- 汇总与输出 ----
+
+    def totals(self):
+        """各阶段在所有图片上的合计"""
+        totals = {}
+        for record in self.images + [self.outside]:
+            for name, stats in record.stages.items():
+                totals.setdefault(name, StageStats()).add(stats)
+        return dict(sorted(totals.items(), key=lambda item: _stage_rank(item[0])))
+
+    def format_summary(self):
+        """格式化汇总表"""
+        totals = self.totals()
+        total_wall = sum(record.wall for record in self.images)
+        lines = [
+            f"性能分析: {len(self.images)} 张图片, 合计 {total_wall:.2f}s",
+            f"{'阶段':<10} {'次数':>6} {'总耗时':>9} {'平均':>9} {'CPU':>9} {'占比':>6} "
+            f"{'读取':>9} {'写入':>9} {'像素':>9}"
+        ]
+        for name, stats in totals.items():
+            share = stats.wall / total_wall if total_wall else 0.0
+            mean = stats.wall / stats.count if stats.count else 0.0
+            lines.append(
+                f"{name:<10} {stats.count:>6} {stats.wall:>8.3f}s {mean * 1000:>7.1f}ms "
+                f"{stats.cpu:>8.3f}s {share:>6.1%} {_format_bytes(stats.bytes_read):>9} "
+                f"{_format_bytes(stats.bytes_written):>9} {stats.pixels / 1e6:>7.1f}MP")
+
+        if self.images:
+            slowest = max(self.images, key=lambda record: record.wall)
+            lines.append(f"最慢: {slowest.name} ({slowest.wall * 1000:.1f}ms)")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "totals": {name: stats.to_dict() for name, stats in self.totals().items()},
+            "images": [record.to_dict() for record in self.images]
+        }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def write_csv(self, path):
+        """每张图片一行，每个阶段占耗时、CPU时间两列"""
+        stage_names = list(self.totals())
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["image", "wall", "cpu"]
+                            + [f"{name}_{column}" for name in stage_names for column in ("wall", "cpu")])
+            for record in self.images:
+                row = [record.name, f"{record.wall:.6f}", f"{record.cpu:.6f}"]
+                for name in stage_names:
+                    stats = record.stages.get(name)
+                    row += [f"{stats.wall:.6f}", f"{stats.cpu:.6f}"] if stats else ["", ""]
+                writer.writerow(row)
+
+    def dump_slowest(self, directory):
+        """
+        保存最慢的N张图片的 cProfile 数据，可用 python -m pstats 查看
+        :return: 写入的文件路径列表
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for rank, (wall, index, name, profile) in enumerate(sorted(self._slowest, reverse=True), 1):
+            safe_name = os.path.basename(str(name)).replace(os.sep, "_")
+            path = os.path.join(directory, f"{rank:02d}_{safe_name}.pstats")
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def write_reports(self, directory, prefix="profile"):
+        """
+        在目录中写入 <prefix>.json、<prefix>.csv，以及 <prefix>_pstats/ 下的 cProfile 数据
+        :return: 写入的文件路径列表
+        """
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, f"{prefix}.json")
+        csv_path = os.path.join(directory, f"{prefix}.csv")
+        self.write_json(json_path)
+        self.write_csv(csv_path)
+        paths = [json_path, csv_path]
+        if self.top_n:
+            paths += self.dump_slowest(os.path.join(directory, f"{prefix}_pstats"))
+        return paths
+
+
+def _stage_rank(name):
+    return STAGE_ORDER.index(name) if name in STAGE_ORDER else len(STAGE_ORDER)
+
+
+def _format_bytes(value):
+    if value >= 1024 * 1024:
+        return f"{value / 1024 / 1024:.1f}MB"
+    if value >= 1024:
+        return f"{value / 1024:.1f}KB"
+    return f"{value}B"
+
+
+def enable(profiler):
+    """启用分析器，之后所有 stage() 调用都会被记录"""
+    global _active
+    _active = profiler
+    return profiler
+
+
+def disable():
+    """停用分析器"""
+    global _active
+    _active = None
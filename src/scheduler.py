@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+内存感知调度 - 按图像尺寸估算每个任务的峰值内存，只在总内存不超过上限时提交新任务
+
+图片的内存占用取决于 宽 × 高 × 通道数，与文件大小无关。提交前用 Image.open 只读取文件头，
+按内存模型（memory_profiler 生成的 memory_model.json）或 watermark_handler.estimate_memory 估算峰值。
+默认的内存上限和工作进程数取自容器的 cgroup 限制，没有限制时使用物理内存和CPU核心数。
+"""
+
+import io
+import math
+import os
+import threading
+
+from PIL import Image
+
+from memory_profiler import estimate_from_model
+from watermark_handler import estimate_memory
+
+# 默认只使用内存上限的这一比例，其余留给主进程、页缓存和估算误差
+DEFAULT_MEMORY_FRACTION = 0.75
+
+# cgroup v1 中"不限制"表现为接近 2^63 的数值
+_UNLIMITED = 1 << 60
+
+
+def _read_first_line(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_memory_limit():
+    """
+    容器的内存上限（字节），支持 cgroup v2 和 v1
+    :return: 字节数，没有限制时返回None
+    """
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        value = _read_first_line(path)
+        if value and value.isdigit() and int(value) < _UNLIMITED:
+            return int(value)
+    return None
+
+
+def cgroup_cpu_quota():
+    """
+    容器的CPU配额（可用CPU数，可能是小数），支持 cgroup v2 和 v1
+    :return: CPU数，没有限制时返回None
+    """
+    value = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if value:
+        quota, _, period = value.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+
+    quota = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def physical_memory():
+    """物理内存大小（字节），无法获取时返回None"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_cpus():
+    """
+    可用的CPU数：CPU亲和性和 cgroup 配额中较小的一个（配额向上取整）
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def default_memory_limit(fraction=DEFAULT_MEMORY_FRACTION):
+    """
+    工作进程池默认的内存上限：cgroup 内存上限或物理内存的一部分
+    :return: 字节数，都无法获取时返回None（不限制）
+    """
+    limit = cgroup_memory_limit() or physical_memory()
+    return int(limit * fraction) if limit else None
+
+
+def read_image_header(source):
+    """
+    只读取文件头，得到图像尺寸和模式
+    :param source: 文件路径或图片文件内容
+    :return: ((width, height), mode)，无法识别时返回None
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as img:
+            return img.size, img.mode
+    except Exception:
+        return None
+
+
+def estimate_task_memory(source, model=None):
+    """
+    估算处理一张图片的峰值内存
+    :param source: 文件路径或图片文件内容
+    :param model: load_memory_model 读取的内存模型，None 表示按图像模式估算
+    :return: 字节数；文件头无法识别时返回0，由工作进程报告错误
+    """
+    header = read_image_header(source)
+    if header is None:
+        return 0
+    size, mode = header
+    if model:
+        return estimate_from_model(model, size[0] * size[1], mode)
+    return estimate_memory(size, mode)
+
+
+class MemoryAdmission:
+    def __init__(self, limit):
+        """
+        按估算内存控制同时执行的任务
+        :param limit: 内存上限（字节），None 表示不限制
+        """
+        self.limit = limit
+        self.used = 0
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def _admit(self, nbytes):
+        # 单个任务超过上限时，等其他任务都结束后单独执行，而不是永远等待
+        if self.limit is None or self.active == 0 or self.used + nbytes <= self.limit:
+            self.used += nbytes
+            self.active += 1
+            return True
+        return False
+
+    def try_acquire(self, nbytes):
+        """内存足够时占用并返回True，否则立即返回False"""
+        with self.condition:
+            return self._admit(nbytes)
+
+    def acquire(self, nbytes):
+        """等待直到内存足够"""
+        with self.condition:
+            while not self._admit(nbytes):
+                self.condition.wait()
+
+    def release(self, nbytes):
+        """任务结束，释放占用的内存"""
+        with self.condition:
+            self.used -= nbytes
+            self.active -= 1
+            self.condition.notify_all()
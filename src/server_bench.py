@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+水印服务压测客户端 - 对本机运行的水印服务发起并发请求，统计吞吐量和延迟
+
+用法:
+    python src/photowatermark.py serve --port 8765
+    python src/server_bench.py --port 8765 --requests 200 --concurrency 8
+"""
+
+import argparse
+import http.client
+import io
+import threading
+import time
+from urllib.parse import urlencode
+
+from PIL import Image
+
+
+def make_test_image(width, height, image_format="JPEG"):
+    """生成用于压测的渐变图片"""
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    output = io.BytesIO()
+    img.save(output, format=image_format)
+    return output.getvalue()
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_benchmark(host, port, data, total_requests, concurrency, query):
+    """
+    并发发送请求
+    :return: 统计结果字典
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=300)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            start = time.perf_counter()
+            conn.request("POST", f"/watermark?{query}", body=data,
+                         headers={"Content-Type": "application/octet-stream"})
+            response = conn.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "duration": duration,
+        "throughput": len(latencies) / duration if duration else 0.0,
+        "p50": _percentile(latencies, 0.5),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "statuses": statuses
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PhotoWaterMark 水印服务压测客户端')
+    parser.add_argument('--host', default='127.0.0.1', help='服务地址 (默认值: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='服务端口 (默认值: 8765)')
+    parser.add_argument('--requests', type=int, default=200, help='请求总数 (默认值: 200)')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发连接数 (默认值: 8)')
+    parser.add_argument('--size', default='1920x1080', help='测试图片尺寸 (默认值: 1920x1080)')
+    parser.add_argument('--text', default='2024-01-01', help='水印文本 (默认值: 2024-01-01)')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    data = make_test_image(width, height)
+    query = urlencode({"text": args.text})
+
+    print(f"压测 http://{args.host}:{args.port}/watermark: {args.requests} 个请求, "
+          f"并发 {args.concurrency}, 图片 {width}x{height} ({len(data) / 1024:.0f} KB)")
+    stats = run_benchmark(args.host, args.port, data, args.requests, args.concurrency, query)
+    print(f"完成 {stats['requests']} 个请求, 耗时 {stats['duration']:.2f}s, "
+          f"吞吐量 {stats['throughput']:.1f} 张/秒")
+    print(f"延迟: p50 {stats['p50'] * 1000:.1f}ms, p95 {stats['p95'] * 1000:.1f}ms, "
+          f"p99 {stats['p99'] * 1000:.1f}ms")
+    print(f"状态码: {stats['statuses']}")
+
+
+if __name__ == "__main__":
+    main()
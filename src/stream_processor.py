@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+流式处理 - 从标准输入读取图片序列，添加水印后按相同的分帧方式写到标准输出
+
+支持两种分帧方式:
+    length  每张图片前有4字节大端序长度；处理失败的图片输出长度为0的帧
+    tar     tar流，输出同名成员（指定 --format 时替换扩展名）
+
+同时在途的图片数量有上限，内存占用与输入总量无关，全程不写临时文件。
+日志信息输出到标准错误，不会混入图片数据。
+"""
+
+from collections import deque
+from datetime import datetime
+import io
+import os
+import struct
+import sys
+import tarfile
+import time
+
+from encoder_profiles import OUTPUT_EXTENSIONS, normalize_format
+from isolated_pool import QuarantineReport
+import metrics
+from worker_pool import WatermarkWorkerPool, watermark_data
+
+_LENGTH = struct.Struct('>I')
+
+
+def _read_exact(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            raise EOFError("输入流在帧中间结束")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_length_prefixed(stream):
+    """
+    读取长度前缀分帧的图片序列
+    :return: 生成器，产生 (序号, 图片内容, None)
+    """
+    index = 0
+    while True:
+        header = stream.read(_LENGTH.size)
+        if not header:
+            return
+        if len(header) < _LENGTH.size:
+            header += _read_exact(stream, _LENGTH.size - len(header))
+        (length,) = _LENGTH.unpack(header)
+        yield index, _read_exact(stream, length), None
+        index += 1
+
+
+def read_tar(stream):
+    """
+    以流模式读取tar包（不回退、不缓存整个包）
+    :return: 生成器，产生 (成员信息, 图片内容, 成员修改日期)
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            data = tar.extractfile(member).read()
+            yield member, data, datetime.fromtimestamp(member.mtime).strftime('%Y-%m-%d')
+
+
+class LengthPrefixedWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, key, data, output_format):
+        self.stream.write(_LENGTH.pack(len(data)))
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.flush()
+
+
+class TarStreamWriter:
+    def __init__(self, stream, rename):
+        """
+        :param rename: 是否按输出格式替换扩展名
+        """
+        self.tar = tarfile.open(fileobj=stream, mode='w|')
+        self.stream = stream
+        self.rename = rename
+
+    def write(self, member, data, output_format):
+        if not data:
+            return
+        name = member.name
+        if self.rename:
+            name = os.path.splitext(name)[0] + OUTPUT_EXTENSIONS[output_format]
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = member.mtime
+        info.mode = member.mode
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.tar.close()
+        self.stream.flush()
+
+
+def stream_main(args):
+    """
+    流式模式主函数
+    :param args: parse_stream_arguments 解析得到的参数
+    """
+    # 图片数据写到原来的标准输出，其余所有输出（包括工作进程）改到标准错误
+    data_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    data_in = sys.stdin.buffer
+
+    output_format = normalize_format(args.format)
+    settings = {
+        "font_size": args.font_size,
+        "font_color": args.font_color,
+        "position": args.position
+    }
+    if args.layers:
+        settings["layers"] = args.layers
+    if args.text:
+        settings["watermark_text"] = args.text
+
+    if args.framing == "tar":
+        reader = read_tar(data_in)
+        writer = TarStreamWriter(data_out, rename=output_format is not None)
+    else:
+        reader = read_length_prefixed(data_in)
+        writer = LengthPrefixedWriter(data_out)
+
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    pool = WatermarkWorkerPool(args.workers, args.font_size, memory_budget)
+    window = args.window or pool.workers * 2
+    pending = deque()
+    quarantine = QuarantineReport()
+    processed = 0
+    failed = 0
+    received = 0
+    truncated = None
+    started = time.time()
+
+    registry = metrics.get_registry()
+    image_results = metrics.LabeledCounter(registry, "watermark_images_total", "处理的图片数", "result")
+    if registry:
+        registry.gauge("watermark_stream_pending", "已读入但尚未输出的图片数").set_function(lambda: len(pending))
+
+    def emit(key, future):
+        nonlocal processed, failed
+        try:
+            data, image_format = future.result()
+            processed += 1
+            image_results.inc("ok")
+        except Exception as e:
+            failed += 1
+            image_results.inc("failed")
+            quarantine.add(getattr(key, "name", key), e)
+            print(f"错误: 处理第 {processed + failed} 张图片时出错: {e}", file=sys.stderr)
+            data, image_format = b"", output_format
+        writer.write(key, data, image_format)
+
+    try:
+        try:
+            for key, data, fallback_text in reader:
+                received += 1
+                # tar流的成员名作为 {filename}，长度前缀分帧没有文件名
+                item_settings = dict(settings, filename=os.path.basename(getattr(key, "name", "")))
+                if fallback_text:
+                    item_settings["fallback_text"] = fallback_text
+                future = pool.submit_sized(pool.estimate(data), watermark_data, data, item_settings, output_format)
+                pending.append((key, future))
+                # 保持输出顺序与输入一致，在途数量达到上限时先输出最早的结果
+                while len(pending) >= window:
+                    emit(*pending.popleft())
+        except (EOFError, tarfile.TarError) as e:
+            # 输入被截断：已完整读入的图片照常输出，之后以非零状态退出
+            truncated = received + 1
+            print(f"错误: 输入流在第 {truncated} 张图片处被截断: {e}", file=sys.stderr)
+        while pending:
+            emit(*pending.popleft())
+    finally:
+        writer.close()
+        pool.shutdown()
+
+    duration = time.time() - started
+    print(f"流式处理完成: 成功 {processed} 张, 失败 {failed} 张, 耗时 {duration:.2f}s", file=sys.stderr)
+    if args.quarantine_report and quarantine.write(args.quarantine_report):
+        print(f"{len(quarantine)} 张图片被隔离，详见: {args.quarantine_report}", file=sys.stderr)
+    if truncated:
+        sys.exit(1)
@@ -5,15 +5,1247 @@
 水印处理器 - 处理图片水印添加功能
 """
 
-from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import hashlib
+import io
+import math
 import os
+import re
+import threading
+
+from compositing import get_backend
+from frame_sequence import is_frame_sequence, write_sequence
+from encoder_profiles import (DEFAULT_PROFILE, ENCODER_PROFILES, encoder_fingerprint, encoder_options,
+                             keep_source_info, source_info)
+from output_variants import variant_size
+from profiling import stage, annotate, get_profiler
+
+# 尝试使用支持中文的字体
+FONT_NAMES = [
+    "simhei.ttf",      # 黑体
+    "simsun.ttc",      # 宋体
+    "msyh.ttc",        # 微软雅黑
+    "simkai.ttf",      # 楷体
+    "fangsong.ttf",    # 仿宋
+    "arial.ttf",
+    "DejaVuSans.ttf"
+]
+
+# 超过该像素数的图像按水平条带并行转换
+STRIP_MIN_PIXELS = 16 * 1000 * 1000
+# 每个条带需要裁剪、转换、粘贴三次内存遍历，至少4个核心时才比直接转换快
+STRIP_MIN_WORKERS = 4
+
+_strip_executor = None
+_strip_executor_lock = threading.Lock()
+
+# 多输出规格的缩放和编码线程池，与条带转换分开，避免任务中的条带转换等待同一个线程池
+_variant_executor = None
+
+# 平铺水印的默认间距（像素）、文字角度和是否错位排列
+TILE_DEFAULTS = {"spacing": 120, "angle": 30, "stagger": True}
+# 缓存的整幅平铺图案数量，12MP图像的图案约48MB
+TILE_PATTERN_CACHE_SIZE = 2
+
+# Logo的目标宽度按该步长取整，宽度相近的图片共用同一个缩放后的Logo
+LOGO_WIDTH_STEP = 16
+# Logo 设置的默认值：宽度为图像宽度的比例，不透明度 (0-100)，旋转角度，位置
+LOGO_DEFAULTS = {"width": 0.2, "opacity": 100, "rotation": 0, "position": "bottomLeft"}
+
+# 各类图层的参数及默认值，图层列表按从下到上的顺序叠加（见 parse_layers）
+LAYER_DEFAULTS = {
+    "text": {"text": "", "font_size": 24, "font_color": "black", "transparency": 100, "rotation": 0,
+             "position": "bottomRight"},
+    "logo": dict(LOGO_DEFAULTS, path=None),
+    "tiled": dict(TILE_DEFAULTS, text="", font_size=24, font_color="black", transparency=100)
+}
+
+# 按图片取值的文本模板字段，文字中的 {date}、{filename}、{camera} 在每张图片上替换，其他花括号原样保留
+TEMPLATE_FIELDS = ("date", "filename", "camera")
+_TEMPLATE_PATTERN = re.compile(r"\{(%s)\}" % "|".join(TEMPLATE_FIELDS))
+
+# (绝对路径, 修改时间, 文件大小) -> Logo内容哈希；内容哈希 -> 原始RGBA Logo
+_logo_files = {}
+_logo_images = {}
+_logo_lock = threading.Lock()
+
+# 按名称加载失败时尝试的系统字体路径
+SYSTEM_FONT_PATHS = [
+    "C:/Windows/Fonts/simhei.ttf",                          # Windows系统字体
+    "/System/Library/Fonts/Helvetica.ttc",                  # macOS系统字体
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"       # Linux系统字体
+]
+
+
+@lru_cache(maxsize=32)
+def load_font(font_size):
+    """
+    加载水印字体，结果按字号缓存，批量处理时每个字号只加载一次
+    :param font_size: 字体大小
+    :return: 字体对象
+    """
+    for font_name in FONT_NAMES:
+        try:
+            return ImageFont.truetype(font_name, font_size)
+        except Exception:
+            continue
+
+    # 如果所有字体都失败，使用默认字体
+    font = ImageFont.load_default()
+    # 如果默认字体也不支持中文，尝试使用系统字体
+    for font_path in SYSTEM_FONT_PATHS:
+        try:
+            return ImageFont.truetype(font_path, font_size)
+        except Exception:
+            continue
+    return font
+
+
+def parse_color(font_color):
+    """
+    解析颜色
+    :param font_color: 颜色名称或HEX颜色
+    :return: (r, g, b)
+    """
+    if font_color.startswith('#'):
+        # HEX颜色
+        return tuple(int(font_color[i:i+2], 16) for i in (1, 3, 5))
+    elif font_color.lower() == 'black':
+        return (0, 0, 0)
+    elif font_color.lower() == 'white':
+        return (255, 255, 255)
+    elif font_color.lower() == 'red':
+        return (255, 0, 0)
+    elif font_color.lower() == 'green':
+        return (0, 255, 0)
+    elif font_color.lower() == 'blue':
+        return (0, 0, 255)
+    else:
+        return (0, 0, 0)  # 默认黑色
+
+
+@lru_cache(maxsize=256)
+def measure_text(watermark_text, font_size):
+    """
+    获取文本边界框
+    :return: (left, top, right, bottom)，相对于绘制起点
+    """
+    draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    return draw.textbbox((0, 0), watermark_text, font=load_font(font_size))
+
+
+@lru_cache(maxsize=256)
+def render_text_sprite(watermark_text, font_size, color, alpha, rotation):
+    """
+    渲染水印文字精灵图（仅包含文字区域），按参数缓存，批量处理和预览刷新时复用
+    :param watermark_text: 水印文本
+    :param font_size: 字体大小
+    :param color: (r, g, b)
+    :param alpha: 不透明度 (0-255)
+    :param rotation: 旋转角度
+    :return: RGBA精灵图，文本为空时返回None
+    """
+    left, top, right, bottom = measure_text(watermark_text, font_size)
+    if right <= left or bottom <= top:
+        return None
+
+    sprite = Image.new('RGBA', (right - left, bottom - top), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(sprite)
+    draw.text((-left, -top), watermark_text, font=load_font(font_size), fill=(*color, alpha))
+
+    if rotation != 0:
+        # 与整层旋转后再以自身为蒙版粘贴的效果保持一致
+        rotated = sprite.rotate(rotation, expand=1)
+        sprite = Image.new('RGBA', rotated.size, (255, 255, 255, 0))
+        sprite.paste(rotated, (0, 0), rotated)
+    return sprite
+
+
+def template_fields(text):
+    """
+    文本中使用的模板字段
+    :return: 字段名集合，不是模板时为空集合
+    """
+    return set(_TEMPLATE_PATTERN.findall(text or ""))
+
+
+def needed_fields(watermark_text, layers=None):
+    """
+    水印文本和附加图层中的文字用到的模板字段，每张图片只需提取这些字段
+    :return: 字段名集合
+    """
+    names = template_fields(watermark_text)
+    for layer in layers or []:
+        names |= template_fields(layer.get("text"))
+    return names
+
+
+def expand_template(text, fields):
+    """
+    把文本中的模板字段替换为当前图片的值
+    :param text: 水印文本，如 "{date} {camera}"
+    :param fields: {"date", "filename", "camera"}，缺少或为None的字段替换为空字符串
+    :return: 替换后的文本
+    """
+    return _TEMPLATE_PATTERN.sub(lambda match: str(fields.get(match.group(1)) or ""), text)
+
+
+@lru_cache(maxsize=4096)
+def glyph_box(char, font_size):
+    """单个字符相对于绘制起点的边界框 (left, top, right, bottom)"""
+    return load_font(font_size).getbbox(char)
+
+
+@lru_cache(maxsize=4096)
+def glyph_advance(char, next_char, font_size):
+    """
+    字符的步进宽度，包含与下一个字符之间的字距调整
+    :param next_char: 下一个字符，最后一个字符为None
+    """
+    font = load_font(font_size)
+    if next_char is None:
+        return font.getlength(char)
+    return font.getlength(char + next_char) - font.getlength(next_char)
+
+
+@lru_cache(maxsize=4096)
+def render_glyph(char, font_size):
+    """
+    渲染单个字符的覆盖率蒙版，每个 (字体, 字号, 字符) 只栅格化一次；颜色和不透明度在拼接整串文字后统一应用
+    :return: L模式蒙版（与 glyph_box 同尺寸），空白字符返回None
+    """
+    left, top, right, bottom = glyph_box(char, font_size)
+    if right <= left or bottom <= top:
+        return None
+    mask = Image.new('L', (right - left, bottom - top), 0)
+    ImageDraw.Draw(mask).text((-left, -top), char, font=load_font(font_size), fill=255)
+    return mask
+
+
+def layout_glyphs(watermark_text, font_size):
+    """
+    按缓存的步进宽度排列字符，不经过FreeType排版
+
+    与 draw.text 相同，各字符的起点取整到像素，边界框与 measure_text 一致。
+
+    :return: ([(字符, 起点x), ...], (left, top, right, bottom))，文本为空时边界框为None
+    """
+    glyphs = []
+    box = None
+    pen = 0.0
+    for i, char in enumerate(watermark_text):
+        x = math.floor(pen + 0.5)
+        glyphs.append((char, x))
+        left, top, right, bottom = glyph_box(char, font_size)
+        glyph = (x + left, top, x + right, bottom)
+        box = glyph if box is None else (min(box[0], glyph[0]), min(box[1], glyph[1]),
+                                         max(box[2], glyph[2]), max(box[3], glyph[3]))
+        next_char = watermark_text[i + 1] if i + 1 < len(watermark_text) else None
+        pen += glyph_advance(char, next_char, font_size)
+    return glyphs, box
+
+
+def measure_glyphs(watermark_text, font_size):
+    """
+    按字形缓存计算的文本边界框，用于每张图片都不同的模板文字
+    :return: (left, top, right, bottom)，相对于绘制起点
+    """
+    return layout_glyphs(watermark_text, font_size)[1] or (0, 0, 0, 0)
+
+
+@lru_cache(maxsize=16)
+def _alpha_table(alpha):
+    """覆盖率到不透明度的查找表"""
+    return [(value * alpha + 127) // 255 for value in range(256)]
+
+
+def render_glyph_sprite(watermark_text, font_size, color, alpha, rotation):
+    """
+    用缓存的字形蒙版拼接水印文字精灵图，合成结果与 render_text_sprite 相同（重叠字形的像素可能相差1）
+
+    文字来自日期、文件名等模板字段时每张图片都不同，整串缓存无法命中；
+    这里只做字形蒙版的拼接，不再对每张图片做FreeType排版和栅格化，也不占用整串精灵图的缓存。
+
+    :param watermark_text: 水印文本
+    :param font_size: 字体大小
+    :param color: (r, g, b)
+    :param alpha: 不透明度 (0-255)
+    :param rotation: 旋转角度
+    :return: RGBA精灵图，文本为空时返回None
+    """
+    glyphs, box = layout_glyphs(watermark_text, font_size)
+    if box is None or box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    left, top, right, bottom = box
+
+    coverage = Image.new('L', (right - left, bottom - top), 0)
+    covered = 0
+    for char, x in glyphs:
+        mask = render_glyph(char, font_size)
+        if mask is None:
+            continue
+        glyph_left, glyph_top = glyph_box(char, font_size)[:2]
+        dest = (x + glyph_left - left, glyph_top - top)
+        if dest[0] >= covered:
+            coverage.paste(mask, dest)
+        else:
+            # 与前面的字形重叠时按FreeType渲染整串文字的方式（screen）叠加覆盖率
+            area = dest + (dest[0] + mask.width, dest[1] + mask.height)
+            coverage.paste(ImageChops.screen(coverage.crop(area), mask), dest)
+        covered = max(covered, dest[0] + mask.width)
+
+    # 不透明度与 draw.text 相同，为 覆盖率 * alpha / 255 四舍五入
+    sprite = Image.new('RGBA', coverage.size, (*color, 0))
+    sprite.putalpha(coverage.point(_alpha_table(alpha)))
+
+    if rotation != 0:
+        rotated = sprite.rotate(rotation, expand=1)
+        sprite = Image.new('RGBA', rotated.size, (255, 255, 255, 0))
+        sprite.paste(rotated, (0, 0), rotated)
+    return sprite
+
+
+def load_logo(path):
+    """
+    读取Logo文件，按路径和修改时间缓存，批量处理时每个进程只读取一次；内容相同的文件共用一份
+    :param path: Logo图片路径（通常为带透明通道的PNG）
+    :return: Logo内容哈希，用作 render_logo_sprite 和输出缓存键的一部分
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _logo_lock:
+        digest = _logo_files.get(key)
+    if digest is not None:
+        return digest
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    with Image.open(io.BytesIO(data)) as logo:
+        logo = logo.convert('RGBA')
+    with _logo_lock:
+        _logo_images.setdefault(digest, logo)
+        _logo_files[key] = digest
+    return digest
+
+
+def logo_width_bucket(image_width, width):
+    """
+    Logo的目标宽度，按 LOGO_WIDTH_STEP 取整
+    :param image_width: 图像宽度
+    :param width: Logo宽度占图像宽度的比例
+    """
+    return max(LOGO_WIDTH_STEP, round(image_width * width / LOGO_WIDTH_STEP) * LOGO_WIDTH_STEP)
+
+
+@lru_cache(maxsize=64)
+def render_logo_sprite(logo_hash, width, opacity, rotation):
+    """
+    缩放到目标宽度、应用不透明度并旋转后的Logo，按 (Logo哈希, 宽度档位, 不透明度, 旋转角度) 缓存，
+    批量处理时每张图片只需一次区域混合
+    :param logo_hash: load_logo 的返回值
+    :param width: 目标宽度（logo_width_bucket 的返回值）
+    :param opacity: 不透明度 (0-100)
+    :param rotation: 旋转角度
+    :return: RGBA精灵图
+    """
+    logo = _logo_images[logo_hash]
+    height = max(1, round(logo.height * width / logo.width))
+    if width == logo.width:
+        # 后面会修改不透明度，不能修改缓存中的原始Logo
+        sprite = logo.copy()
+    elif width < logo.width:
+        sprite = resize_image(logo, (width, height))
+    else:
+        sprite = logo.resize((width, height), Image.LANCZOS)
+    if opacity < 100:
+        sprite.putalpha(sprite.getchannel('A').point(lambda a: a * opacity // 100))
+    if rotation != 0:
+        sprite = sprite.rotate(rotation, Image.BICUBIC, expand=1)
+    return sprite
+
+
+def tiled_position(spacing=None, angle=None, stagger=None):
+    """
+    平铺模式的位置参数，可作为 position 传给各水印方法
+    :param spacing: 相邻文字之间的间距（像素）
+    :param angle: 文字旋转角度
+    :param stagger: 是否错位排列（下一行右移半格）
+    :return: 位置字典
+    """
+    spacing = TILE_DEFAULTS["spacing"] if spacing is None else spacing
+    if spacing < 0:
+        raise ValueError(f"平铺间距不能为负数: {spacing}")
+    return {
+        "mode": "tiled",
+        "spacing": int(spacing),
+        "angle": TILE_DEFAULTS["angle"] if angle is None else angle,
+        "stagger": TILE_DEFAULTS["stagger"] if stagger is None else bool(stagger)
+    }
+
+
+def is_tiled(position):
+    """位置参数是否为平铺模式"""
+    return isinstance(position, dict) and position.get("mode") == "tiled"
+
+
+@lru_cache(maxsize=64)
+def render_tile(watermark_text, font_size, color, alpha, angle, spacing, stagger):
+    """
+    渲染平铺图案的一个周期，按参数缓存：旋转后的文字四周留出间距，
+    错位排列时包含上下两行，下一行右移半格（超出右边的部分折回左边）
+    :return: RGBA图块，文本为空时返回None
+    """
+    sprite = render_text_sprite(watermark_text, font_size, color, alpha, angle)
+    if sprite is None:
+        return None
+    cell_width, cell_height = sprite.width + spacing, sprite.height + spacing
+    tile = Image.new('RGBA', (cell_width, cell_height * 2 if stagger else cell_height), (255, 255, 255, 0))
+    tile.paste(sprite, (0, 0))
+    if stagger:
+        offset = cell_width // 2
+        tile.paste(sprite, (offset, cell_height))
+        tile.paste(sprite, (offset - cell_width, cell_height))
+    return tile
+
+
+@lru_cache(maxsize=TILE_PATTERN_CACHE_SIZE)
+def build_tiled_pattern(size, watermark_text, font_size, color, alpha, angle, spacing, stagger):
+    """
+    生成覆盖整幅图像的平铺图案，按图像尺寸和参数缓存，同一批相同尺寸的图片和预览刷新时复用
+
+    文字只渲染一次（render_tile），先把图块粘贴成一行，再把这一行粘贴到各行，
+    粘贴次数为行数加列数；图案以一个文字位于图像中心对齐。
+
+    :param size: 图像尺寸 (width, height)
+    :return: 与图像相同尺寸的RGBA图案，文本为空时返回None
+    """
+    tile = render_tile(watermark_text, font_size, color, alpha, angle, spacing, stagger)
+    if tile is None:
+        return None
+    sprite = render_text_sprite(watermark_text, font_size, color, alpha, angle)
+    width, height = size
+    x0 = (width - sprite.width) // 2 % tile.width - tile.width
+    y0 = (height - sprite.height) // 2 % tile.height - tile.height
+
+    row = Image.new('RGBA', (width, tile.height), (255, 255, 255, 0))
+    for x in range(x0, width, tile.width):
+        row.paste(tile, (x, 0))
+    pattern = Image.new('RGBA', size, (255, 255, 255, 0))
+    for y in range(y0, height, tile.height):
+        pattern.paste(row, (0, y))
+    return pattern
+
+
+def parse_layers(layers):
+    """
+    校验图层列表并补全默认参数
+
+    tiled 图层转换为 position 为平铺参数的 text 图层，Logo图层加上内容哈希（用于输出缓存键）。
+
+    :param layers: [{"type": "text" | "logo" | "tiled", ...}, ...]，参数见 LAYER_DEFAULTS
+    :return: 新的图层列表
+    :raise ValueError: 未知的图层类型或参数、Logo图层没有 path 或无法读取
+    """
+    if not isinstance(layers, list):
+        raise ValueError("图层必须是列表")
+    result = []
+    for layer in layers:
+        if not isinstance(layer, dict) or layer.get("type") not in LAYER_DEFAULTS:
+            raise ValueError(f"未知的图层类型: {layer!r}，可用类型: {', '.join(LAYER_DEFAULTS)}")
+        unknown = set(layer) - set(LAYER_DEFAULTS[layer["type"]]) - {"type", "hash"}
+        if unknown:
+            raise ValueError(f"{layer['type']} 图层不支持参数: {', '.join(sorted(unknown))}")
+        layer = dict(LAYER_DEFAULTS[layer["type"]], **layer)
+        if isinstance(layer.get("position"), list):
+            # JSON中的手动位置
+            layer["position"] = tuple(layer["position"])
+
+        if layer["type"] == "logo":
+            if not layer["path"]:
+                raise ValueError("logo 图层必须指定 path")
+            try:
+                layer["hash"] = load_logo(layer["path"])
+            except OSError as e:
+                raise ValueError(f"无法读取Logo {layer['path']}: {e}")
+        elif layer["type"] == "tiled":
+            position = tiled_position(layer.pop("spacing"), layer.pop("angle"), layer.pop("stagger"))
+            layer = dict(layer, type="text", rotation=0, position=position)
+        result.append(layer)
+    return result
+
+
+def layers_fingerprint(layers):
+    """用于输出缓存键和断点续传记录的图层设置：Logo按内容哈希而不是路径区分"""
+    return [{key: value for key, value in layer.items() if not (layer["type"] == "logo" and key == "path")}
+            for layer in layers]
+
+
+def layer_stack(watermark_text, font_size=24, font_color='black', transparency=100, rotation=0,
+                position='bottomRight', logo=None, layers=None, fields=None):
+    """
+    单个文本水印、Logo和附加图层组成的图层列表，从下到上
+    :param logo: Logo设置 {"path", "width", "opacity", "rotation", "position"}，None 表示不添加Logo
+    :param layers: parse_layers 返回的附加图层，叠加在文字和Logo之上
+    :param fields: 当前图片的模板字段值 {"date", "filename", "camera"}；指定时文字中的模板字段被替换，
+                   这些每张图片都不同的文字由字形缓存拼接（见 render_glyph_sprite）
+    """
+    stack = [{"type": "text", "text": watermark_text, "font_size": font_size, "font_color": font_color,
+              "transparency": transparency, "rotation": rotation, "position": position}]
+    if logo:
+        stack.append(dict(logo, type="logo"))
+    stack += list(layers or [])
+    if fields is None:
+        return stack
+    return [dict(layer, text=expand_template(layer["text"], fields), glyphs=True)
+            if layer["type"] != "logo" and template_fields(layer.get("text")) else layer
+            for layer in stack]
+
+
+def scale_layer(layer, scale):
+    """按输出图像的缩放比例调整图层的字号、平铺间距和手动位置"""
+    if scale == 1:
+        return layer
+    layer = dict(layer)
+    if layer["type"] == "logo":
+        # Logo宽度是图像宽度的比例，不需要调整
+        _, layer["position"] = scale_watermark(1, layer.get("position", LOGO_DEFAULTS["position"]), scale)
+    else:
+        layer["font_size"], layer["position"] = scale_watermark(layer["font_size"], layer["position"], scale)
+    return layer
+
+
+def _layer_rotation(size, rotation):
+    """
+    整层以中心旋转（expand=1）时 Image.rotate 使用的仿射矩阵，把旋转后图层中的坐标映射回原图层
+    :return: (a, b, c, d, e, f)
+    """
+    w, h = size
+    angle = -math.radians(rotation)
+    # 与 Image.rotate 相同，舍入到15位小数以避免90度倍数时的浮点误差
+    a, b = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    d, e = round(-math.sin(angle), 15), round(math.cos(angle), 15)
+    c = a * -w / 2 + b * -h / 2 + w / 2
+    f = d * -w / 2 + e * -h / 2 + h / 2
+
+    xs, ys = [], []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        xs.append(a * x + b * y + c)
+        ys.append(d * x + e * y + f)
+    nw = math.ceil(max(xs)) - math.floor(min(xs))
+    nh = math.ceil(max(ys)) - math.floor(min(ys))
+    tx, ty = -(nw - w) / 2.0, -(nh - h) / 2.0
+    return a, b, a * tx + b * ty + c, d, e, d * tx + e * ty + f
+
+
+def _fixed(value):
+    """Pillow 最近邻仿射变换使用的16.16定点数"""
+    return math.floor(value * 65536 + 0.5)
+
+
+def rotate_in_layer(sprite, image_size, origin, rotation):
+    """
+    按整层旋转的方式旋转精灵图：结果与把精灵图画在图像大小的透明图层上、整层 rotate(rotation, expand=1)
+    后粘贴到 (0, 0) 相同，只是只变换精灵图所在的区域。
+    单独旋转精灵图再摆放时最近邻采样的网格会错位，这里沿用整层旋转的采样位置
+    :param sprite: 未旋转的RGBA精灵图
+    :param image_size: 图像尺寸
+    :param origin: 精灵图左上角在未旋转图层中的位置
+    :param rotation: 旋转角度
+    :return: (旋转后的精灵图, 左上角在图像中的位置)，完全超出图像时返回None
+    """
+    # 整层只有图像大小，超出的文字在旋转前就被裁掉
+    w, h = image_size
+    sx, sy = origin
+    box = (max(0, -sx), max(0, -sy), min(sprite.width, w - sx), min(sprite.height, h - sy))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    sprite = sprite.crop(box)
+    sx, sy = sx + box[0], sy + box[1]
+    sw, sh = sprite.size
+
+    angle = rotation % 360
+    if angle in (0, 90, 180, 270):
+        # Image.rotate 对90度的倍数直接转置
+        if angle == 0:
+            rotated, dest = sprite, (sx, sy)
+        elif angle == 90:
+            rotated, dest = sprite.transpose(Image.Transpose.ROTATE_90), (sy, w - sx - sw)
+        elif angle == 180:
+            rotated, dest = sprite.transpose(Image.Transpose.ROTATE_180), (w - sx - sw, h - sy - sh)
+        else:
+            rotated, dest = sprite.transpose(Image.Transpose.ROTATE_270), (h - sy - sh, sx)
+    else:
+        a, b, c, d, e, f = _layer_rotation(image_size, rotation)
+        # 旋转矩阵是正交的，逆变换即转置：求精灵图四角在旋转后图层中的位置
+        xs, ys = [], []
+        for x, y in ((sx, sy), (sx + sw, sy), (sx + sw, sy + sh), (sx, sy + sh)):
+            xs.append(a * (x - c) + d * (y - f))
+            ys.append(b * (x - c) + e * (y - f))
+        ox, oy = math.floor(min(xs)) - 1, math.floor(min(ys)) - 1
+        size = (math.ceil(max(xs)) + 1 - ox, math.ceil(max(ys)) + 1 - oy)
+
+        # 最近邻仿射变换按16.16定点数逐像素累加，区域左上角的采样位置按整层的定点数推算，
+        # 输出和输入又都只平移整数像素，因此每个像素取到的源像素与整层旋转相同
+        x0 = _fixed(c + a * 0.5 + b * 0.5) + ox * _fixed(a) + oy * _fixed(b) - sx * 65536
+        y0 = _fixed(f + d * 0.5 + e * 0.5) + ox * _fixed(d) + oy * _fixed(e) - sy * 65536
+        matrix = (a, b, x0 / 65536 - a * 0.5 - b * 0.5, d, e, y0 / 65536 - d * 0.5 - e * 0.5)
+        rotated = sprite.transform(size, Image.Transform.AFFINE, matrix)
+        dest = (ox, oy)
+
+    bbox = rotated.getbbox()
+    if bbox is None:
+        return None
+    rotated = rotated.crop(bbox)
+    # 与整层旋转后再以自身为蒙版粘贴的效果保持一致
+    result = Image.new('RGBA', rotated.size, (255, 255, 255, 0))
+    result.paste(rotated, (0, 0), rotated)
+    return result, (dest[0] + bbox[0], dest[1] + bbox[1])
+
+
+def default_output_format(img):
+    """与输入格式相同，无法确定或不支持时使用JPEG；多帧的GIF、APNG和TIFF保持原格式"""
+    if is_frame_sequence(img):
+        return img.format
+    return img.format if img.format in ("JPEG", "PNG", "WEBP") else "JPEG"
+
+
+def _get_strip_executor():
+    """按需创建条带转换线程池，每个进程一个"""
+    global _strip_executor
+    with _strip_executor_lock:
+        if _strip_executor is None:
+            _strip_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _strip_executor
+
+
+def _get_variant_executor():
+    """按需创建多输出规格的线程池，每个进程一个"""
+    global _variant_executor
+    with _strip_executor_lock:
+        if _variant_executor is None:
+            _variant_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _variant_executor
+
+
+def resize_image(img, size):
+    """
+    缩小图像：先按不小于目标尺寸的最大整数倍 reduce（盒式平均，很快），再用LANCZOS重采样到目标尺寸
+    :param img: 已解码的PIL图像，调色板图像会先转换为RGB/RGBA
+    :param size: 目标尺寸 (width, height)
+    :return: 新的图像，尺寸相同时返回原图像
+    """
+    if img.size == tuple(size):
+        return img
+    with stage("resize", pixels=size[0] * size[1]):
+        if img.mode in ('1', 'P'):
+            # 调色板图像不能平滑缩放
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor >= 2:
+            img = img.reduce(factor)
+        return img.resize(size, Image.LANCZOS)
+
+
+def scale_watermark(font_size, position, scale):
+    """
+    按输出图像的缩放比例调整字号和手动位置，使缩小后的输出与原尺寸输出的水印比例一致
+    :return: (字号, 位置)
+    """
+    if scale == 1:
+        return font_size, position
+    if is_tiled(position):
+        position = dict(position, spacing=round(position["spacing"] * scale))
+    elif isinstance(position, (tuple, list)):
+        position = (round(position[0] * scale), round(position[1] * scale))
+    return max(1, round(font_size * scale)), position
+
+
+def convert_image(img, mode):
+    """
+    转换图像模式，超过 STRIP_MIN_PIXELS 的图像按水平条带在线程池中并行转换
+
+    Pillow在转换、裁剪和粘贴时释放GIL，各条带直接写入同一张结果图像，
+    除结果图像外只有每个条带的临时副本。
+
+    :param img: PIL图像
+    :param mode: 目标模式
+    :return: 转换后的图像
+    """
+    workers = os.cpu_count() or 1
+    if workers < STRIP_MIN_WORKERS or img.width * img.height < STRIP_MIN_PIXELS:
+        return img.convert(mode)
+
+    img.load()
+    result = Image.new(mode, img.size)
+    strip_height = -(-img.height // workers)
+
+    def convert_strip(top):
+        box = (0, top, img.width, min(top + strip_height, img.height))
+        result.paste(img.crop(box).convert(mode), box)
+
+    # 等待所有条带完成，并抛出其中的异常
+    list(_get_strip_executor().map(convert_strip, range(0, img.height, strip_height)))
+    return result
+
+
+def estimate_memory(size, mode):
+    """
+    估算添加水印并编码时的峰值内存（只需图像头信息，不解码）
+    :param size: 图像尺寸 (width, height)
+    :param mode: 图像模式
+    :return: 字节数
+    """
+    pixels = size[0] * size[1]
+    bands = Image.getmodebands(mode) if mode in Image.MODES else 4
+    if mode == 'RGB':
+        # 只在水印区域转换，不需要整幅副本
+        working = 0
+    elif mode == 'RGBA' or 'A' not in mode:
+        # 转换为RGB（或RGBA保存前转换为RGB）的一份副本
+        working = 3
+    else:
+        # 带透明通道的其他模式：先转换为RGBA，保存前再转换为RGB
+        working = 7
+    # 编解码器的工作缓冲区，实测约为每像素1字节
+    return pixels * (bands + working + 1)
+
+
+def composite_sprite(img, sprite, dest):
+    """
+    使用当前合成后端将精灵图合成到图像的对应区域（原地修改），超出图像的部分被裁剪
+    :param img: RGB或RGBA图像
+    :param sprite: RGBA精灵图
+    :param dest: 精灵图左上角在图像中的位置
+    """
+    get_backend().composite(img, sprite, dest)
+
+
+def composite_layers(img, placements):
+    """
+    使用当前合成后端按顺序合成多个精灵图（原地修改）
+    :param img: RGB或RGBA图像
+    :param placements: [(精灵图, 左上角位置), ...]，从下到上
+    """
+    get_backend().composite_layers(img, placements)
+
+
+def blend_pattern(img, pattern):
+    """
+    将整幅RGBA平铺图案一次混合到图像中（原地修改）
+
+    RGB图像以图案自身为蒙版直接粘贴，只遍历一次且不需要整幅的RGBA副本；
+    RGBA图像使用 alpha_composite 以正确合成透明度。
+
+    :param img: RGB或RGBA图像
+    :param pattern: 与图像尺寸相同的RGBA图案
+    """
+    if img.mode == 'RGBA':
+        img.alpha_composite(pattern)
+    else:
+        img.paste(pattern, (0, 0), pattern)
+
 
 class WatermarkHandler:
+    # 单张图像的内存预算（字节），None 表示不限制；可通过 set_memory_budget 统一设置
+    memory_budget = None
+    # 编码配置（见 encoder_profiles.py）；可通过 set_encoder 统一设置
+    encoder_profile = DEFAULT_PROFILE
+    encoder_quality = None
+    encoder_lossless = False
+    # 输出尺寸（长边像素数或缩放比例），None 表示原尺寸；可通过 set_output_size 统一设置
+    output_max_size = None
+    output_scale = None
+
     def __init__(self):
         pass
 
+    @classmethod
+    def set_memory_budget(cls, budget):
+        """
+        设置所有处理器的单张图像内存预算
+        :param budget: 字节数，None 表示不限制
+        """
+        # 只用于 check_memory_budget 的单独检查，不改变Pillow的像素数上限（解压炸弹保护）
+        cls.memory_budget = budget
+
+    @classmethod
+    def set_encoder(cls, profile=DEFAULT_PROFILE, quality=None, lossless=False):
+        """
+        设置所有处理器保存图片时的编码配置
+        :param profile: compat、fast、balanced 或 smallest
+        :param quality: 覆盖配置中的JPEG/WebP质量，整数或 'keep'，None 表示使用配置
+        :param lossless: WebP是否无损压缩
+        """
+        if profile and profile not in ENCODER_PROFILES:
+            raise ValueError(f"未知的编码配置: {profile}")
+        cls.encoder_profile = profile or DEFAULT_PROFILE
+        cls.encoder_quality = quality
+        cls.encoder_lossless = lossless
+
+    @classmethod
+    def set_output_size(cls, max_size=None, scale=None):
+        """
+        设置所有处理器的输出尺寸，只缩小不放大；两者都指定时取较小的结果
+        :param max_size: 输出图像长边的最大像素数
+        :param scale: 缩放比例 (0, 1]
+        """
+        if max_size is not None and max_size < 1:
+            raise ValueError(f"最大边长必须是正整数: {max_size}")
+        if scale is not None and not 0 < scale <= 1:
+            raise ValueError(f"缩放比例必须在0到1之间: {scale}")
+        cls.output_max_size = max_size
+        cls.output_scale = scale
+
+    def get_output_size(self):
+        """当前的输出尺寸设置，可作为 open_source 的 output_size 参数传给工作进程"""
+        return {"max_size": self.output_max_size, "scale": self.output_scale}
+
+    def get_encoder(self):
+        """当前的编码配置，可作为 watermark_bytes 的 encoder 参数传给工作进程"""
+        return {"profile": self.encoder_profile, "quality": self.encoder_quality, "lossless": self.encoder_lossless}
+
+    def encoder_fingerprint(self, output_format, encoder=None):
+        """输出缓存键中的编码设置"""
+        return encoder_fingerprint(output_format, **(encoder or self.get_encoder()))
+
+    def _encoder_options(self, output_format, source, encoder=None):
+        encoder = encoder or self.get_encoder()
+        return encoder_options(output_format, encoder.get("profile"), encoder.get("quality"),
+                               encoder.get("lossless", False), source)
+
+    def check_memory_budget(self, img, name=None):
+        """
+        根据图像头信息检查内存预算，超出时抛出 MemoryError，避免在解码时被系统终止
+        :param img: 尚未解码的PIL图像
+        :param name: 用于错误信息的图像名称
+        """
+        if self.memory_budget is None:
+            return
+        required = estimate_memory(img.size, img.mode)
+        if required > self.memory_budget:
+            raise MemoryError(
+                f"图像 {name + ' ' if name else ''}({img.width}x{img.height} {img.mode}) 预计需要 "
+                f"{required / 1024 / 1024:.0f}MB 内存，超过内存预算 {self.memory_budget / 1024 / 1024:.0f}MB")
+
+    def decode(self, img, target=None, name=None):
+        """
+        解码图像；目标尺寸小于原图时JPEG用 draft() 按不小于目标尺寸的最小DCT比例（1/2、1/4、1/8）解码，
+        不再解码完整分辨率，内存预算也按缩小后的尺寸检查
+        :param img: 尚未解码的PIL图像
+        :param target: 最终需要的尺寸 (width, height)，None 表示原尺寸
+        :param name: 用于错误信息的图像名称
+        """
+        if target is not None and tuple(target) != img.size:
+            # 其他格式不支持，返回None且不改变图像
+            img.draft(None, target)
+        self.check_memory_budget(img, name)
+        annotate(mode=img.mode, format=img.format)
+        with stage("decode", pixels=img.width * img.height):
+            img.load()
+
+    def get_text_size(self, watermark_text, font_size):
+        """
+        获取水印文本尺寸
+        :return: (width, height)
+        """
+        left, top, right, bottom = measure_text(watermark_text, font_size)
+        return right - left, bottom - top
+
+    def apply_text_watermark(self, img, watermark_text, font_size=24, font_color='black',
+                             transparency=100, rotation=0, position='bottomRight'):
+        """
+        向已打开的图像添加文本水印，只合成文字所在区域
+
+        :param img: PIL图像，如果已经是RGBA模式将直接在原图上绘制
+        :param position: 九宫格位置名称、手动位置 (x, y)，或 tiled_position() 生成的平铺参数
+        :return: 添加水印后的RGBA图像
+        """
+        # 转换为RGBA模式以支持透明度
+        if img.mode != 'RGBA':
+            with stage("convert", pixels=img.width * img.height):
+                img = convert_image(img, 'RGBA')
+
+        placement = self._place_sprite(img.size, watermark_text, font_size, font_color,
+                                       transparency, rotation, position)
+        if placement is not None:
+            with stage("composite"):
+                self._composite(img, placement, position)
+        return img
+
+    def apply_text_watermark_roi(self, img, watermark_text, font_size=24, font_color='black',
+                                 transparency=100, rotation=0, position='bottomRight'):
+        """
+        只对水印所在区域做RGBA转换和合成，不生成整幅RGBA图像
+
+        结果与 apply_text_watermark(...).convert('RGB') 逐像素相同，
+        但RGB图像无需额外的整幅副本，适合保存前的最后一步。
+
+        :param img: 已解码的PIL图像，RGB/RGBA图像将直接在原图上绘制
+        :return: RGB图像（输入为RGBA时返回RGBA图像，保存前需转换为RGB）
+        """
+        if img.mode not in ('RGB', 'RGBA'):
+            # 带透明通道的图像需在RGBA上合成，结果才与整幅合成一致
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            with stage("convert", pixels=img.width * img.height):
+                img = convert_image(img, 'RGBA' if has_alpha else 'RGB')
+
+        placement = self._place_sprite(img.size, watermark_text, font_size, font_color,
+                                       transparency, rotation, position)
+        if placement is None:
+            return img
+        # RGB图像由合成后端只在水印区域混合
+        with stage("composite"):
+            self._composite(img, placement, position)
+        return img
+
+    def apply_logo_watermark(self, img, logo_path, width=LOGO_DEFAULTS["width"], opacity=LOGO_DEFAULTS["opacity"],
+                             rotation=LOGO_DEFAULTS["rotation"], position=LOGO_DEFAULTS["position"]):
+        """
+        向已打开的图像添加Logo水印，只在Logo所在区域混合
+
+        缩放、不透明度和旋转的结果按 (Logo哈希, 宽度档位, 不透明度, 旋转角度) 缓存，
+        同一批宽度相近的图片直接复用。
+
+        :param img: PIL图像，RGB/RGBA图像将直接在原图上绘制
+        :param logo_path: Logo图片路径
+        :param width: Logo宽度占图像宽度的比例
+        :param opacity: 不透明度 (0-100)
+        :param rotation: Logo自身的旋转角度
+        :param position: 九宫格位置名称，或Logo左上角的手动位置 (x, y)
+        :return: RGB或RGBA图像
+        """
+        layer = {"type": "logo", "path": logo_path, "width": width, "opacity": opacity, "rotation": rotation,
+                 "position": position}
+        return self.apply_layers(img, [layer])
+
+    def apply_logo(self, img, logo, scale=1):
+        """
+        按Logo设置字典添加Logo水印，logo 为None时原样返回
+        :param logo: {"path", "width", "opacity", "rotation", "position"}，省略的项使用 LOGO_DEFAULTS
+        :param scale: 输出图像相对原图的缩放比例，用于调整手动位置
+        """
+        if not logo:
+            return img
+        settings = dict(LOGO_DEFAULTS, **{key: value for key, value in logo.items() if key != "hash"})
+        _, settings["position"] = scale_watermark(1, settings["position"], scale)
+        return self.apply_logo_watermark(img, settings.pop("path"), **settings)
+
+    def apply_layers(self, img, layers, scale=1):
+        """
+        按顺序叠加多个图层，各图层的精灵图都从缓存取得，所有图层在同一次合成中混合到图像
+
+        只对图层覆盖的区域做处理，不生成整幅的图层或RGBA副本；保存前只需一次模式转换和编码。
+
+        :param img: 已解码的PIL图像，RGB/RGBA图像将直接在原图上绘制
+        :param layers: 图层列表（见 parse_layers、layer_stack），从下到上
+        :param scale: 输出图像相对原图的缩放比例，用于调整字号、平铺间距和手动位置
+        :return: RGB或RGBA图像（同 apply_text_watermark_roi）
+        """
+        if img.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            with stage("convert", pixels=img.width * img.height):
+                img = convert_image(img, 'RGBA' if has_alpha else 'RGB')
+
+        placements = [self._place_layer(img.size, scale_layer(layer, scale)) for layer in layers]
+        placements = [placement for placement in placements if placement is not None]
+        if placements:
+            with stage("composite"):
+                composite_layers(img, placements)
+        return img
+
+    def _place_layer(self, image_size, layer):
+        """
+        获取图层的精灵图及其在图像中的左上角位置
+        :return: (精灵图, (x, y))，文本为空时返回None
+        """
+        layer = dict(LAYER_DEFAULTS[layer["type"]], **layer)
+        if layer["type"] == "logo":
+            with stage("draw"):
+                sprite = render_logo_sprite(load_logo(layer["path"]), logo_width_bucket(image_size[0], layer["width"]),
+                                            layer["opacity"], layer["rotation"])
+            if isinstance(layer["position"], (tuple, list)):
+                return sprite, tuple(layer["position"])
+            return sprite, self.get_watermark_position(image_size, sprite.size, layer["position"])
+        if layer["type"] == "tiled":
+            glyphs = layer.pop("glyphs", False)
+            layer = dict(parse_layers([layer])[0], glyphs=glyphs)
+        return self._place_sprite(image_size, layer["text"], layer["font_size"], layer["font_color"],
+                                  layer["transparency"], layer["rotation"], layer["position"],
+                                  layer.get("glyphs", False))
+
+    def _composite(self, img, placement, position):
+        """平铺图案一次混合整幅图像，单个水印由合成后端只处理精灵图区域"""
+        if is_tiled(position):
+            blend_pattern(img, placement[0])
+        else:
+            composite_sprite(img, *placement)
+
+    def _place_sprite(self, image_size, watermark_text, font_size, font_color,
+                      transparency, rotation, position, glyphs=False):
+        """
+        获取水印精灵图及其在图像中的左上角位置
+        :param glyphs: 文字来自模板字段、每张图片都不同时为True，用字形缓存拼接而不是整串缓存
+        :return: (精灵图, (x, y))，文本为空时返回None
+        """
+        alpha = int(255 * transparency / 100)
+        with stage("font"):
+            load_font(font_size)
+        if is_tiled(position):
+            # rotation 由平铺参数中的 angle 代替
+            with stage("draw"):
+                pattern = build_tiled_pattern(
+                    tuple(image_size), watermark_text, font_size, parse_color(font_color), alpha,
+                    position["angle"], position["spacing"], position["stagger"])
+            return None if pattern is None else (pattern, (0, 0))
+
+        render, measure = (render_glyph_sprite, measure_glyphs) if glyphs else (render_text_sprite, measure_text)
+        with stage("draw"):
+            # 旋转在确定位置后按整层旋转的采样网格进行，见 rotate_in_layer
+            sprite = render(watermark_text, font_size, parse_color(font_color), alpha, 0)
+        if sprite is None:
+            return None
+
+        # 计算水印位置
+        left, top, right, bottom = measure(watermark_text, font_size)
+        if isinstance(position, (tuple, list)):
+            x, y = position
+        else:
+            x, y = self.get_watermark_position(image_size, (right - left, bottom - top), position)
+
+        if rotation == 0:
+            return sprite, (x + left, y + top)
+        with stage("draw"):
+            return rotate_in_layer(sprite, tuple(image_size), (x + left, y + top), rotation)
+
+    def open_source(self, source, output_size=None, frames=False):
+        """
+        打开内存中的图片来源，不经过临时文件，并缩小到输出尺寸
+        :param source: bytes/bytearray/memoryview、二进制文件对象、文件路径或PIL图像（PIL图像原样返回）
+        :param output_size: 输出尺寸 {"max_size", "scale"}，默认见 set_output_size
+        :param frames: 为True时多帧图像（见 frame_sequence.is_frame_sequence）不解码，原样返回以便逐帧处理
+        :return: PIL图像
+        """
+        if isinstance(source, Image.Image):
+            return source
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        with stage("open"):
+            img = Image.open(source)
+        if frames and is_frame_sequence(img):
+            return img
+        return self._decode_source(img, output_size, source if isinstance(source, str) else None)
+
+    def _decode_source(self, img, output_size=None, name=None):
+        """解码 open_source 打开的图像并缩小到输出尺寸；多帧图像只解码当前帧"""
+        original_size = img.size
+        output_size = output_size or self.get_output_size()
+        target = variant_size(img.size, output_size.get("max_size"), output_size.get("scale"))
+        # 立即解码，从文件路径打开时会同时关闭文件句柄
+        self.decode(img, target, name)
+        resized = resize_image(img, target)
+        if resized is not img:
+            # 缩小后的图像沿用来源的格式和量化表，供 default_output_format 和 quality='keep' 使用
+            keep_source_info(img, resized)
+            # 原图尺寸，用于按比例调整水印
+            resized.source_size = original_size
+        return resized
+
+    def watermark_sequence(self, img, fp, stack, output_size=None, encoder=None):
+        """
+        逐帧添加水印并写出动画GIF、APNG或多页TIFF，输出格式与输入相同
+
+        用 ImageSequence 逐帧解码、缩放、合成后立即编码写出，同一时间只保留一帧；
+        各帧的精灵图相同，从缓存取得后只在水印区域混合。
+
+        :param img: Image.open 得到的多帧图像（frame_sequence.is_frame_sequence 为True）
+        :param fp: 二进制输出文件对象，TIFF需要可读写、可定位
+        :param stack: 图层列表（见 layer_stack）
+        :param output_size: 输出尺寸 {"max_size", "scale"}，默认见 set_output_size
+        :param encoder: 编码配置 {"profile", "quality", "lossless"}，APNG各帧按PNG配置编码
+        :return: 帧数
+        """
+        output_size = output_size or self.get_output_size()
+        target = variant_size(img.size, output_size.get("max_size"), output_size.get("scale"))
+        scale = target[0] / img.width
+        annotate(mode=img.mode, format=img.format)
+        # 内存只与单帧尺寸有关
+        self.check_memory_budget(img)
+
+        def render(frame):
+            with stage("decode", pixels=frame.width * frame.height):
+                frame.load()
+            resized = resize_image(frame, target)
+            if resized is frame and frame.mode in ('RGB', 'RGBA'):
+                # Pillow 解码下一帧时还会用到当前帧，不能在上面直接绘制
+                resized = frame.copy()
+            return self.apply_layers(resized, stack, scale)
+
+        return write_sequence(fp, img, render, self._encoder_options(img.format, None, encoder))
+
+    def watermark_image(self, source, watermark_text, font_size=24, font_color='black',
+                        transparency=100, rotation=0, position='bottomRight', logo=None, layers=None):
+        """
+        在内存中添加文本水印并返回图像
+
+        :param source: bytes、文件对象、文件路径或PIL图像；RGBA图像将直接在原图上绘制，其他来源缩小到输出尺寸
+        :param logo: Logo设置 {"path", "width", "opacity", "rotation", "position"}，None 表示不添加Logo
+        :param layers: parse_layers 返回的附加图层，与文字、Logo在同一次合成中叠加
+        :return: 添加水印后的RGBA图像
+        """
+        img = self.open_source(source)
+        scale = img.width / getattr(img, "source_size", img.size)[0]
+        if img.mode != 'RGBA':
+            with stage("convert", pixels=img.width * img.height):
+                img = convert_image(img, 'RGBA')
+        stack = layer_stack(watermark_text, font_size, font_color, transparency, rotation, position, logo, layers)
+        return self.apply_layers(img, stack, scale)
+
+    def watermark_bytes(self, source, watermark_text, font_size=24, font_color='black',
+                        transparency=100, rotation=0, position='bottomRight', output_format=None, encoder=None,
+                        output_size=None, logo=None, layers=None, fields=None):
+        """
+        在内存中添加文本水印并返回编码后的图片内容
+
+        :param source: bytes、文件对象、文件路径或PIL图像（PIL图像不缩放；尚未解码的多帧图像逐帧缩放）
+        :param output_format: 输出格式，默认与输入格式相同（无法确定时为JPEG）；
+                              动画GIF、APNG和多页TIFF以原格式输出时保留所有帧，其他格式只输出第一帧
+        :param encoder: 编码配置 {"profile", "quality", "lossless"}，默认见 set_encoder
+        :param output_size: 输出尺寸 {"max_size", "scale"}，默认见 set_output_size
+        :param logo: Logo设置 {"path", "width", "opacity", "rotation", "position"}，None 表示不添加Logo
+        :param layers: parse_layers 返回的附加图层，与文字、Logo在同一次合成中叠加
+        :param fields: 当前图片的模板字段值，用于替换文字中的 {date}、{filename}、{camera}（见 layer_stack）
+        :return: 输出图片内容 (bytes)
+        """
+        img = self.open_source(source, output_size, frames=True)
+        output_format = output_format or default_output_format(img)
+        stack = layer_stack(watermark_text, font_size, font_color, transparency, rotation, position, logo, layers,
+                            fields)
+        if is_frame_sequence(img):
+            if output_format == img.format:
+                output = io.BytesIO()
+                self.watermark_sequence(img, output, stack, output_size, encoder)
+                return output.getvalue()
+            img = self._decode_source(img, output_size)
+        source_encoding = source_info(img)
+        if img is source and img.mode == 'RGB':
+            # 不修改调用方传入的RGB图像
+            img = img.copy()
+        scale = img.width / getattr(img, "source_size", img.size)[0]
+        watermarked = self.apply_layers(img, stack, scale)
+        if watermarked.mode != 'RGB':
+            with stage("convert", pixels=watermarked.width * watermarked.height):
+                watermarked = convert_image(watermarked, 'RGB')
+
+        options = self._encoder_options(output_format, source_encoding, encoder)
+        output = io.BytesIO()
+        with stage("encode", pixels=watermarked.width * watermarked.height):
+            watermarked.save(output, format=output_format, **options)
+        return output.getvalue()
+
+    def watermark_variants(self, source, variants, watermark_text, font_size=24, font_color='black',
+                           transparency=100, rotation=0, position='bottomRight', output_format=None, encoder=None,
+                           logo=None, layers=None, fields=None):
+        """
+        一次解码生成多个输出规格
+
+        所有规格都小于原图时，JPEG按其中最大的尺寸用 draft() 在DCT阶段缩小解码；
+        各规格从同一张解码后的图像用 resize_image 缩放，
+        字号和手动位置按规格的缩放比例调整，缩放、添加水印和编码在线程池中并行。
+        动画GIF、APNG和多页TIFF以原格式输出的规格保留所有帧，其他格式的规格只输出第一帧并打印警告。
+
+        :param source: bytes、文件对象或文件路径
+        :param variants: output_variants.parse_variant 返回的规格列表
+        :param output_format: 规格未指定格式时的输出格式，默认与输入格式相同
+        :param encoder: 编码配置 {"profile", "quality", "lossless"}，规格中的编码配置优先
+        :param logo: Logo设置 {"path", "width", "opacity", "rotation", "position"}，None 表示不添加Logo
+        :param layers: parse_layers 返回的附加图层，与文字、Logo在同一次合成中叠加
+        :param fields: 当前图片的模板字段值（见 layer_stack）
+        :return: 与 variants 顺序相同的输出图片内容 (bytes) 列表
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        with stage("open"):
+            img = Image.open(source)
+        with img:
+            stack = layer_stack(watermark_text, font_size, font_color, transparency, rotation, position, logo,
+                                layers, fields)
+            outputs = [None] * len(variants)
+            if is_frame_sequence(img):
+                # 保持原格式的规格逐帧写出，其余规格只输出第一帧
+                outputs = self._sequence_variants(img, variants, stack, output_format, encoder,
+                                                  source if isinstance(source, str) else None)
+            pending = [i for i, output in enumerate(outputs) if output is None]
+            if not pending:
+                return outputs
+
+            original_size = img.size
+            targets = [variant_size(original_size, variants[i]["max_size"]) for i in pending]
+            largest = max(targets, key=lambda size: size[0] * size[1])
+            # 按其中最大的规格缩小解码
+            self.decode(img, largest, source if isinstance(source, str) else None)
+            output_format = output_format or default_output_format(img)
+            source_encoding = source_info(img)
+            executor = _get_variant_executor()
+
+            # 先完成所有缩放，原尺寸的规格随后才能在解码图像上直接绘制
+            resized = list(executor.map(lambda target: resize_image(img, target), targets))
+            shared = [i for i, frame in enumerate(resized) if frame is img]
+            for i in shared[1:]:
+                # 多个原尺寸规格时只有第一个在解码图像上直接绘制
+                resized[i] = img.copy()
+
+            def render(variant, frame):
+                watermarked = self.apply_layers(frame, stack, frame.width / original_size[0])
+                if watermarked.mode != 'RGB':
+                    with stage("convert", pixels=watermarked.width * watermarked.height):
+                        watermarked = convert_image(watermarked, 'RGB')
+
+                frame_format = variant["format"] or output_format
+                options = self._encoder_options(frame_format, source_encoding, self._variant_encoder(variant, encoder))
+                output = io.BytesIO()
+                with stage("encode", pixels=watermarked.width * watermarked.height):
+                    watermarked.save(output, format=frame_format, **options)
+                return output.getvalue()
+
+            for i, output in zip(pending, executor.map(render, [variants[i] for i in pending], resized)):
+                outputs[i] = output
+            return outputs
+
+    def _variant_encoder(self, variant, encoder=None):
+        """输出规格使用的编码配置：规格中的编码配置优先"""
+        variant_encoder = dict(encoder or self.get_encoder())
+        if variant["profile"]:
+            variant_encoder["profile"] = variant["profile"]
+        return variant_encoder
+
+    def _sequence_variants(self, img, variants, stack, output_format=None, encoder=None, name=None):
+        """
+        多帧来源的输出规格：格式与来源相同的规格逐帧写出（见 watermark_sequence），
+        其他格式的规格只能输出第一帧，打印警告后留给调用方按单帧处理
+        :param img: 尚未解码的多帧图像
+        :return: 与 variants 对应的列表，逐帧写出的规格为输出内容，其余为None
+        """
+        outputs = []
+        for variant in variants:
+            frame_format = variant["format"] or output_format or img.format
+            if frame_format != img.format:
+                print(f"警告: {name or '多帧图像'} 共 {img.n_frames} 帧，输出为 {frame_format} 时只保留第一帧")
+                outputs.append(None)
+                continue
+            output = io.BytesIO()
+            self.watermark_sequence(img, output, stack, {"max_size": variant["max_size"], "scale": None},
+                                    self._variant_encoder(variant, encoder))
+            outputs.append(output.getvalue())
+        # 其余规格从第一帧解码
+        img.seek(0)
+        return outputs
+
     def add_text_watermark(self, input_path, output_path, watermark_text, font_size=24,
-                          font_color='black', transparency=100, rotation=0, position='bottomRight'):
+                          font_color='black', transparency=100, rotation=0, position='bottomRight', logo=None,
+                          layers=None, fields=None):
         """
         向图像添加文本水印
 
@@ -25,125 +1257,41 @@ class WatermarkHandler:
         :param transparency: 透明度 (0-100)
         :param rotation: 旋转角度 (-180到180)
         :param position: 水印位置
+        :param logo: Logo设置 {"path", "width", "opacity", "rotation", "position"}，None 表示不添加Logo
+        :param layers: parse_layers 返回的附加图层，与文字、Logo在同一次合成中叠加
+        :param fields: 当前图片的模板字段值，用于替换文字中的 {date}、{filename}、{camera}（见 layer_stack）
         :return: 是否成功添加水印
         """
         try:
             # 打开图像
-            with Image.open(input_path) as img:
-                # 转换为RGBA模式以支持透明度
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-
-                # 创建一个透明图层用于绘制水印
-                txt_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
-                draw = ImageDraw.Draw(txt_layer)
-
-                # 尝试使用支持中文的字体
-                font_names = [
-                    "simhei.ttf",      # 黑体
-                    "simsun.ttc",      # 宋体
-                    "msyh.ttc",        # 微软雅黑
-                    "simkai.ttf",      # 楷体
-                    "fangsong.ttf",    # 仿宋
-                    "arial.ttf",
-                    "DejaVuSans.ttf"
-                ]
-
-                font = None
-                for font_name in font_names:
-                    try:
-                        font = ImageFont.truetype(font_name, font_size)
-                        break
-                    except:
-                        continue
-
-                # 如果所有字体都失败，使用默认字体
-                if font is None:
-                    font = ImageFont.load_default()
-                    # 如果默认字体也不支持中文，尝试使用系统字体
-                    try:
-                        # Windows系统字体
-                        font = ImageFont.truetype("C:/Windows/Fonts/simhei.ttf", font_size)
-                    except:
-                        try:
-                            # macOS系统字体
-                            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-                        except:
-                            try:
-                                # Linux系统字体
-                                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-                            except:
-                                pass
-
-                # 获取文本尺寸
-                bbox = draw.textbbox((0, 0), watermark_text, font=font)
-                text_width = bbox[2] - bbox[0]
-                text_height = bbox[3] - bbox[1]
-
-                # 计算水印位置
-                img_width, img_height = img.size
-                margin = 10
-
-                if position == 'topLeft':
-                    x, y = margin, margin
-                elif position == 'top':
-                    x, y = (img_width - text_width) // 2, margin
-                elif position == 'topRight':
-                    x, y = img_width - text_width - margin, margin
-                elif position == 'left':
-                    x, y = margin, (img_height - text_height) // 2
-                elif position == 'center':
-                    x, y = (img_width - text_width) // 2, (img_height - text_height) // 2
-                elif position == 'right':
-                    x, y = img_width - text_width - margin, (img_height - text_height) // 2
-                elif position == 'bottomLeft':
-                    x, y = margin, img_height - text_height - margin
-                elif position == 'bottom':
-                    x, y = (img_width - text_width) // 2, img_height - text_height - margin
-                elif position == 'bottomRight':
-                    x, y = img_width - text_width - margin, img_height - text_height - margin
-                else:
-                    x, y = img_width - text_width - margin, img_height - text_height - margin
-
-                # 调整透明度
-                alpha = int(255 * transparency / 100)
-
-                # 解析颜色
-                if font_color.startswith('#'):
-                    # HEX颜色
-                    color = tuple(int(font_color[i:i+2], 16) for i in (1, 3, 5))
-                elif font_color.lower() == 'black':
-                    color = (0, 0, 0)
-                elif font_color.lower() == 'white':
-                    color = (255, 255, 255)
-                elif font_color.lower() == 'red':
-                    color = (255, 0, 0)
-                elif font_color.lower() == 'green':
-                    color = (0, 255, 0)
-                elif font_color.lower() == 'blue':
-                    color = (0, 0, 255)
-                else:
-                    color = (0, 0, 0)  # 默认黑色
-
-                # 绘制水印
-                draw.text((x, y), watermark_text, font=font, fill=(*color, alpha))
-
-                # 如果有旋转，应用旋转
-                if rotation != 0:
-                    # 创建一个新的图层用于旋转
-                    rotated_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
-                    rotated_watermark = txt_layer.rotate(rotation, expand=1)
-                    rotated_layer.paste(rotated_watermark, (0, 0), rotated_watermark)
-                    txt_layer = rotated_layer
-
-                # 合并图像和水印图层
-                watermarked = Image.alpha_composite(img, txt_layer)
+            with self._open_input(input_path) as img:
+                stack = layer_stack(watermark_text, font_size, font_color, transparency, rotation, position,
+                                    logo, layers, fields)
+                output_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+                if is_frame_sequence(img) and output_format == img.format:
+                    # 动画和多页图像逐帧处理并写出，TIFF追加页面时需要读回文件头
+                    from image_processor import remove_output
+                    remove_output(output_path)
+                    with open(output_path, 'w+b') as f:
+                        self.watermark_sequence(img, f, stack)
+                    return True
+
+                original_size = img.size
+                target = variant_size(original_size, self.output_max_size, self.output_scale)
+                self.decode(img, target, input_path)
+                source_encoding = source_info(img)
+                # 先缩小到输出尺寸，水印按相同比例在输出分辨率上绘制
+                resized = resize_image(img, target)
+                # 所有图层只在各自的区域一次合成，峰值内存约为解码后图像本身
+                watermarked = self.apply_layers(resized, stack, target[0] / original_size[0])
 
                 # 转换回RGB模式以保存为JPEG等格式
-                watermarked = watermarked.convert('RGB')
+                if watermarked.mode != 'RGB':
+                    with stage("convert", pixels=watermarked.width * watermarked.height):
+                        watermarked = convert_image(watermarked, 'RGB')
 
                 # 保存图像
-                watermarked.save(output_path)
+                self._save_output(watermarked, output_path, source_encoding)
 
                 return True
 
@@ -151,6 +1299,49 @@ class WatermarkHandler:
             print(f"错误: 处理图像 {input_path} 时出错: {e}")
             return False
 
+    def _open_input(self, input_path):
+        """
+        打开输入文件；启用性能分析时先整体读入内存，使读盘与解码分开计时
+        :return: 尚未解码的PIL图像
+        """
+        profiler = get_profiler()
+        if profiler is None:
+            return Image.open(input_path)
+        if not profiler.split_io:
+            with stage("open"):
+                return Image.open(input_path)
+
+        with stage("read") as timer:
+            with open(input_path, 'rb') as f:
+                data = f.read()
+            timer.nbytes_read = len(data)
+        with stage("open"):
+            return Image.open(io.BytesIO(data))
+
+    def _save_output(self, img, output_path, source_encoding=None):
+        """
+        按扩展名和编码配置编码并保存；启用性能分析时先编码到内存，使编码与写盘分开计时
+        :param source_encoding: encoder_profiles.source_info 的返回值，用于沿用JPEG原图质量
+        """
+        pixels = img.width * img.height
+        image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+        options = self._encoder_options(image_format, source_encoding)
+        profiler = get_profiler()
+        # image_processor 在导入时引用本模块，只能在用到时导入
+        from image_processor import remove_output
+        remove_output(output_path)
+        if profiler is None or not profiler.split_io:
+            with stage("encode", pixels=pixels):
+                img.save(output_path, format=image_format, **options)
+            return
+
+        output = io.BytesIO()
+        with stage("encode", pixels=pixels):
+            img.save(output, format=image_format, **options)
+        with stage("write", nbytes_written=output.tell()):
+            with open(output_path, 'wb') as f:
+                f.write(output.getbuffer())
+
     def get_watermark_position(self, image_size, text_size, position):
         """
         计算水印位置
@@ -184,4 +1375,51 @@ class WatermarkHandler:
             return (img_width - text_width - margin, img_height - text_height - margin)
         else:
             # 默认为右下角
-            return (img_width - text_width - margin, img_height - text_height - margin)
\ No newline at end of file
+            return (img_width - text_width - margin, img_height - text_height - margin)
+
+
+def watermark_many(sources, watermark_text, font_size=24, font_color='black', transparency=100,
+                   rotation=0, position='bottomRight', output_format=None, as_image=False, workers=None):
+    """
+    流式批量添加水印，按完成顺序产生结果
+
+    解码、合成和编码期间Pillow会释放GIL，因此使用线程并行；
+    同时处理的图片数量限制为线程数的2倍，内存占用不随输入数量增长。
+
+    :param sources: 可迭代的图片来源（bytes、文件对象、文件路径或PIL图像）
+    :param as_image: 为True时产生PIL图像，否则产生编码后的bytes
+    :param workers: 线程数，默认为CPU核心数
+    :return: 生成器，产生 (输入序号, 结果或异常)
+    """
+    handler = WatermarkHandler()
+    workers = workers or os.cpu_count() or 1
+    settings = (watermark_text, font_size, font_color, transparency, rotation, position)
+
+    def process(source):
+        if as_image:
+            return handler.watermark_image(source, *settings)
+        return handler.watermark_bytes(source, *settings, output_format=output_format)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        source_iter = enumerate(sources)
+        exhausted = False
+        while pending or not exhausted:
+            # 补充任务直到达到并发窗口
+            while not exhausted and len(pending) < workers * 2:
+                item = next(source_iter, None)
+                if item is None:
+                    exhausted = True
+                    break
+                index, source = item
+                pending[executor.submit(process, source)] = index
+
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    yield index, future.result()
+                except Exception as e:
+                    yield index, e
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+水印服务 - 在本机提供HTTP接口，由常驻的工作进程池处理图片
+
+接口:
+    POST /watermark   请求体为图片，返回添加水印后的图片
+    POST /batch       请求体为tar包，返回同名文件组成的tar包（指定 format 时替换扩展名）；
+                      处理失败的成员列在 errors.json 成员和 X-Failed-Members 响应头中，全部失败时返回422
+    GET  /health      返回服务状态和统计信息（JSON）
+    GET  /metrics     启用运行指标时返回Prometheus文本格式的指标
+
+水印参数通过查询字符串传递: text, font_size, font_color, transparency,
+rotation, position, format (jpeg/png/webp/gif/tiff)。未指定 text 时使用图片的EXIF拍摄日期，
+text 中的 {date}、{camera} 在每张图片上替换为拍摄日期和相机型号。
+position=tiled 时在整幅图像上平铺水印，tile_spacing, tile_angle, tile_stagger 指定间距、角度和是否错位。
+编码参数 profile, quality, lossless 覆盖服务启动时的编码配置。
+"""
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+from encoder_profiles import ENCODER_PROFILES, OUTPUT_EXTENSIONS, normalize_format, parse_quality
+from image_processor import normalize_color
+import metrics
+from isolated_pool import QuarantineReport, TaskQuarantined, TaskTimeout
+from watermark_handler import WatermarkHandler, tiled_position
+from worker_pool import WatermarkWorkerPool, watermark_data
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif",
+                 "TIFF": "image/tiff"}
+
+# /batch 响应中列出处理失败成员的tar成员名
+BATCH_ERRORS = "errors.json"
+
+
+class ServiceBusy(Exception):
+    """排队请求数超过上限"""
+
+
+class WatermarkService:
+    def __init__(self, workers=None, max_concurrency=None, max_queue=64,
+                 max_body_size=256 * 1024 * 1024, font_size=24, memory_budget=None):
+        """
+        :param workers: 工作进程数，默认为CPU核心数
+        :param max_concurrency: 同时处理的请求数上限，默认为工作进程数的2倍
+        :param max_queue: 等待处理的请求数上限，超出时返回503
+        :param max_body_size: 请求体大小上限（字节）
+        :param font_size: 工作进程预加载的字体大小
+        :param memory_budget: 单张图像的内存预算（字节），None 表示不限制
+        """
+        self.pool = WatermarkWorkerPool(workers, font_size, memory_budget)
+        self.max_concurrency = max_concurrency or self.pool.workers * 2
+        self.max_queue = max_queue
+        self.max_body_size = max_body_size
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+        self.started = time.time()
+        self.requests = 0
+        self.images = 0
+        self.rejected = 0
+        self.errors = 0
+        self.quarantine = QuarantineReport()
+
+        registry = metrics.get_registry()
+        self.responses = metrics.LabeledCounter(registry, "watermark_http_responses_total", "按状态码统计的响应数", "status")
+        self.request_seconds = None
+        if registry:
+            registry.gauge("watermark_service_active", "正在处理的请求数").set_function(lambda: self.active)
+            registry.gauge("watermark_service_waiting", "排队等待处理的请求数").set_function(lambda: self.waiting)
+            self.request_seconds = registry.histogram("watermark_request_seconds", "请求从获取名额到完成处理的耗时（秒）")
+
+    def acquire(self):
+        """获取处理名额，排队已满时抛出 ServiceBusy"""
+        with self.condition:
+            self.requests += 1
+            if self.active >= self.max_concurrency and self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise ServiceBusy()
+            self.waiting += 1
+            while self.active >= self.max_concurrency:
+                self.condition.wait()
+            self.waiting -= 1
+            self.active += 1
+
+    def release(self):
+        """释放处理名额"""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def count(self, images=0, errors=0):
+        """累加统计数，各请求线程同时更新"""
+        with self.condition:
+            self.images += images
+            self.errors += errors
+
+    def process(self, data, settings, output_format=None):
+        """处理单张图片"""
+        future = self.pool.submit_sized(self.pool.estimate(data), watermark_data, data, settings, output_format)
+        try:
+            result = future.result()
+        except TaskQuarantined as e:
+            self.quarantine.add(f"<请求 {len(data)} 字节>", e)
+            raise
+        self.count(images=1)
+        return result
+
+    def process_batch(self, archive, settings, output_format=None):
+        """
+        处理tar包中的所有图片，与流式模式的tar分帧相同：成员名作为 {filename}，
+        没有EXIF拍摄日期时使用成员的修改日期，指定输出格式时替换扩展名
+        :return: (输出tar包内容, 成功处理的图片数, [{"name": 成员名, "error": 错误信息}, ...])；
+                 有失败的成员时输出tar包中附带 errors.json
+        """
+        output = io.BytesIO()
+        processed = 0
+        failed = []
+        with tarfile.open(fileobj=io.BytesIO(archive), mode='r:*') as tar_in, \
+                tarfile.open(fileobj=output, mode='w') as tar_out:
+            futures = []
+            for member in tar_in:
+                if not member.isfile():
+                    continue
+                data = tar_in.extractfile(member).read()
+                item_settings = dict(settings, filename=os.path.basename(member.name),
+                                     fallback_text=datetime.fromtimestamp(member.mtime).strftime('%Y-%m-%d'))
+                future = self.pool.submit_sized(self.pool.estimate(data), watermark_data, data, item_settings,
+                                                output_format)
+                futures.append((member, future))
+
+            for member, future in futures:
+                try:
+                    image_data, image_format = future.result()
+                except Exception as e:
+                    self.count(errors=1)
+                    self.quarantine.add(member.name, e)
+                    failed.append({"name": member.name, "error": str(e)})
+                    print(f"错误: 处理 {member.name} 时出错: {e}")
+                    continue
+                name = member.name
+                if output_format:
+                    name = os.path.splitext(name)[0] + OUTPUT_EXTENSIONS[image_format]
+                info = tarfile.TarInfo(name)
+                info.size = len(image_data)
+                info.mtime = member.mtime
+                info.mode = member.mode
+                tar_out.addfile(info, io.BytesIO(image_data))
+                processed += 1
+                self.count(images=1)
+
+            if failed:
+                report = json.dumps({"failed": failed}, ensure_ascii=False, indent=2).encode('utf-8')
+                info = tarfile.TarInfo(BATCH_ERRORS)
+                info.size = len(report)
+                info.mtime = int(time.time())
+                tar_out.addfile(info, io.BytesIO(report))
+        return output.getvalue(), processed, failed
+
+    def get_stats(self):
+        """获取服务统计信息"""
+        return {
+            "uptime": time.time() - self.started,
+            "workers": self.pool.workers,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "images": self.images,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "quarantined": self.pool.quarantined,
+            "worker_restarts": self.pool.restarts
+        }
+
+    def shutdown(self, quarantine_report=None):
+        """
+        关闭工作进程池
+        :param quarantine_report: 有被隔离的任务时写入的JSON报告路径
+        """
+        self.pool.shutdown()
+        if quarantine_report and self.quarantine.write(quarantine_report):
+            print(f"{len(self.quarantine)} 个任务被隔离，详见: {quarantine_report}")
+
+
+def _parse_settings(query):
+    """从查询字符串中解析水印设置"""
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    settings = {}
+    if "text" in params:
+        settings["watermark_text"] = params["text"]
+    for key in ("font_size", "transparency", "rotation"):
+        if key in params:
+            settings[key] = int(params[key])
+    if "font_color" in params:
+        # 与目录模式相同支持Pillow识别的所有颜色，无法识别时返回400
+        settings["font_color"] = normalize_color(params["font_color"])
+    if "position" in params:
+        settings["position"] = params["position"]
+    if settings.get("position") == "tiled":
+        settings["position"] = tiled_position(
+            int(params["tile_spacing"]) if "tile_spacing" in params else None,
+            float(params["tile_angle"]) if "tile_angle" in params else None,
+            params["tile_stagger"].lower() in ("1", "true", "yes") if "tile_stagger" in params else None)
+    # 编码配置，未指定的项使用服务启动时的设置
+    if "profile" in params or "quality" in params or "lossless" in params:
+        profile = params.get("profile", WatermarkHandler.encoder_profile)
+        if profile not in ENCODER_PROFILES:
+            raise ValueError(f"未知的编码配置: {profile}")
+        settings["encoder"] = {
+            "profile": profile,
+            "quality": parse_quality(params["quality"]) if "quality" in params else WatermarkHandler.encoder_quality,
+            "lossless": params["lossless"].lower() in ("1", "true", "yes") if "lossless" in params
+            else WatermarkHandler.encoder_lossless
+        }
+    output_format = normalize_format(params.get("format"))
+    if output_format and output_format not in CONTENT_TYPES:
+        raise ValueError(f"不支持的输出格式: {output_format}")
+    return settings, output_format
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, content_type, headers=None):
+        self.service.responses.inc(str(status))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self._send(status, body, "application/json; charset=utf-8", headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        registry = metrics.get_registry()
+        if path == "/health":
+            self._send_json(200, self.service.get_stats())
+        elif path == "/metrics" and registry:
+            self._send(200, registry.render_prometheus().encode('utf-8'), metrics.PROMETHEUS_CONTENT_TYPE)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        # 提前返回时请求体没有读取，连接不能继续复用，否则未读的内容会被当作下一个请求解析
+        if url.path not in ("/watermark", "/batch"):
+            self.close_connection = True
+            self._send_json(404, {"error": "not found"})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self.close_connection = True
+            self._send_json(411, {"error": "缺少请求体"})
+            return
+        if length > self.service.max_body_size:
+            self.close_connection = True
+            self._send_json(413, {"error": "请求体过大"})
+            return
+
+        try:
+            settings, output_format = _parse_settings(url.query)
+        except ValueError as e:
+            self.close_connection = True
+            self._send_json(400, {"error": str(e)})
+            return
+
+        # 取得处理名额后才读取请求体，排队中的请求不占用内存，最多同时缓存 并发上限 个请求体
+        try:
+            self.service.acquire()
+        except ServiceBusy:
+            self.close_connection = True
+            self._send_json(503, {"error": "服务繁忙"}, {"Retry-After": "1"})
+            return
+
+        started = time.perf_counter()
+        try:
+            body = self.rfile.read(length)
+            if len(body) < length:
+                self.close_connection = True
+                self._send_json(400, {"error": "请求体不完整"})
+                return
+            if url.path == "/watermark":
+                image_data, image_format = self.service.process(body, settings, output_format)
+                self._send(200, image_data, CONTENT_TYPES[image_format])
+            else:
+                archive, processed, failed = self.service.process_batch(body, settings, output_format)
+                if failed and not processed:
+                    self._send_json(422, {"error": "所有图片都处理失败", "failed": failed})
+                else:
+                    self._send(200, archive, "application/x-tar", {"X-Failed-Members": str(len(failed))})
+        except TaskQuarantined as e:
+            # 超时返回504，工作进程崩溃或内存超限返回500
+            self.service.count(errors=1)
+            self._send_json(504 if isinstance(e, TaskTimeout) else 500, {"error": str(e), "reason": e.reason})
+        except Exception as e:
+            self.service.count(errors=1)
+            self._send_json(422, {"error": str(e)})
+        finally:
+            self.service.release()
+            if self.service.request_seconds:
+                self.service.request_seconds.observe(time.perf_counter() - started)
+
+
+class WatermarkHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, WatermarkRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+def serve_main(args):
+    """
+    服务模式主函数
+    :param args: parse_serve_arguments 解析得到的参数
+    """
+    service = WatermarkService(
+        workers=args.workers,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        max_body_size=args.max_body_size * 1024 * 1024,
+        font_size=args.font_size,
+        memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    )
+    server = WatermarkHTTPServer((args.host, args.port), service, args.verbose)
+    print(f"水印服务已启动: http://{args.host}:{server.server_address[1]} "
+          f"(工作进程: {service.pool.workers}, 并发上限: {service.max_concurrency}, 队列上限: {service.max_queue})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n停止服务")
+    finally:
+        server.server_close()
+        service.shutdown(args.quarantine_report)
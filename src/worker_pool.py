@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+工作进程池 - 在常驻的工作进程中批量处理图片
+
+工作进程在启动时预加载字体，之后在多个批次之间保持存活，
+字体和水印精灵图缓存因此一直处于预热状态。
+按估算内存提交任务时，所有在途任务的估算内存之和不超过内存上限（见 scheduler.py）。
+每个任务有超时时间，超时、崩溃或内存失控只影响该任务，结果为 TaskQuarantined（见 isolated_pool.py）。
+"""
+
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, Future, as_completed, wait
+import io
+import os
+import signal
+import time
+
+from compositing import get_backend, set_backend
+from exif_extractor import extract_camera_from_exif, extract_date_from_exif, get_file_modification_date
+from image_processor import normalize_color, process_image
+from isolated_pool import IsolatedProcessPool
+from memory_profiler import read_rss
+import metrics
+import profiling
+from scheduler import MemoryAdmission, available_cpus, default_memory_limit, estimate_task_memory
+from watermark_handler import (WatermarkHandler, default_output_format, expand_template, load_font,
+                               needed_fields)
+
+_handler = WatermarkHandler()
+
+
+def _warm_worker(font_size, memory_budget=None, compositor="pillow", collect_stages=False, encoder=None,
+                 output_size=None):
+    """工作进程初始化：预加载字体，设置单张图像内存预算、合成后端、编码配置和输出尺寸，需要时记录各阶段耗时"""
+    # Ctrl+C 由主进程处理，工作进程在进程池关闭时退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_font(font_size)
+    WatermarkHandler.set_memory_budget(memory_budget)
+    set_backend(compositor)
+    if encoder:
+        WatermarkHandler.set_encoder(**encoder)
+    if output_size:
+        WatermarkHandler.set_output_size(**output_size)
+    if collect_stages:
+        # 不按图片记录，所有阶段累计到 outside 中，每个任务结束后取走
+        profiling.enable(profiling.StageProfiler(split_io=False))
+
+
+def _run_instrumented(fn, args, kwargs):
+    """
+    在工作进程中执行任务并记录耗时
+    :return: (任务结果, {阶段名称: 耗时秒数}, 任务耗时)
+    """
+    profiler = profiling.get_profiler()
+    profiler.outside = profiling.ImageRecord(None)
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    stages = {name: stats.wall for name, stats in profiler.outside.stages.items()}
+    return result, stages, elapsed
+
+
+def watermark_file(input_path, output_path, font_size=24, font_color='black', position='bottomRight', layers=None,
+                   text=None):
+    """
+    处理单个文件，水印文本默认为图片拍摄日期
+    :param input_path: 输入图像路径
+    :param output_path: 输出图像路径
+    :param text: 水印文本模板，可包含 {date}、{filename}、{camera}，默认为 {date}
+    :return: (是否成功, 水印文本)
+    """
+    template = text or "{date}"
+    needed = needed_fields(template, layers)
+    fields = {"date": None, "filename": os.path.basename(input_path), "camera": None}
+    if "date" in needed:
+        # 提取EXIF日期，没有EXIF日期时使用文件修改日期
+        fields["date"] = extract_date_from_exif(input_path) or get_file_modification_date(input_path)
+        if not fields["date"]:
+            return False, None
+    if "camera" in needed:
+        fields["camera"] = extract_camera_from_exif(input_path)
+
+    success = process_image(input_path, output_path, template, font_size, font_color, position, layers, fields)
+    return success, expand_template(template, fields)
+
+
+def watermark_data(data, settings, output_format=None):
+    """
+    在内存中处理一张图片
+    :param data: 图片文件内容
+    :param settings: 水印设置字典，watermark_text 可包含模板字段 {date}、{filename}、{camera}，未指定时为 {date}；
+                     {date} 为EXIF拍摄日期，没有EXIF日期时使用 fallback_text（如果有），{filename} 为 filename（如果有）；
+                     encoder、output_size 覆盖进程池的编码配置和输出尺寸，
+                     logo 为Logo设置（见 WatermarkHandler.apply_logo_watermark），layers 为附加图层（见 parse_layers）
+    :param output_format: 输出格式，默认与输入格式相同
+    :return: (输出图片内容, 输出格式)
+    """
+    watermark_text = settings.get("watermark_text") or "{date}"
+    needed = needed_fields(watermark_text, settings.get("layers"))
+    fields = {"date": None, "filename": settings.get("filename"), "camera": None}
+    if "date" in needed:
+        fields["date"] = extract_date_from_exif(io.BytesIO(data)) or settings.get("fallback_text")
+        if not fields["date"]:
+            raise ValueError("水印文本使用拍摄日期，但图片中没有EXIF拍摄日期")
+    if "camera" in needed:
+        fields["camera"] = extract_camera_from_exif(io.BytesIO(data))
+
+    # 多帧图像不在这里解码，由 watermark_bytes 逐帧处理
+    img = _handler.open_source(data, settings.get("output_size"), frames=True)
+    output_format = output_format or default_output_format(img)
+    output = _handler.watermark_bytes(
+        img,
+        watermark_text,
+        settings.get("font_size", 24),
+        normalize_color(settings.get("font_color", "black")),
+        settings.get("transparency", 100),
+        settings.get("rotation", 0),
+        settings.get("position", "bottomRight"),
+        output_format=output_format,
+        encoder=settings.get("encoder"),
+        output_size=settings.get("output_size"),
+        logo=settings.get("logo"),
+        layers=settings.get("layers"),
+        fields=fields
+    )
+    return output, output_format
+
+
+class _PoolMetrics:
+    def __init__(self, registry):
+        self.tasks_ok = registry.counter("watermark_tasks_total", "工作进程完成的任务数", {"result": "ok"})
+        self.tasks_error = registry.counter("watermark_tasks_total", "工作进程完成的任务数", {"result": "error"})
+        self.task_seconds = registry.histogram("watermark_task_seconds", "单个任务在工作进程中的耗时（秒）")
+        self.in_flight = registry.gauge("watermark_pool_in_flight", "已提交但尚未完成的任务数")
+        self.stage_seconds = metrics.StageLatency(registry)
+        self.quarantined = metrics.LabeledCounter(registry, "watermark_quarantined_total", "被隔离的任务数", "reason")
+        self.restarts = metrics.LabeledCounter(registry, "watermark_worker_restarts_total", "工作进程重启次数", "reason")
+
+
+class WatermarkWorkerPool:
+    # 所有在途任务合计的内存上限（字节）：None 表示按 cgroup 或物理内存自动确定，0 表示不限制
+    memory_limit = None
+    # 估算任务内存使用的内存模型，None 表示按图像模式估算
+    memory_model = None
+    # 单个任务的超时时间（秒），None 表示不限制
+    task_timeout = 300
+    # 工作进程完成多少个任务后重启，None 表示不重启
+    max_tasks_per_worker = 1000
+    # 工作进程RSS上限（字节），None 表示不限制
+    max_worker_rss = None
+
+    @classmethod
+    def configure_memory(cls, memory_limit=None, memory_model=None):
+        """
+        设置之后创建的进程池默认使用的内存上限和内存模型
+        :param memory_limit: 内存上限（字节），None 表示自动确定，0 表示不限制
+        :param memory_model: load_memory_model 读取的内存模型
+        """
+        cls.memory_limit = memory_limit
+        cls.memory_model = memory_model
+
+    @classmethod
+    def configure_isolation(cls, task_timeout=300, max_tasks_per_worker=1000, max_worker_rss=None):
+        """
+        设置之后创建的进程池默认的任务超时和工作进程重启条件
+        :param task_timeout: 单个任务的超时时间（秒），None 表示不限制
+        :param max_tasks_per_worker: 工作进程完成多少个任务后重启，None 表示不重启
+        :param max_worker_rss: 工作进程RSS上限（字节），None 表示不限制
+        """
+        cls.task_timeout = task_timeout
+        cls.max_tasks_per_worker = max_tasks_per_worker
+        cls.max_worker_rss = max_worker_rss
+
+    def __init__(self, workers=None, font_size=24, memory_budget=None, compositor=None,
+                 memory_limit=None, memory_model=None):
+        """
+        :param workers: 工作进程数，默认为可用CPU数（考虑 cgroup 配额）
+        :param font_size: 预加载的字体大小
+        :param memory_budget: 单张图像的内存预算（字节），None 表示不限制
+        :param compositor: 合成后端名称，默认与当前进程相同
+        :param memory_limit: 在途任务合计的内存上限（字节），默认见 configure_memory
+        :param memory_model: 内存模型，默认见 configure_memory
+        """
+        self.workers = workers or available_cpus()
+        if memory_limit is None:
+            memory_limit = type(self).memory_limit
+        if memory_limit is None:
+            memory_limit = default_memory_limit()
+        self.memory_limit = memory_limit or None
+        self.memory_model = memory_model or type(self).memory_model
+        self.admission = MemoryAdmission(self.memory_limit)
+        # 启用运行指标时在工作进程中记录各阶段耗时
+        registry = metrics.get_registry()
+        self.metrics = _PoolMetrics(registry) if registry else None
+        if registry:
+            registry.gauge("watermark_memory_admitted_bytes", "在途任务的估算内存之和（字节）").set_function(
+                lambda: self.admission.used)
+            registry.gauge("watermark_worker_rss_bytes", "所有工作进程RSS之和（字节）").set_function(
+                lambda: sum(read_rss(pid) or 0 for pid in self.executor.worker_pids()))
+        self.executor = IsolatedProcessPool(
+            max_workers=self.workers,
+            initializer=_warm_worker,
+            initargs=(font_size, memory_budget, compositor or get_backend().name, self.metrics is not None,
+                      _handler.get_encoder(), _handler.get_output_size()),
+            task_timeout=self.task_timeout,
+            max_tasks_per_worker=self.max_tasks_per_worker,
+            max_worker_rss=self.max_worker_rss,
+            on_event=self._on_event if self.metrics else None
+        )
+
+    @property
+    def restarts(self):
+        """工作进程重启次数（定期重启和隔离任务后的重启）"""
+        return self.executor.restarts
+
+    @property
+    def quarantined(self):
+        """被隔离的任务数（超时、崩溃或内存失控）"""
+        return self.executor.quarantined
+
+    @property
+    def ipc_bytes(self):
+        """经管道传递的任务参数和结果的字节数 (发送, 接收)"""
+        return self.executor.bytes_sent, self.executor.bytes_received
+
+    def _on_event(self, event, reason):
+        if event == "quarantine":
+            self.metrics.quarantined.inc(reason)
+        else:
+            self.metrics.restarts.inc(reason)
+
+    def submit(self, fn, *args, **kwargs):
+        """提交单个任务"""
+        if self.metrics is None:
+            return self.executor.submit(fn, *args, **kwargs)
+
+        # 返回给调用方的 Future 只包含任务结果，耗时等信息在主进程中记录
+        outer = Future()
+        self.metrics.in_flight.inc()
+        inner = self.executor.submit(_run_instrumented, fn, args, kwargs)
+        inner.add_done_callback(lambda future: self._record(future, outer))
+        return outer
+
+    def _record(self, future, outer):
+        pool_metrics = self.metrics
+        pool_metrics.in_flight.dec()
+        try:
+            result, stages, elapsed = future.result()
+        except BaseException as e:
+            pool_metrics.tasks_error.inc()
+            outer.set_exception(e)
+            return
+        pool_metrics.tasks_ok.inc()
+        pool_metrics.task_seconds.observe(elapsed)
+        for name, seconds in stages.items():
+            pool_metrics.stage_seconds(name, seconds)
+        outer.set_result(result)
+
+    def estimate(self, source):
+        """
+        读取文件头估算处理一张图片的峰值内存
+        :param source: 文件路径或图片文件内容
+        :return: 字节数
+        """
+        return estimate_task_memory(source, self.memory_model)
+
+    def submit_sized(self, nbytes, fn, *args, **kwargs):
+        """
+        等到估算内存放得下时再提交任务，任务结束后释放
+        :param nbytes: 任务的估算内存（字节）
+        """
+        self.admission.acquire(nbytes)
+        try:
+            future = self.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.admission.release(nbytes)
+            raise
+        future.add_done_callback(lambda _: self.admission.release(nbytes))
+        return future
+
+    def run_batch(self, fn, items, sizes=None):
+        """
+        并行处理一批任务，按完成顺序返回结果
+        :param fn: 处理函数，必须是模块级函数
+        :param items: 参数元组列表
+        :param sizes: 每个任务的估算内存（字节），指定时按内存上限控制提交并优先处理大任务
+        :return: 生成器，产生 (参数元组, 结果或异常)
+        """
+        if sizes is None:
+            futures = {self.submit(fn, *item): item for item in items}
+            for future in as_completed(futures):
+                yield futures[future], self._result(future)
+            return
+
+        # 按估算内存从大到小排列：大任务最先开始，总耗时不会被最后才开始的大图拖长
+        order = sorted(range(len(items)), key=lambda index: sizes[index], reverse=True)
+        keys = [-sizes[index] for index in order]
+        window = self.workers * 2
+        futures = {}
+
+        def submit_at(position):
+            nbytes = -keys.pop(position)
+            index = order.pop(position)
+            future = self.submit(fn, *items[index])
+            future.add_done_callback(lambda _: self.admission.release(nbytes))
+            futures[future] = index
+
+        while order or futures:
+            while order and len(futures) < window:
+                # 最大的任务放不下时，用放得下的最大任务补位
+                position = 0
+                if self.admission.limit is not None and self.admission.active:
+                    position = bisect_left(keys, self.admission.used - self.admission.limit)
+                if position >= len(order) or not self.admission.try_acquire(-keys[position]):
+                    break
+                submit_at(position)
+            if not futures:
+                # 内存被本批次以外的任务占用，等待释放
+                self.admission.acquire(-keys[0])
+                submit_at(0)
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield items[futures.pop(future)], self._result(future)
+
+    @staticmethod
+    def _result(future):
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    def shutdown(self):
+        """关闭进程池"""
+        self.executor.shutdown(wait=True)